@@ -0,0 +1,105 @@
+"""Бенчмарк аналитики активности для админки: время запроса на N пользователях.
+
+Сравнивает прежний подсчёт (strptime по каждому пользователю) с колоночным
+ActivityIndex: построение индекса, count_activity, count_registrations и
+полный отчёт activity_report без кэша.
+
+Запуск: python bench/bench_analytics.py [--users 1000000] [--legacy-users 100000]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("UPDATE_SPOOL_FILE", "")
+os.chdir(tempfile.mkdtemp(prefix="bench-"))  # файлы хранилища не должны попасть в репозиторий
+
+import main  # noqa: E402
+
+NOW = datetime(2026, 10, 17, 12, 0, 0)
+
+def make_users(count: int, seed: int = 1) -> dict:
+    rnd = random.Random(seed)
+    users = {}
+    for index in range(count):
+        joined = NOW - timedelta(seconds=rnd.randint(0, 900 * 86400))
+        last_active = joined + timedelta(seconds=rnd.randint(0, int((NOW - joined).total_seconds())))
+        users[str(100000 + index)] = {
+            "joined": joined.strftime("%Y-%m-%d %H:%M:%S"),
+            "last_active": last_active.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+    return users
+
+def legacy_count_activity(users: dict, days: int = 30) -> tuple:
+    active = inactive = 0
+    for user in users.values():
+        try:
+            if (NOW - datetime.strptime(user["last_active"], "%Y-%m-%d %H:%M:%S")).days <= days:
+                active += 1
+            else:
+                inactive += 1
+        except Exception:
+            active += 1
+    return active, inactive
+
+def timed(func, repeat: int) -> float:
+    """Среднее время вызова в миллисекундах"""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) / repeat * 1e3
+
+class IndexOnly(main.BaseStorage):
+    """Минимальное хранилище поверх индекса — только для activity_report"""
+
+    def __init__(self, index: main.ActivityIndex):
+        self.index = index
+
+    def count_users(self):
+        return self.index.size
+
+    def count_activity(self, now, days=30):
+        return self.index.count_activity(now, days)
+
+    def count_registrations(self, since, until):
+        return self.index.count_registrations(since, until)
+
+    def registrations_by_month(self):
+        return self.index.registrations_by_month()
+
+    def retention(self, now):
+        return self.index.retention(now)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1_000_000, help="пользователей в индексе")
+    parser.add_argument("--legacy-users", type=int, default=100_000, help="пользователей для прежнего подсчёта")
+    args = parser.parse_args()
+    print(f"numpy: {'да' if main.np is not None else 'нет'}")
+
+    users = make_users(args.users)
+    started = time.perf_counter()
+    index = main.ActivityIndex.build(users)
+    print(f"build            {(time.perf_counter() - started) * 1e3:>10.1f} ms  ({args.users:,} пользователей)")
+
+    legacy_users = dict(list(users.items())[:args.legacy_users])
+    legacy_ms = timed(lambda: legacy_count_activity(legacy_users), 1)
+    print(f"legacy activity  {legacy_ms:>10.1f} ms  ({len(legacy_users):,} пользователей)")
+    print(f"count_activity   {timed(lambda: index.count_activity(NOW), 50):>10.3f} ms")
+    year_start, year_end = datetime(NOW.year, 1, 1), datetime(NOW.year + 1, 1, 1)
+    print(f"registrations    {timed(lambda: index.count_registrations(year_start, year_end), 50):>10.3f} ms")
+
+    storage = IndexOnly(index)
+
+    def fresh_report():
+        storage._activity_report = None
+        storage.activity_report(NOW)
+
+    print(f"activity_report  {timed(fresh_report, 10):>10.3f} ms  (без кэша)")
+    print(f"activity_report  {timed(lambda: storage.activity_report(NOW), 1000):>10.4f} ms  (из кэша)")
@@ -0,0 +1,106 @@
+"""Бенчмарк рассылки против локальной заглушки Bot API: сообщений в секунду.
+
+Регистрирует --users пользователей во временном хранилище и отправляет им
+рассылку через Broadcaster, направив бота на bench/fake_bot_api.py.
+С --interrupt процесс «перезапускается» на указанной доле рассылки:
+Broadcaster останавливается, а новый экземпляр продолжает с контрольной
+точки. В конце проверяется, что ни один чат не получил сообщение дважды.
+
+Запуск: python bench/bench_broadcast.py [--users 3000] [--rate 25] [--interrupt 0.5]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("UPDATE_SPOOL_FILE", "")
+os.environ.setdefault("BROADCAST_PROGRESS_INTERVAL", "1")
+os.chdir(tempfile.mkdtemp(prefix="bench-"))  # файлы хранилища не должны попасть в репозиторий
+
+import main  # noqa: E402
+from aiogram import Bot  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+from aiohttp import web  # noqa: E402
+from fake_bot_api import FakeBotAPI  # noqa: E402
+
+ADMIN_CHAT_ID = 1
+
+async def wait_processed(broadcaster: main.Broadcaster, count: int):
+    while broadcaster.running and broadcaster.summary()["processed"] < count:
+        await asyncio.sleep(0.05)
+
+async def run(args) -> dict:
+    api = FakeBotAPI(args.limit, args.latency, args.blocked, args.missing)
+    runner = web.AppRunner(api.app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    main.bot = Bot(
+        token=os.environ["BOT_TOKEN"],
+        session=AiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{port}")),
+    )
+
+    now_str = time.strftime("%Y-%m-%d %H:%M:%S")
+    for index in range(args.users):
+        main.storage.register_user(str(100000 + index), {"first_name": f"user{index}"}, now_str)
+    await main.storage.save_all(force=True)  # SQLite пишет в фоновом потоке: рассылке нужны все получатели
+
+    started = time.perf_counter()
+    broadcaster = main.Broadcaster(main.BROADCAST_FILE, args.rate, args.concurrency)
+    broadcaster.start("Проверка рассылки", ADMIN_CHAT_ID, 1)
+    if args.interrupt:
+        await wait_processed(broadcaster, int(args.users * args.interrupt))
+        await broadcaster.shutdown()
+        print(f"перезапуск на {broadcaster.summary()['processed']:,} из {args.users:,}")
+        broadcaster = main.Broadcaster(main.BROADCAST_FILE, args.rate, args.concurrency)
+        broadcaster.resume()
+    await broadcaster._task
+    elapsed = time.perf_counter() - started
+
+    summary = broadcaster.summary()
+    await main.storage.save_all(force=True)
+    await main.bot.session.close()
+    await runner.cleanup()
+    return {
+        "elapsed": elapsed,
+        "summary": summary,
+        "server": api.stats,
+        "duplicates": sum(1 for count in api.delivered.values() if count > 1),
+        "unreachable": sum(1 for _, user in main.storage.recent_users(args.users) if user.get("unreachable")),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=3000, help="получателей рассылки")
+    parser.add_argument("--rate", type=float, default=main.BROADCAST_RATE, help="сообщений в секунду")
+    parser.add_argument("--concurrency", type=int, default=main.BROADCAST_CONCURRENCY)
+    parser.add_argument("--limit", type=int, default=30, help="лимит заглушки, сообщений в секунду")
+    parser.add_argument("--latency", type=float, default=0.03, help="задержка ответа заглушки, секунд")
+    parser.add_argument("--blocked", type=float, default=0.05, help="доля заблокировавших бота")
+    parser.add_argument("--missing", type=float, default=0.01, help="доля несуществующих чатов")
+    parser.add_argument("--interrupt", type=float, default=0.0, help="доля рассылки, после которой перезапуск")
+    args = parser.parse_args()
+    main.logging.getLogger("aiogram.event").setLevel(main.logging.WARNING)
+
+    result = asyncio.run(run(args))
+    summary, stats = result["summary"], result["summary"]["stats"]
+    print(f"backend: {main.STORAGE_BACKEND}, rate {args.rate}/s, concurrency {args.concurrency}, "
+          f"заглушка {args.limit}/s, задержка {args.latency * 1e3:.0f} ms")
+    print(f"статус            {summary['status']}")
+    print(f"время             {result['elapsed']:>10.1f} s")
+    print(f"обработано        {summary['processed']:>10,} ({summary['processed'] / result['elapsed']:.1f}/s)")
+    print(f"доставлено        {stats['sent']:>10,} ({stats['sent'] / result['elapsed']:.1f}/s)")
+    print(f"заблокировали     {stats['blocked']:>10,}")
+    print(f"не найдены        {stats['not_found']:>10,}")
+    print(f"ошибки            {stats['failed']:>10,}")
+    print(f"429 от заглушки   {result['server']['too_many_requests']:>10,}")
+    print(f"помечены          {result['unreachable']:>10,}")
+    print(f"повторные доставки{result['duplicates']:>10,}")
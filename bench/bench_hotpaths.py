@@ -0,0 +1,371 @@
+"""Микробенчмарки горячих функций: нс на вызов и выделения памяти на вызов.
+
+Каждый случай — функция одного аргумента и набор входов, по которым она
+вызывается по кругу (даты, тексты, id пользователей). Время — минимум из
+--repeat замеров по --min-time секунд за вычетом стоимости пустого вызова.
+Память — через tracemalloc на отдельном проходе: пик байт, выделенных
+внутри одного вызова (временные объекты), и блоков, оставшихся живыми
+после вызова (кэши и утечки), в среднем на вызов.
+
+Случаи, зависящие от данных (calculate_active_users, personalize_response,
+recent_actions), прогоняются на синтетических базах из --sizes
+пользователей; история действий генерируется для --history-users из них.
+Хранилище — то, что задано STORAGE_BACKEND (по умолчанию json; базу
+sqlite на миллион пользователей заполнять долго).
+
+Результат сохраняется в JSON (--out). С --baseline замер сравнивается с
+прошлым; если нс на вызов или выделения хуже больше чем на --tolerance,
+код выхода 1.
+
+Запуск: python bench/bench_hotpaths.py [--sizes 10k,100k,1M] [--filter zodiac]
+                                       [--out hotpaths.json] [--baseline hotpaths-main.json]
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("UPDATE_SPOOL_FILE", "")
+os.chdir(tempfile.mkdtemp(prefix="bench-"))  # файлы хранилища не должны попасть в репозиторий
+
+import main  # noqa: E402
+
+NOW = datetime(2026, 10, 17, 12, 0, 0)
+INPUTS = 1024  # входов на случай: достаточно, чтобы не мерить один закэшированный путь
+
+# Действия в тех же пропорциях, что пишут обработчики через update_user_profile
+ACTIONS = (
+    ("start", 10), ("profile_request", 8), ("profile_analysis", 10), ("numerology_request", 6),
+    ("numerology_analysis", 6), ("horoscope_request", 10), ("horoscope_today", 8),
+    ("horoscope_generated_today", 8), ("horoscope_week", 3), ("horoscope_generated_week", 3),
+    ("compatibility_request_general", 4), ("compatibility_analysis", 4), ("relationship_compatibility", 3),
+    ("career_forecast", 3), ("natal_chart_request", 3), ("natal_chart_generated", 3),
+    ("daily_card_request", 5), ("daily_card_generated", 5),
+)
+
+# =====================
+# ДАННЫЕ
+# =====================
+
+def parse_size(text: str) -> int:
+    """10k, 100k, 1M, 250000"""
+    text = text.strip().lower()
+    factor = {"k": 1_000, "m": 1_000_000}.get(text[-1:], 1)
+    return int(float(text[:-1] if factor > 1 else text) * factor)
+
+def random_date(rnd: random.Random) -> str:
+    birth = datetime(1950, 1, 1) + timedelta(days=rnd.randint(0, 60 * 365))
+    return birth.strftime("%d.%m.%Y")
+
+def make_dates(count: int, seed: int = 1) -> list:
+    rnd = random.Random(seed)
+    return [random_date(rnd) for _ in range(count)]
+
+def make_texts(count: int, seed: int = 1) -> list:
+    """Смесь входящих текстов: даты, даты со временем, кнопки меню и свободный текст"""
+    rnd = random.Random(seed)
+    menu = list(main.MENU_ROUTES) or ["🔮 Мой профиль"]
+    free = ["привет", "что меня ждёт завтра?", "12.5", "31.02.1990", "1.1.2000 25:99", "расскажи о любви"]
+    texts = []
+    for _ in range(count):
+        roll = rnd.random()
+        if roll < 0.35:
+            texts.append(random_date(rnd))
+        elif roll < 0.5:
+            texts.append(f"{random_date(rnd)} {rnd.randint(0, 23):02d}:{rnd.randint(0, 59):02d}")
+        elif roll < 0.8:
+            texts.append(rnd.choice(menu))
+        else:
+            texts.append(rnd.choice(free))
+    return texts
+
+def make_users(count: int, seed: int = 1):
+    """(user_id, профиль, joined, last_active) — последние заходы за 900 дней"""
+    rnd = random.Random(seed)
+    for index in range(count):
+        joined = NOW - timedelta(seconds=rnd.randint(0, 900 * 86400))
+        last_active = joined + timedelta(seconds=rnd.randint(0, int((NOW - joined).total_seconds())))
+        profile = {"username": f"user{index}", "first_name": "Bench", "last_name": None}
+        yield str(100000 + index), profile, joined, last_active
+
+def make_histories(user_ids: list, per_user: int, seed: int = 1):
+    """(user_id, действие, data, timestamp, birth_date) — от 0 до per_user действий на пользователя"""
+    rnd = random.Random(seed)
+    names = [name for name, _ in ACTIONS]
+    weights = [weight for _, weight in ACTIONS]
+    for user_id in user_ids:
+        birth_date = random_date(rnd)
+        moment = NOW - timedelta(days=rnd.randint(0, 365))
+        for name in rnd.choices(names, weights, k=rnd.randint(0, per_user)):
+            moment += timedelta(seconds=rnd.randint(60, 86400))
+            data = {"date": birth_date} if name.endswith(("analysis", "generated")) else None
+            yield user_id, name, data, moment.isoformat(), birth_date if data else None
+
+def load_dataset(size: int, history_users: int, per_user: int, seed: int) -> tuple:
+    """Новое хранилище с size пользователями; возвращает (storage, id с историей, секунд)"""
+    started = time.perf_counter()
+    os.chdir(tempfile.mkdtemp(prefix=f"bench-{size}-"))  # у каждой базы свои файлы хранилища
+    storage = main.create_storage()
+    with_history = []
+    for user_id, profile, joined, last_active in make_users(size, seed):
+        storage.register_user(user_id, profile, joined.strftime("%Y-%m-%d %H:%M:%S"))
+        storage.touch_user(user_id, last_active.strftime("%Y-%m-%d %H:%M:%S"))
+        if len(with_history) < history_users:
+            with_history.append(user_id)
+    for record in make_histories(with_history, per_user, seed):
+        storage.append_action(*record)
+    storage._io_executor.submit(int).result()  # SQLite пишет в потоке storage-io — дожидаемся очереди
+    return storage, with_history, time.perf_counter() - started
+
+# =====================
+# ЗАМЕР
+# =====================
+
+def _noop(_):
+    return None
+
+def run_batch(func, inputs: list, batches: int) -> int:
+    started = time.perf_counter_ns()
+    for _ in range(batches):
+        for value in inputs:
+            func(value)
+    return time.perf_counter_ns() - started
+
+def time_per_call(func, inputs: list, min_time: float, repeat: int) -> list:
+    """Нс на вызов в каждом из repeat замеров (без поправки на пустой вызов)"""
+    run_batch(func, inputs, 1)  # прогрев: ленивые индексы, кэши re
+    batch_ns = max(run_batch(func, inputs, 1), 1)
+    batches = max(1, int(min_time * 1e9 / batch_ns))
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return [run_batch(func, inputs, batches) / (batches * len(inputs)) for _ in range(repeat)]
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+def allocations_per_call(func, inputs: list) -> dict:
+    """Пик байт внутри вызова и живые блоки после него, в среднем на вызов"""
+    func(inputs[0])
+    gc.collect()
+    tracemalloc.start()
+    try:
+        peak_total = 0
+        for value in inputs:
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            func(value)
+            peak_total += tracemalloc.get_traced_memory()[1] - current
+        gc.collect()
+        before = tracemalloc.take_snapshot()
+        for value in inputs:
+            func(value)
+        gc.collect()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    retained = sum(stat.count_diff for stat in after.compare_to(before, "filename")
+                   if stat.traceback[0].filename != tracemalloc.__file__)
+    return {
+        "peak_bytes_per_call": round(peak_total / len(inputs), 1),
+        "retained_blocks_per_call": round(max(retained, 0) / len(inputs), 3),
+    }
+
+def measure(func, inputs: list, args, overhead_ns: float) -> dict:
+    samples = time_per_call(func, inputs, args.min_time, args.repeat)
+    samples.sort()
+    result = {
+        "ns_per_call": round(max(samples[0] - overhead_ns, 0.0), 1),
+        "ns_median": round(max(samples[len(samples) // 2] - overhead_ns, 0.0), 1),
+    }
+    if not args.no_alloc:
+        result.update(allocations_per_call(func, inputs[:args.alloc_calls]))
+    return result
+
+# =====================
+# СЛУЧАИ
+# =====================
+
+def pure_cases() -> dict:
+    """Случаи без хранилища: имя -> (функция, входы)"""
+    dates = make_dates(INPUTS, 1)
+    texts = make_texts(INPUTS, 2)
+    with_time = [f"{date} {index % 24:02d}:{index % 60:02d}" if index % 2 else date
+                 for index, date in enumerate(dates)]
+    loose = [f"{int(d[:2])}.{int(d[3:5])}.{d[6:]}" for d in dates]  # 1.5.1990 — мимо быстрого пути
+
+    windows = {h_type: main.horoscope_window(h_type, NOW) for h_type in main.HOROSCOPE_TYPE_NAMES}
+    signs = [main.get_zodiac_sign(date) for date in dates]
+    life_numbers = [main.NumerologyFeatures.calculate_life_path_number(date) for date in dates]
+    h_types = list(windows)
+    horoscope_args = [
+        (h_types[index % len(h_types)], sign["name"], sign["element"], life)
+        for index, (sign, life) in enumerate(zip(signs, life_numbers))
+    ]
+    card_args = [(sign["name"], sign["element"], life) for sign, life in zip(signs, life_numbers)]
+    today_str = NOW.strftime("%d.%m.%Y")
+
+    def horoscope_prompt(item):
+        h_type, name, element, life = item
+        return main.build_horoscope_prompt(h_type, name, element, life, *windows[h_type])
+
+    def daily_card_prompt(item):
+        return main.build_daily_card_prompt(*item, today_str)
+
+    life_path = main.NumerologyFeatures.calculate_life_path_number
+    return {
+        "life_path_number": (life_path, dates),
+        "life_path_number_loose": (life_path, loose),
+        "get_zodiac_sign": (main.get_zodiac_sign, dates),
+        "is_date": (main.is_date, texts),
+        "resolve_text_route": (main.resolve_text_route, texts),
+        "parse_date_input": (main.parse_date_input, with_time),
+        "horoscope_prompt": (horoscope_prompt, horoscope_args),
+        "daily_card_prompt": (daily_card_prompt, card_args),
+    }
+
+def storage_cases(with_history: list, seed: int) -> dict:
+    """Случаи на текущем main.storage"""
+    rnd = random.Random(seed)
+    ids = [rnd.choice(with_history) for _ in range(INPUTS)] if with_history else ["0"] * INPUTS
+    user_ids = [int(user_id) for user_id in ids]
+    features = ["profile", "numerology", "compatibility"]
+    personalize_args = [(user_id, features[index % 3]) for index, user_id in enumerate(user_ids)]
+
+    def personalize(item):
+        return main.PersonalizationEngine.personalize_response(item[0], "Базовый ответ.", item[1])
+
+    return {
+        "calculate_active_users": (lambda _: main.calculate_active_users(), [None] * 64),
+        "recent_actions": (lambda user_id: main.storage.recent_actions(user_id, 5), ids),
+        "personalize_response": (personalize, personalize_args),
+    }
+
+# =====================
+# ОТЧЁТ И СРАВНЕНИЕ
+# =====================
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# метрика -> абсолютный допуск, ниже которого разница считается шумом
+REGRESSION_METRICS = (
+    ("ns_per_call", 20.0),
+    ("peak_bytes_per_call", 64.0),
+    ("retained_blocks_per_call", 0.5),
+)
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list:
+    """Строки сравнения с прошлым результатом; регрессии помечены"""
+    rows = []
+    for case, stats in result["cases"].items():
+        old_stats = baseline.get("cases", {}).get(case)
+        if not old_stats:
+            continue
+        for metric, slack in REGRESSION_METRICS:
+            new, old = stats.get(metric), old_stats.get(metric)
+            if new is None or old is None:
+                continue
+            change = (new - old) / abs(old) if old else 0.0
+            regressed = new > old * (1 + tolerance) and new - old > slack
+            rows.append((case, metric, old, new, change, regressed))
+    return rows
+
+def print_row(case: str, stats: dict):
+    alloc = ""
+    if "peak_bytes_per_call" in stats:
+        alloc = f"{stats['peak_bytes_per_call']:>12.0f}{stats['retained_blocks_per_call']:>10.2f}"
+    print(f"{case:40s}{stats['ns_per_call']:>12.1f}{stats['ns_median']:>12.1f}{alloc}", flush=True)
+
+def run(args) -> dict:
+    pattern = re.compile(args.filter) if args.filter else None
+    selected = lambda name: pattern is None or pattern.search(name)  # noqa: E731
+    overhead_ns = min(time_per_call(_noop, [None] * INPUTS, args.min_time, args.repeat))
+    print(f"Python {sys.version.split()[0]}, хранилище {main.STORAGE_BACKEND}, "
+          f"numpy: {'да' if main.np is not None else 'нет'}, пустой вызов {overhead_ns:.1f} нс")
+    print(f"{'':40s}{'нс/вызов':>12s}{'медиана':>12s}{'пик Б':>12s}{'блоков':>10s}")
+    cases = {}
+    for name, (func, inputs) in pure_cases().items():
+        if selected(name):
+            cases[name] = measure(func, inputs, args, overhead_ns)
+            print_row(name, cases[name])
+
+    datasets = {}
+    storage_names = [name for name in storage_cases([], args.seed) if selected(name)]
+    for size in args.sizes if storage_names else ():
+        previous = main.storage
+        main.storage, with_history, load_seconds = load_dataset(
+            size, min(args.history_users, size), args.actions_per_user, args.seed)
+        datasets[str(size)] = {"users": size, "history_users": len(with_history), "load_s": round(load_seconds, 2)}
+        print(f"--- {size:,} пользователей, история у {len(with_history):,} (загрузка {load_seconds:.1f} с)")
+        try:
+            for name, (func, inputs) in storage_cases(with_history, args.seed).items():
+                if name in storage_names:
+                    key = f"{name}[{size}]"
+                    cases[key] = measure(func, inputs, args, overhead_ns)
+                    print_row(key, cases[key])
+        finally:
+            main.storage = previous
+            del with_history
+            gc.collect()
+
+    return {
+        "git_commit": git_commit(),
+        "python": sys.version.split()[0],
+        "config": {
+            "backend": main.STORAGE_BACKEND,
+            "min_time": args.min_time,
+            "repeat": args.repeat,
+            "overhead_ns": round(overhead_ns, 1),
+            "datasets": datasets,
+        },
+        "cases": cases,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10k,100k", help="размеры баз через запятую: 10k,100k,1M")
+    parser.add_argument("--history-users", type=int, default=100_000, help="пользователей с историей действий")
+    parser.add_argument("--actions-per-user", type=int, default=50, help="до скольких действий на пользователя")
+    parser.add_argument("--filter", help="регулярное выражение по именам случаев")
+    parser.add_argument("--min-time", type=float, default=0.2, help="секунд на один замер")
+    parser.add_argument("--repeat", type=int, default=5, help="замеров на случай")
+    parser.add_argument("--alloc-calls", type=int, default=256, help="вызовов на замер памяти")
+    parser.add_argument("--no-alloc", action="store_true", help="не мерить выделения памяти")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="файл для результата в JSON")
+    parser.add_argument("--baseline", help="прошлый результат для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="допустимое ухудшение, доля")
+    args = parser.parse_args()
+    args.sizes = [parse_size(size) for size in args.sizes.split(",") if size.strip()]
+
+    result = run(args)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"результат: {args.out}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"сравнение с {args.baseline} (commit {baseline.get('git_commit')}):")
+        rows = compare(result, baseline, args.tolerance)
+        for case, metric, old, new, change, regressed in rows:
+            print(f"  {case:36s}{metric:26s}{old:>10.1f} → {new:>10.1f}  {change:+.1%}"
+                  f"{'  РЕГРЕССИЯ' if regressed else ''}")
+        if any(row[-1] for row in rows):
+            sys.exit(1)
@@ -0,0 +1,138 @@
+"""Бенчмарк маршрутизации текстовых сообщений: стоимость на одно сообщение.
+
+Сравнивает прежнюю цепочку фильтров (лямбда на каждую кнопку меню, затем
+is_date через DateModel с исключениями) с таблицей маршрутов
+resolve_text_route. Замеряется и сама функция выбора, и полный проход
+через Dispatcher aiogram с пустыми обработчиками.
+
+Запуск: python bench/bench_routing.py [--rounds 2000]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("UPDATE_SPOOL_FILE", "")
+os.chdir(tempfile.mkdtemp(prefix="bench-"))  # файлы хранилища не должны попасть в репозиторий
+
+import main  # noqa: E402
+from aiogram import Dispatcher, Router  # noqa: E402
+from aiogram.types import Update  # noqa: E402
+
+MESSAGES = [
+    "🔮 Мой профиль",
+    "♈ Гороскоп",
+    "ℹ️ О боте",
+    "🔙 В главное меню",
+    "15.05.1990",
+    "15.05.1990 14:30",
+    "15.05.1990 22.08.1988",
+    "спасибо!",
+    "как дела?",
+]
+
+def legacy_is_date(text):
+    if not text:
+        return False
+    date_part = text.strip().split()[0]
+    try:
+        main.DateModel(date_str=date_part)
+        return True
+    except Exception:
+        return False
+
+def legacy_filters():
+    """Фильтры в порядке прежней регистрации на router.message"""
+    filters = [lambda m, text=text: m.text == text for text in main.MENU_ROUTES]
+    filters.append(lambda m: legacy_is_date(m.text))
+    filters.append(lambda m: m.text and len(m.text.split()) == 2 and all("." in part for part in m.text.split()))
+    return filters
+
+class FakeMessage:
+    __slots__ = ("text",)
+
+    def __init__(self, text):
+        self.text = text
+
+def legacy_resolve(filters, message):
+    for index, check in enumerate(filters):
+        if check(message):
+            return index
+    return None
+
+def bench_resolve(rounds: int) -> dict:
+    filters = legacy_filters()
+    messages = [FakeMessage(text) for text in MESSAGES]
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for message in messages:
+            legacy_resolve(filters, message)
+    legacy = time.perf_counter() - started
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for message in messages:
+            main.resolve_text_route(message.text)
+    fast = time.perf_counter() - started
+    total = rounds * len(messages)
+    return {"legacy_ns": legacy / total * 1e9, "fast_ns": fast / total * 1e9}
+
+def build_dispatchers():
+    async def noop(*args, **kwargs):
+        pass
+
+    legacy_router = Router()
+    for check in legacy_filters():
+        legacy_router.message(check)(noop)
+    legacy_dp = Dispatcher()
+    legacy_dp.include_router(legacy_router)
+
+    fast_router = Router()
+    fast_router.message(main.match_text_route)(noop)
+    fast_dp = Dispatcher()
+    fast_dp.include_router(fast_router)
+    return legacy_dp, fast_dp
+
+def make_updates():
+    updates = []
+    for index, text in enumerate(MESSAGES):
+        updates.append(Update.model_validate({
+            "update_id": index,
+            "message": {
+                "message_id": index,
+                "date": 1760000000,
+                "chat": {"id": 111, "type": "private"},
+                "from": {"id": 111, "is_bot": False, "first_name": "Иван"},
+                "text": text,
+            },
+        }, context={"bot": main.bot}))
+    return updates
+
+async def bench_dispatch(rounds: int) -> dict:
+    legacy_dp, fast_dp = build_dispatchers()
+    updates = make_updates()
+    results = {}
+    for name, dp in (("legacy", legacy_dp), ("fast", fast_dp)):
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for update in updates:
+                await dp.feed_update(main.bot, update)
+        results[f"{name}_us"] = (time.perf_counter() - started) / (rounds * len(updates)) * 1e6
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=2000, help="проходов по набору сообщений")
+    args = parser.parse_args()
+    main.logging.getLogger("aiogram.event").setLevel(main.logging.WARNING)
+
+    resolve = bench_resolve(args.rounds)
+    print(f"resolve   legacy {resolve['legacy_ns']:>9.0f} ns/msg   fast {resolve['fast_ns']:>9.0f} ns/msg"
+          f"   x{resolve['legacy_ns'] / resolve['fast_ns']:.1f}")
+    dispatch = asyncio.run(bench_dispatch(max(1, args.rounds // 10)))
+    print(f"dispatch  legacy {dispatch['legacy_us']:>9.1f} us/msg   fast {dispatch['fast_us']:>9.1f} us/msg"
+          f"   x{dispatch['legacy_us'] / dispatch['fast_us']:.1f}")
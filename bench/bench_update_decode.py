@@ -0,0 +1,109 @@
+"""Микробенчмарк разбора входящих обновлений: обновлений в секунду.
+
+Сравнивает прежний путь вебхука (json → dict → Update(**dict) и повторная
+валидация внутри feed_update из-за отсутствия контекста бота) с текущим
+(decode_update + Update.model_validate_json с контекстом бота).
+
+Запуск: python bench/bench_update_decode.py [--seconds 2]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("UPDATE_SPOOL_FILE", "")
+os.chdir(tempfile.mkdtemp(prefix="bench-"))  # файлы хранилища не должны попасть в репозиторий
+
+import main  # noqa: E402
+from aiogram.types import Update  # noqa: E402
+
+SAMPLES = {
+    "menu_button": {
+        "update_id": 100000001,
+        "message": {
+            "message_id": 42,
+            "from": {"id": 111, "is_bot": False, "first_name": "Иван", "username": "ivan", "language_code": "ru"},
+            "chat": {"id": 111, "first_name": "Иван", "username": "ivan", "type": "private"},
+            "date": 1760000000,
+            "text": "🔮 Мой профиль",
+        },
+    },
+    "callback_query": {
+        "update_id": 100000002,
+        "callback_query": {
+            "id": "4382bfdwdsb323b2d9",
+            "from": {"id": 111, "is_bot": False, "first_name": "Иван"},
+            "message": {
+                "message_id": 43,
+                "from": {"id": 999, "is_bot": True, "first_name": "Bot", "username": "astro_bot"},
+                "chat": {"id": 111, "type": "private"},
+                "date": 1760000001,
+                "text": "Выберите период",
+            },
+            "chat_instance": "-123456789",
+            "data": "horoscope_today",
+        },
+    },
+    "unrouted_edited": {
+        "update_id": 100000003,
+        "edited_message": {
+            "message_id": 44,
+            "from": {"id": 111, "is_bot": False, "first_name": "Иван"},
+            "chat": {"id": 111, "type": "private"},
+            "date": 1760000002,
+            "edit_date": 1760000003,
+            "text": "01.01.1990",
+        },
+    },
+}
+
+def legacy_path(raw: bytes):
+    update_data = json.loads(raw)
+    update = Update(**update_data)
+    # feed_update перемонтирует обновление без контекста бота
+    if update.bot != main.bot:
+        update = Update.model_validate(update.model_dump(), context={"bot": main.bot})
+    return update
+
+def fast_path(raw: bytes):
+    update = main.decode_update(raw)
+    if update.update_type not in main.routed_update_types():
+        return None
+    return Update.model_validate_json(update.raw, context={"bot": main.bot})
+
+def measure(func, raw: bytes, seconds: float) -> float:
+    """Обновлений в секунду за seconds секунд"""
+    for _ in range(100):
+        func(raw)
+    count = 0
+    started = time.perf_counter()
+    deadline = started + seconds
+    while True:
+        for _ in range(100):
+            func(raw)
+        count += 100
+        now = time.perf_counter()
+        if now >= deadline:
+            return count / (now - started)
+
+def run(seconds: float) -> dict:
+    results = {}
+    for name, sample in SAMPLES.items():
+        raw = json.dumps(sample, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        legacy = measure(legacy_path, raw, seconds)
+        fast = measure(fast_path, raw, seconds)
+        results[name] = {"legacy_per_s": round(legacy), "fast_per_s": round(fast), "speedup": round(fast / legacy, 2)}
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=2.0, help="длительность замера одного варианта")
+    args = parser.parse_args()
+    print(f"json backend: {main.json_loads.__module__}")
+    for name, row in run(args.seconds).items():
+        print(f"{name:18s} legacy {row['legacy_per_s']:>9,}/s   fast {row['fast_per_s']:>9,}/s   x{row['speedup']}")
@@ -0,0 +1,543 @@
+"""Нагрузочный прогон вебхука: бот в отдельном процессе против заглушек Telegram и LLM.
+
+Запускает main.py с TELEGRAM_API_URL и LLM_BASE_URL, указывающими на
+bench/fake_bot_api.py и bench/mock_llm_server.py (они работают в этом
+процессе), и с постоянной частотой, не дожидаясь ответов, шлёт на /webhook
+синтетические обновления: /start, кнопки меню, даты рождения, пары дат для
+совместимости и выбор периода гороскопа (callback). Измеряется:
+
+- подтверждение вебхука — время HTTP-ответа на POST /webhook;
+- первый и полный ответ — от POST до первого и последнего сообщения или
+  правки бота в этом чате (один чат получает обновление не чаще раза в
+  --chat-gap секунд, поэтому ответы однозначно относятся к обновлению);
+- пропускная способность, прирост RSS процесса бота, сбросы хранилища
+  (/api/admin/storage) и серверные гистограммы из /metrics за время замера.
+
+Результат сохраняется в JSON (--out). С --baseline прогон сравнивается с
+прошлым результатом; если p95 задержек, пропускная способность, стоимость
+сброса или прирост памяти хуже больше чем на --tolerance, код выхода 1.
+
+Запуск: python bench/bench_webhook.py [--rate 50] [--duration 30] [--backend sqlite]
+                                      [--out webhook.json] [--baseline webhook-main.json]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import random
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+import aiohttp
+from aiohttp import web
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from fake_bot_api import FakeBotAPI  # noqa: E402
+from mock_llm_server import LATENCY_KINDS, MockLLM  # noqa: E402
+
+BOT_TOKEN = "123456:bench"
+WEBHOOK_SECRET = "bench-secret"
+ADMIN_TOKEN = "bench-admin"
+USER_BASE = 10_000_000
+
+SCENARIOS = {
+    "start": 0.10,
+    "menu": 0.35,
+    "date": 0.25,
+    "compatibility": 0.10,
+    "horoscope_callback": 0.20,
+}
+MENU_BUTTONS = (
+    "🔮 Мой профиль", "♈ Гороскоп", "🔢 Нумерология", "💞 Совместимость",
+    "🌌 Натальная карта", "✨ Карта дня", "ℹ️ О боте",
+)
+HOROSCOPE_PERIODS = ("today", "tomorrow", "week", "month")
+
+# Путь к значению в результате, что считается улучшением, и допустимый
+# абсолютный шум, ниже которого разница не считается регрессией
+REGRESSION_CHECKS = (
+    ("ack_ms.p95", "lower", 1.0),
+    ("first_reply_ms.p95", "lower", 5.0),
+    ("full_reply_ms.p95", "lower", 20.0),
+    ("throughput.acked_per_s", "higher", 1.0),
+    ("storage.mean_flush_ms", "lower", 1.0),
+    ("memory.growth_mb", "lower", 5.0),
+)
+
+class UpdateFactory:
+    """Синтетические обновления Telegram в том виде, в каком их шлёт Bot API"""
+
+    def __init__(self, seed: int):
+        self.random = random.Random(seed)
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+
+    def kind(self) -> str:
+        return self.random.choices(list(SCENARIOS), weights=list(SCENARIOS.values()))[0]
+
+    def birth_date(self) -> str:
+        return f"{self.random.randint(1, 28):02d}.{self.random.randint(1, 12):02d}.{self.random.randint(1950, 2008)}"
+
+    @staticmethod
+    def user(user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": "Тест", "language_code": "ru"}
+
+    def message(self, user_id: int, text: str) -> dict:
+        return {
+            "update_id": next(self.update_ids),
+            "message": {
+                "message_id": next(self.message_ids),
+                "from": self.user(user_id),
+                "chat": {"id": user_id, "first_name": "Тест", "type": "private"},
+                "date": int(time.time()),
+                "text": text,
+            },
+        }
+
+    def callback(self, user_id: int, data: str) -> dict:
+        return {
+            "update_id": next(self.update_ids),
+            "callback_query": {
+                "id": str(next(self.message_ids)),
+                "from": self.user(user_id),
+                "message": {
+                    "message_id": next(self.message_ids),
+                    "from": {"id": 1, "is_bot": True, "first_name": "Bot"},
+                    "chat": {"id": user_id, "type": "private"},
+                    "date": int(time.time()),
+                    "text": "Выберите период",
+                },
+                "chat_instance": str(user_id),
+                "data": data,
+            },
+        }
+
+    def build(self, kind: str, user_id: int) -> bytes:
+        if kind == "start":
+            update = self.message(user_id, "/start")
+        elif kind == "menu":
+            update = self.message(user_id, self.random.choice(MENU_BUTTONS))
+        elif kind == "date":
+            update = self.message(user_id, self.birth_date())
+        elif kind == "compatibility":
+            update = self.message(user_id, f"{self.birth_date()} {self.birth_date()}")
+        else:
+            update = self.callback(user_id, f"horoscope_{self.random.choice(HOROSCOPE_PERIODS)}")
+        return json.dumps(update, ensure_ascii=False).encode("utf-8")
+
+class ReplyTracker:
+    """Сопоставляет сообщения бота с последним обновлением в том же чате"""
+
+    def __init__(self):
+        self.records = []
+        self.open = {}  # chat_id -> запись последнего обновления
+        self.last_event = time.monotonic()
+
+    def posted(self, kind: str, chat_id: int, started: float) -> dict:
+        record = {"kind": kind, "started": started, "ack": None, "status": None, "first": None, "last": None}
+        self.records.append(record)
+        self.open[chat_id] = record
+        return record
+
+    def on_bot_call(self, method: str, chat_id: int, now: float):
+        self.last_event = now
+        record = self.open.get(chat_id)
+        if record is None or now < record["started"]:
+            return
+        if record["first"] is None:
+            record["first"] = now
+        record["last"] = now
+
+def percentile(values, q: float) -> float:
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q
+    low = math.floor(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+def latency_summary(seconds) -> dict:
+    values = [value * 1e3 for value in seconds]
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 3),
+        "p50": round(percentile(values, 0.50), 3),
+        "p95": round(percentile(values, 0.95), 3),
+        "p99": round(percentile(values, 0.99), 3),
+        "max": round(max(values), 3),
+    }
+
+SAMPLE_RE = re.compile(r'^(\w+)(?:\{(.*)\})? (\S+)$')
+LABEL_RE = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+def parse_histograms(text: str) -> dict:
+    """{метрика: {le: накопленное число}} по всем меткам, кроме le, из текста /metrics"""
+    histograms = defaultdict(lambda: defaultdict(float))
+    for line in text.splitlines():
+        match = SAMPLE_RE.match(line)
+        if not match or not match.group(1).endswith("_bucket"):
+            continue
+        labels = dict(LABEL_RE.findall(match.group(2) or ""))
+        histograms[match.group(1)[:-len("_bucket")]][float(labels["le"])] += float(match.group(3))
+    return histograms
+
+def histogram_summary(before: dict, after: dict) -> dict:
+    """Квантили по приращению гистограммы за замер (интерполяция внутри корзины), мс"""
+    bounds = sorted(after)
+    cumulative = [after[bound] - before.get(bound, 0.0) for bound in bounds]
+    total = cumulative[-1] if cumulative else 0
+    if not total:
+        return {"count": 0}
+    result = {"count": int(total)}
+    for name, q in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99)):
+        rank = q * total
+        for index, count in enumerate(cumulative):
+            if count >= rank:
+                upper = bounds[index]
+                lower = bounds[index - 1] if index else 0.0
+                below = cumulative[index - 1] if index else 0.0
+                if math.isinf(upper):
+                    value = lower
+                else:
+                    value = lower + (upper - lower) * ((rank - below) / max(count - below, 1e-9))
+                result[name] = round(value * 1e3, 3)
+                break
+    return result
+
+def process_rss_mb(pid: int):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+async def start_site(app: web.Application):
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, site._server.sockets[0].getsockname()[1]
+
+class BotProcess:
+    """main.py в отдельном процессе с временным рабочим каталогом для файлов хранилища"""
+
+    def __init__(self, args, telegram_url: str, llm_url: str):
+        self.port = free_port()
+        self.workdir = tempfile.mkdtemp(prefix="bench-webhook-")
+        self.env = {
+            **os.environ,
+            "BOT_TOKEN": BOT_TOKEN,
+            "GROQ_API_KEY": "bench",
+            "TELEGRAM_API_URL": telegram_url,
+            "LLM_BASE_URL": llm_url,
+            "WEBHOOK_SECRET": WEBHOOK_SECRET,
+            "ADMIN_TOKEN": ADMIN_TOKEN,
+            "ADMIN_IDS": "1",
+            "PORT": str(self.port),
+            "STORAGE_BACKEND": args.backend,
+            "STORAGE_FLUSH_INTERVAL": str(args.flush_interval),
+            "GROQ_RPM": "0",
+            "LLM_STREAMING": "true" if args.streaming else "false",
+        }
+        self.process = None
+        self.url = f"http://127.0.0.1:{self.port}"
+
+    async def start(self, session: aiohttp.ClientSession, timeout: float = 60):
+        self.log = open(os.path.join(self.workdir, "bot.log"), "wb")
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "main.py")],
+            cwd=self.workdir, env=self.env, stdout=self.log, stderr=subprocess.STDOUT,
+        )
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"бот завершился с кодом {self.process.returncode}, лог: {self.log.name}")
+            try:
+                async with session.get(f"{self.url}/ping") as resp:
+                    if resp.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+        raise RuntimeError(f"бот не ответил на /ping за {timeout} с, лог: {self.log.name}")
+
+    async def admin_get(self, session: aiohttp.ClientSession, path: str):
+        async with session.get(f"{self.url}{path}", headers={"Authorization": f"Bearer {ADMIN_TOKEN}"}) as resp:
+            resp.raise_for_status()
+            return await (resp.json() if path.startswith("/api/") else resp.text())
+
+    def rss_mb(self):
+        return process_rss_mb(self.process.pid)
+
+    def stop(self, timeout: float = 30):
+        if self.process is None or self.process.poll() is not None:
+            return
+        self.process.send_signal(signal.SIGTERM)
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.log.close()
+
+async def send_update(session, url: str, body: bytes, record: dict):
+    try:
+        async with session.post(
+            url, data=body,
+            headers={"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET},
+        ) as resp:
+            await resp.read()
+            record["status"] = resp.status
+    except aiohttp.ClientError as e:
+        record["status"] = type(e).__name__
+    record["ack"] = time.monotonic() - record["started"]
+
+async def drive(session, url: str, factory: UpdateFactory, tracker: ReplyTracker, rate: float,
+                duration: float, users: int):
+    """Открытая нагрузка: обновления уходят по расписанию, не дожидаясь ответов"""
+    total = int(rate * duration)
+    started = time.monotonic()
+    tasks = []
+    for index in range(total):
+        delay = started + index / rate - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        kind = factory.kind()
+        user_id = USER_BASE + index % users
+        body = factory.build(kind, user_id)
+        record = tracker.posted(kind, user_id, time.monotonic())
+        tasks.append(asyncio.create_task(send_update(session, url, body, record)))
+    await asyncio.gather(*tasks)
+    return time.monotonic() - started
+
+async def settle(tracker: ReplyTracker, quiet: float, limit: float):
+    """Ждёт, пока бот не замолчит на quiet секунд (но не дольше limit)"""
+    deadline = time.monotonic() + limit
+    while time.monotonic() < deadline and time.monotonic() - tracker.last_event < quiet:
+        await asyncio.sleep(0.1)
+
+async def run(args) -> dict:
+    telegram = FakeBotAPI(limit=10 ** 9, latency=args.telegram_latency, blocked=0, missing=0, chat_interval=0)
+    llm = MockLLM(latency=args.llm_latency, latency_mean=args.llm_latency_mean,
+                  tokens_per_second=args.llm_tokens_per_second, error_rate=args.llm_error_rate,
+                  rate_limit_rate=args.llm_rate_limit_rate, seed=args.seed)
+    telegram_runner, telegram_port = await start_site(telegram.app())
+    llm_runner, llm_port = await start_site(llm.app())
+    bot = BotProcess(args, f"http://127.0.0.1:{telegram_port}", f"http://127.0.0.1:{llm_port}/v1")
+    connector = aiohttp.TCPConnector(limit=args.connections)
+    session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=60))
+    users = max(args.users, math.ceil(args.rate * args.chat_gap))
+    factory = UpdateFactory(args.seed)
+    try:
+        await bot.start(session)
+        webhook_url = f"{bot.url}/webhook"
+
+        if args.warmup > 0:
+            warmup = ReplyTracker()
+            telegram.listeners = [warmup.on_bot_call]
+            await drive(session, webhook_url, factory, warmup, args.rate, args.warmup, users)
+            await settle(warmup, args.settle, args.settle_limit)
+
+        tracker = ReplyTracker()
+        telegram.listeners = [tracker.on_bot_call]
+        storage_before = await bot.admin_get(session, "/api/admin/storage")
+        metrics_before = parse_histograms(await bot.admin_get(session, "/metrics"))
+        rss_start = bot.rss_mb()
+        rss_peak = rss_start or 0.0
+
+        async def sample_rss():
+            nonlocal rss_peak
+            while True:
+                await asyncio.sleep(0.5)
+                rss_peak = max(rss_peak, bot.rss_mb() or 0.0)
+
+        sampler = asyncio.create_task(sample_rss())
+        started = time.monotonic()
+        elapsed = await drive(session, webhook_url, factory, tracker, args.rate, args.duration, users)
+        await settle(tracker, args.settle, args.settle_limit)
+        sampler.cancel()
+        rss_end = bot.rss_mb()
+        storage_after = await bot.admin_get(session, "/api/admin/storage")
+        metrics_after = parse_histograms(await bot.admin_get(session, "/metrics"))
+    finally:
+        await session.close()
+        bot.stop()
+        await telegram_runner.cleanup()
+        await llm_runner.cleanup()
+
+    records = tracker.records
+    acked = [r for r in records if r["status"] == 200]
+    replied = [r for r in records if r["first"] is not None]
+    by_kind = {}
+    for kind in SCENARIOS:
+        rows = [r for r in records if r["kind"] == kind]
+        by_kind[kind] = {
+            "count": len(rows),
+            "ack_ms": latency_summary(r["ack"] for r in rows if r["status"] == 200),
+            "first_reply_ms": latency_summary(r["first"] - r["started"] for r in rows if r["first"] is not None),
+            "full_reply_ms": latency_summary(r["last"] - r["started"] for r in rows if r["first"] is not None),
+        }
+    last_reply = max((r["last"] for r in replied), default=started)
+    flushes = storage_after.get("flushes", 0) - storage_before.get("flushes", 0)
+    flush_ms = storage_after.get("total_flush_ms", 0.0) - storage_before.get("total_flush_ms", 0.0)
+    server = {}
+    for name, key in (("bot_webhook_ack_seconds", "webhook_ack_ms"), ("bot_update_handle_seconds", "update_handle_ms"),
+                      ("bot_handler_seconds", "handler_ms"), ("bot_groq_request_seconds", "llm_request_ms"),
+                      ("bot_storage_flush_seconds", "storage_flush_ms")):
+        if name in metrics_after:
+            server[key] = histogram_summary(metrics_before.get(name, {}), metrics_after[name])
+
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "config": {**vars(args), "users": users},
+        "updates": {
+            "sent": len(records),
+            "acked": len(acked),
+            "replied": len(replied),
+            "no_reply": len(records) - len(replied),
+            "status": dict(Counter(str(r["status"]) for r in records)),
+        },
+        "throughput": {
+            "offered_per_s": round(len(records) / elapsed, 2),
+            "acked_per_s": round(len(acked) / elapsed, 2),
+            "replied_per_s": round(len(replied) / max(last_reply - started, 1e-9), 2),
+        },
+        "ack_ms": latency_summary(r["ack"] for r in acked),
+        "first_reply_ms": latency_summary(r["first"] - r["started"] for r in replied),
+        "full_reply_ms": latency_summary(r["last"] - r["started"] for r in replied),
+        "by_kind": by_kind,
+        "server": server,
+        "memory": {
+            "rss_start_mb": round(rss_start, 1) if rss_start else None,
+            "rss_end_mb": round(rss_end, 1) if rss_end else None,
+            "rss_peak_mb": round(rss_peak, 1) if rss_peak else None,
+            "growth_mb": round(rss_end - rss_start, 1) if rss_start and rss_end else None,
+        },
+        "storage": {
+            "backend": storage_after.get("backend"),
+            "flushes": flushes,
+            "bytes_written": storage_after.get("bytes_written", 0) - storage_before.get("bytes_written", 0),
+            "mean_flush_ms": round(flush_ms / flushes, 3) if flushes else 0.0,
+            "max_flush_ms": storage_after.get("max_flush_ms"),
+        },
+        "llm": llm.stats,
+        "telegram": telegram.stats,
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def lookup(result: dict, path: str):
+    value = result
+    for key in path.split("."):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list:
+    """Строки сравнения с прошлым результатом; регрессии помечены"""
+    rows = []
+    for path, better, slack in REGRESSION_CHECKS:
+        new, old = lookup(result, path), lookup(baseline, path)
+        if new is None or old is None:
+            continue
+        change = (new - old) / abs(old) if old else 0.0
+        if better == "lower":
+            regressed = new > old * (1 + tolerance) and new - old > slack
+        else:
+            regressed = new < old * (1 - tolerance) and old - new > slack
+        rows.append((path, old, new, change, regressed))
+    return rows
+
+def print_report(result: dict):
+    config = result["config"]
+    print(f"backend {config['backend']}, {config['rate']}/s × {config['duration']} s, "
+          f"LLM {config['llm_latency']} {config['llm_latency_mean'] * 1e3:.0f} ms, commit {result['git_commit']}")
+    updates = result["updates"]
+    print(f"обновлений {updates['sent']}, подтверждено {updates['acked']}, с ответом {updates['replied']}, "
+          f"коды {updates['status']}")
+    throughput = result["throughput"]
+    print(f"пропускная способность: подано {throughput['offered_per_s']}/s, "
+          f"подтверждено {throughput['acked_per_s']}/s, ответов {throughput['replied_per_s']}/s")
+    print(f"{'':24s}{'p50':>10s}{'p95':>10s}{'p99':>10s}{'max':>10s}  мс")
+    rows = [("ack", result["ack_ms"]), ("first reply", result["first_reply_ms"]),
+            ("full reply", result["full_reply_ms"])]
+    rows += [(f"  {kind} full", stats["full_reply_ms"]) for kind, stats in result["by_kind"].items()]
+    rows += [(f"server {name}", stats) for name, stats in result["server"].items()]
+    for name, stats in rows:
+        if stats.get("count"):
+            peak = f"{stats['max']:>10.1f}" if "max" in stats else ""
+            print(f"{name:24s}{stats['p50']:>10.1f}{stats['p95']:>10.1f}{stats['p99']:>10.1f}{peak}")
+    memory, storage = result["memory"], result["storage"]
+    print(f"RSS: {memory['rss_start_mb']} → {memory['rss_end_mb']} MB (пик {memory['rss_peak_mb']}, "
+          f"прирост {memory['growth_mb']})")
+    print(f"хранилище {storage['backend']}: сбросов {storage['flushes']}, {storage['bytes_written']} байт, "
+          f"в среднем {storage['mean_flush_ms']} мс, максимум {storage['max_flush_ms']} мс")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rate", type=float, default=50, help="обновлений в секунду")
+    parser.add_argument("--duration", type=float, default=30, help="секунд замера")
+    parser.add_argument("--warmup", type=float, default=3, help="секунд прогрева без замера")
+    parser.add_argument("--users", type=int, default=1000, help="синтетических пользователей (не меньше rate × chat-gap)")
+    parser.add_argument("--chat-gap", type=float, default=10, help="минимум секунд между обновлениями одного чата")
+    parser.add_argument("--connections", type=int, default=200, help="одновременных HTTP-соединений к вебхуку")
+    parser.add_argument("--backend", choices=("json", "wal", "sqlite"), default="json")
+    parser.add_argument("--flush-interval", type=int, default=5, help="STORAGE_FLUSH_INTERVAL бота, секунд")
+    parser.add_argument("--streaming", action=argparse.BooleanOptionalAction, default=True, help="LLM_STREAMING бота")
+    parser.add_argument("--telegram-latency", type=float, default=0.005, help="задержка заглушки Bot API, секунд")
+    parser.add_argument("--llm-latency", choices=LATENCY_KINDS, default="lognormal")
+    parser.add_argument("--llm-latency-mean", type=float, default=0.3, help="средняя задержка LLM, секунд")
+    parser.add_argument("--llm-tokens-per-second", type=float, default=400)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--llm-rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--settle", type=float, default=3, help="секунд тишины, после которых ответы считаются полными")
+    parser.add_argument("--settle-limit", type=float, default=120, help="максимум ожидания ответов после нагрузки")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="файл для результата в JSON")
+    parser.add_argument("--baseline", help="прошлый результат для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимое ухудшение, доля")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print_report(result)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"результат: {args.out}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"сравнение с {args.baseline} (commit {baseline.get('git_commit')}):")
+        rows = compare(result, baseline, args.tolerance)
+        for path, old, new, change, regressed in rows:
+            print(f"  {path:28s}{old:>12.2f} → {new:>12.2f}  {change:+.1%}{'  РЕГРЕССИЯ' if regressed else ''}")
+        if any(row[-1] for row in rows):
+            sys.exit(1)
@@ -0,0 +1,116 @@
+"""Локальная заглушка Telegram Bot API для прогонов рассылки и вебхука.
+
+Отвечает на sendMessage и editMessageText так же, как настоящий API, и
+воспроизводит его ограничения: больше --limit сообщений за скользящую
+секунду или второе сообщение в чат быстрее --chat-interval — 429 с
+parameters.retry_after; часть чатов заблокировала бота (403), часть не
+существует (400 chat not found). Задержка ответа — --latency.
+Слушатели (listeners) получают (метод, chat_id, время) каждого
+доставленного сообщения или правки — по ним считается задержка ответа.
+
+Запуск отдельно: python bench/fake_bot_api.py [--port 8081]
+Бот направляется на заглушку через TelegramAPIServer.from_base("http://127.0.0.1:8081").
+"""
+import argparse
+import asyncio
+import random
+import time
+from collections import deque
+
+from aiohttp import web
+
+class FakeBotAPI:
+    def __init__(self, limit: int = 30, latency: float = 0.03, blocked: float = 0.05,
+                 missing: float = 0.01, seed: int = 1, chat_interval: float = 1.0):
+        self.limit = limit
+        self.chat_interval = chat_interval  # секунд между сообщениями в один чат, 0 — без лимита
+        self.latency = latency
+        self.blocked = blocked
+        self.missing = missing
+        self.seed = seed
+        self.delivered = {}  # chat_id -> сколько сообщений доставлено
+        self.last_sent = {}  # chat_id -> время последнего сообщения
+        self.window = deque()  # время доставленных сообщений за последнюю секунду
+        self.stats = {"ok": 0, "too_many_requests": 0, "blocked": 0, "not_found": 0, "edits": 0}
+        self._message_id = 0
+        self.listeners = []
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    def chat_kind(self, chat_id: int) -> str:
+        """Судьба чата детерминирована: одинакова от прогона к прогону"""
+        roll = random.Random(chat_id * 7919 + self.seed).random()
+        if roll < self.blocked:
+            return "blocked"
+        if roll < self.blocked + self.missing:
+            return "not_found"
+        return "ok"
+
+    @staticmethod
+    def error(code: int, description: str, **parameters) -> web.Response:
+        body = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            body["parameters"] = parameters
+        return web.json_response(body, status=code)
+
+    def notify(self, method: str, chat_id: int):
+        now = time.monotonic()
+        for listener in self.listeners:
+            listener(method, chat_id, now)
+
+    def message(self, chat_id: int, text: str) -> dict:
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": text,
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method == "editMessageText":
+            self.stats["edits"] += 1
+            self.notify(method, int(data["chat_id"]))
+            return web.json_response({"ok": True, "result": self.message(int(data["chat_id"]), data["text"])})
+        if method != "sendMessage":
+            return web.json_response({"ok": True, "result": True})
+
+        chat_id = int(data["chat_id"])
+        now = time.monotonic()
+        while self.window and self.window[0] <= now - 1:
+            self.window.popleft()
+        if len(self.window) >= self.limit or now - self.last_sent.get(chat_id, -1e9) < self.chat_interval:
+            self.stats["too_many_requests"] += 1
+            return self.error(429, "Too Many Requests: retry after 1", retry_after=1)
+        kind = self.chat_kind(chat_id)
+        if kind == "blocked":
+            self.stats["blocked"] += 1
+            return self.error(403, "Forbidden: bot was blocked by the user")
+        if kind == "not_found":
+            self.stats["not_found"] += 1
+            return self.error(400, "Bad Request: chat not found")
+        self.window.append(now)
+        self.last_sent[chat_id] = now
+        self.delivered[chat_id] = self.delivered.get(chat_id, 0) + 1
+        self.stats["ok"] += 1
+        self.notify(method, chat_id)
+        return web.json_response({"ok": True, "result": self.message(chat_id, data["text"])})
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--limit", type=int, default=30, help="сообщений в секунду до ответа 429")
+    parser.add_argument("--latency", type=float, default=0.03, help="задержка ответа, секунд")
+    parser.add_argument("--blocked", type=float, default=0.05, help="доля чатов, заблокировавших бота")
+    parser.add_argument("--missing", type=float, default=0.01, help="доля несуществующих чатов")
+    parser.add_argument("--chat-interval", type=float, default=1.0, help="секунд между сообщениями в чат, 0 — без лимита")
+    args = parser.parse_args()
+    api = FakeBotAPI(args.limit, args.latency, args.blocked, args.missing, chat_interval=args.chat_interval)
+    web.run_app(api.app(), host="127.0.0.1", port=args.port)
@@ -0,0 +1,203 @@
+"""OpenAI-совместимая заглушка LLM для нагрузочных прогонов без расхода квоты.
+
+POST /v1/chat/completions (и /openai/v1/chat/completions, как у Groq):
+обычный ответ и поток SSE при "stream": true. Задержка до ответа или до
+первого фрагмента берётся из распределения --latency (const, uniform,
+normal, lognormal, exp) со средним --latency-mean и разбросом --jitter;
+поток отдаёт слова со скоростью --tokens-per-second.
+
+Отказы: --error-rate — доля ответов 500, --rate-limit-rate — доля 429 с
+Retry-After, --rpm — честный лимит запросов в минуту на модель,
+--saturated-models — модели, которые всегда отвечают 429 (проверка
+переключения на запасной бэкенд), --models — единственные известные
+модели, прочие получают 404.
+
+Запуск: python bench/mock_llm_server.py [--port 8090] [--latency lognormal --latency-mean 0.8]
+Бот:    LLM_BASE_URL=http://127.0.0.1:8090/v1 GROQ_API_KEY=test python main.py
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+import uuid
+from collections import defaultdict, deque
+
+from aiohttp import web
+
+WORDS = (
+    "звёзды", "число", "путь", "энергия", "день", "гармония", "интуиция", "решение", "сила",
+    "рост", "баланс", "цель", "время", "удача", "ритм", "внимание", "шаг", "опыт", "ясность",
+)
+LATENCY_KINDS = ("const", "uniform", "normal", "lognormal", "exp")
+
+class MockLLM:
+    def __init__(self, latency: str = "lognormal", latency_mean: float = 0.5, jitter: float = 0.5,
+                 tokens_per_second: float = 200.0, completion_tokens: int = 120, error_rate: float = 0.0,
+                 rate_limit_rate: float = 0.0, retry_after: float = 1.0, rpm: int = 0,
+                 models=None, saturated_models=(), seed: int = 1):
+        if latency not in LATENCY_KINDS:
+            raise ValueError(f"latency must be one of {', '.join(LATENCY_KINDS)}")
+        self.latency = latency
+        self.latency_mean = latency_mean
+        self.jitter = jitter
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.rpm = rpm
+        self.models = set(models) if models else None
+        self.saturated_models = set(saturated_models)
+        self.random = random.Random(seed)
+        self.recent = defaultdict(deque)  # модель -> время запросов за последнюю минуту
+        self.stats = {"requests": 0, "streams": 0, "ok": 0, "errors": 0, "rate_limited": 0, "not_found": 0}
+        self.by_model = defaultdict(int)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle)
+        app.router.add_post("/openai/v1/chat/completions", self.handle)
+        app.router.add_get("/stats", self.handle_stats)
+        return app
+
+    def sample_latency(self) -> float:
+        mean = self.latency_mean
+        if mean <= 0 or self.latency == "const":
+            return max(0.0, mean)
+        if self.latency == "uniform":
+            return self.random.uniform(mean * (1 - self.jitter), mean * (1 + self.jitter))
+        if self.latency == "normal":
+            return max(0.0, self.random.gauss(mean, mean * self.jitter))
+        if self.latency == "lognormal":
+            # Среднее логнормального распределения — exp(mu + sigma² / 2)
+            sigma = self.jitter
+            return self.random.lognormvariate(math.log(mean) - sigma * sigma / 2, sigma)
+        return self.random.expovariate(1 / mean)
+
+    @staticmethod
+    def error(status: int, message: str, kind: str, headers=None) -> web.Response:
+        return web.json_response({"error": {"message": message, "type": kind}}, status=status, headers=headers)
+
+    def rejection(self, model: str):
+        """Ответ-отказ или None, если запрос нужно обслужить"""
+        if self.models is not None and model not in self.models:
+            self.stats["not_found"] += 1
+            return self.error(404, f"The model `{model}` does not exist", "invalid_request_error")
+        limited = model in self.saturated_models or self.random.random() < self.rate_limit_rate
+        if not limited and self.rpm:
+            now = time.monotonic()
+            recent = self.recent[model]
+            while recent and recent[0] <= now - 60:
+                recent.popleft()
+            limited = len(recent) >= self.rpm
+            if not limited:
+                recent.append(now)
+        if limited:
+            self.stats["rate_limited"] += 1
+            return self.error(429, f"Rate limit reached for model `{model}`", "rate_limit_exceeded",
+                              {"Retry-After": str(self.retry_after)})
+        if self.random.random() < self.error_rate:
+            self.stats["errors"] += 1
+            return self.error(500, "Internal server error", "server_error")
+        return None
+
+    def completion_words(self, max_tokens: int) -> list:
+        count = max(1, min(self.completion_tokens, max_tokens))
+        return [self.random.choice(WORDS) for _ in range(count)]
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        if not request.headers.get("Authorization", "").startswith("Bearer "):
+            return self.error(401, "Invalid API Key", "invalid_request_error")
+        data = await request.json()
+        model = data.get("model", "")
+        self.stats["requests"] += 1
+        self.by_model[model] += 1
+        rejected = self.rejection(model)
+        if rejected is not None:
+            return rejected
+
+        words = self.completion_words(int(data.get("max_tokens") or self.completion_tokens))
+        prompt_tokens = sum(len(message.get("content", "")) for message in data.get("messages", [])) // 3
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(words),
+            "total_tokens": prompt_tokens + len(words),
+        }
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        await asyncio.sleep(self.sample_latency())
+        self.stats["ok"] += 1
+        if not data.get("stream"):
+            return web.json_response({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": " ".join(words)},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            })
+
+        self.stats["streams"] += 1
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+
+        async def send(delta: dict, finish_reason=None, **extra):
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                **extra,
+            }
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+        await send({"role": "assistant", "content": ""})
+        interval = 1 / self.tokens_per_second if self.tokens_per_second > 0 else 0
+        for index, word in enumerate(words):
+            await send({"content": word if index == 0 else f" {word}"})
+            if interval:
+                await asyncio.sleep(interval)
+        await send({}, "stop", x_groq={"usage": usage})
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({**self.stats, "by_model": dict(self.by_model)})
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", choices=LATENCY_KINDS, default="lognormal", help="распределение задержки")
+    parser.add_argument("--latency-mean", type=float, default=0.5, help="средняя задержка до ответа, секунд")
+    parser.add_argument("--jitter", type=float, default=0.5, help="разброс: доля среднего или sigma для lognormal")
+    parser.add_argument("--tokens-per-second", type=float, default=200, help="скорость выдачи в потоке")
+    parser.add_argument("--completion-tokens", type=int, default=120, help="слов в ответе (не больше max_tokens)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After в ответах 429, секунд")
+    parser.add_argument("--rpm", type=int, default=0, help="лимит запросов в минуту на модель, 0 — без лимита")
+    parser.add_argument("--models", default="", help="известные модели через запятую, пусто — любые")
+    parser.add_argument("--saturated-models", default="", help="модели, всегда отвечающие 429")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser
+
+def from_args(args) -> MockLLM:
+    split = lambda value: [item.strip() for item in value.split(",") if item.strip()]  # noqa: E731
+    return MockLLM(
+        latency=args.latency, latency_mean=args.latency_mean, jitter=args.jitter,
+        tokens_per_second=args.tokens_per_second, completion_tokens=args.completion_tokens,
+        error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate, retry_after=args.retry_after,
+        rpm=args.rpm, models=split(args.models), saturated_models=split(args.saturated_models), seed=args.seed,
+    )
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    web.run_app(from_args(args).app(), host=args.host, port=args.port)
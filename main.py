@@ -1,21 +1,52 @@
 # main.pу
 import os
+import re
+import sys
 import json
+import calendar
+import sqlite3
 import asyncio
 import aiohttp
+import threading
 import logging
 from pathlib import Path
-from datetime import datetime, timedelta
-from typing import Dict, Any, Optional, List
-from collections import defaultdict
+from datetime import datetime, timedelta, date
+from array import array
+from typing import Dict, Any, Optional, List, Mapping, Sequence
+from types import MappingProxyType
+from collections import defaultdict, OrderedDict, deque
 import random
 import time
-from functools import wraps
+import hashlib
+import csv
+import io
+import math
+import heapq
+import bisect
+import itertools
+from functools import wraps, lru_cache, partial
 from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 import contextlib
 
-from fastapi import FastAPI, Request, HTTPException, BackgroundTasks, Depends
-from fastapi.responses import HTMLResponse, JSONResponse
+try:
+    import fcntl
+except ImportError:  # Windows: многопроцессный режим недоступен
+    fcntl = None
+
+try:
+    import orjson  # необязательно: ускоряет разбор входящих обновлений
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+try:
+    import numpy as np  # необязательно: векторные пакетные расчёты
+except ImportError:
+    np = None
+
+from fastapi import FastAPI, Request, HTTPException, Depends
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
@@ -24,8 +55,18 @@ from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 
-from aiogram import Bot, Dispatcher, Router, types
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import CommandStart, Command
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramNotFound,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
 from aiogram.types import (
     ReplyKeyboardMarkup,
     KeyboardButton,
@@ -46,20 +87,90 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")  # свой сервер Bot API (telegram-bot-api или заглушка из bench/)
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 BASE_URL = os.getenv("BASE_URL", "https://your-domain.com")
 ADMIN_IDS = list(map(int, os.getenv("ADMIN_IDS", "260219938").split(",")))
 ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "your-admin-token")
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "your-secret-token")
 MODEL_NAME = os.getenv("MODEL_NAME", "llama-3.1-8b-instant")
+LLM_BASE_URL = os.getenv("LLM_BASE_URL", "https://api.groq.com/openai/v1")  # любой OpenAI-совместимый API
+LLM_FALLBACKS = os.getenv("LLM_FALLBACKS", "")  # запасные модели и бэкенды, см. parse_llm_fallbacks
+LLM_FAILOVER_COOLDOWN = float(os.getenv("LLM_FAILOVER_COOLDOWN", "30"))  # секунд в обход бэкенда после ошибки
 KEEP_ALIVE_INTERVAL = int(os.getenv("KEEP_ALIVE_INTERVAL", "600"))  # секунд, по умолчанию 10 мин
+GROQ_POOL_LIMIT = int(os.getenv("GROQ_POOL_LIMIT", "100"))
+GROQ_POOL_LIMIT_PER_HOST = int(os.getenv("GROQ_POOL_LIMIT_PER_HOST", "20"))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))  # секунд
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "60"))  # секунд
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+LLM_CACHE_DB = os.getenv("LLM_CACHE_DB", "")  # путь к SQLite для кэша на диске, пусто — только память
+LLM_CACHE_DB_MAX_ROWS = int(os.getenv("LLM_CACHE_DB_MAX_ROWS", "100000"))  # 0 — без ограничения
+LLM_CACHE_PRUNE_INTERVAL = int(os.getenv("LLM_CACHE_PRUNE_INTERVAL", "3600"))  # секунд между чистками таблицы
+PRECOMPUTE_ENABLED = os.getenv("PRECOMPUTE_ENABLED", "false").lower() == "true"
+PRECOMPUTE_AT = os.getenv("PRECOMPUTE_AT", "00:05")  # локальное время ежедневного запуска, ЧЧ:ММ
+PRECOMPUTE_CONCURRENCY = int(os.getenv("PRECOMPUTE_CONCURRENCY", "4"))
+PRECOMPUTE_FILE = os.getenv("PRECOMPUTE_FILE", "precomputed.json")
+LLM_STREAMING = os.getenv("LLM_STREAMING", "true").lower() == "true"
+LLM_STREAM_EDIT_INTERVAL = float(os.getenv("LLM_STREAM_EDIT_INTERVAL", "1.0"))  # секунд между правками сообщения
+GROQ_MAX_CONCURRENCY = int(os.getenv("GROQ_MAX_CONCURRENCY", "8"))
+GROQ_RPM = int(os.getenv("GROQ_RPM", "30"))  # запросов в минуту, 0 — без ограничения
+GROQ_TPM = int(os.getenv("GROQ_TPM", "0"))  # токенов в минуту, 0 — без ограничения
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+UPDATE_QUEUE_MAX = int(os.getenv("UPDATE_QUEUE_MAX", "1000"))  # при переполнении вебхук отвечает 503
+UPDATE_DRAIN_TIMEOUT = float(os.getenv("UPDATE_DRAIN_TIMEOUT", "20"))  # секунд на дообработку при остановке
+UPDATE_SPOOL_FILE = os.getenv("UPDATE_SPOOL_FILE", "updates.spool")  # пусто — без журнала обновлений
+UPDATE_SPOOL_COMPACT_BYTES = int(os.getenv("UPDATE_SPOOL_COMPACT_BYTES", str(4 * 1024 * 1024)))
+UPDATE_LOG_SAMPLE = float(os.getenv("UPDATE_LOG_SAMPLE", "0"))  # доля обновлений, попадающих в лог, 0..1
 WEBHOOK_PATH = "/webhook"
 ADMIN_PATH = "/admin"
 PORT = int(os.getenv("PORT", 8000))
 USE_POLLING = os.getenv("USE_POLLING", "false").lower() == "true"
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").lower()  # json | wal | sqlite
+SQLITE_PATH = os.getenv("SQLITE_PATH", "bot.db")
+SQLITE_WRITE_RETRIES = int(os.getenv("SQLITE_WRITE_RETRIES", "3"))  # повторы мутации при занятой базе
+STORAGE_FLUSH_INTERVAL = int(os.getenv("STORAGE_FLUSH_INTERVAL", "60"))  # секунд
+WAL_COMPACT_BYTES = int(os.getenv("WAL_COMPACT_BYTES", str(8 * 1024 * 1024)))
+USER_HISTORY_SIZE = max(1, int(os.getenv("USER_HISTORY_SIZE", "50")))  # последних действий в истории пользователя
+ANALYTICS_CACHE_TTL = float(os.getenv("ANALYTICS_CACHE_TTL", "10"))  # секунд жизни отчёта об активности
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "10"))  # секунд между сбросами метрик в хранилище
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))  # сообщений в секунду; глобальный лимит Telegram — около 30
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))  # одновременных запросов sendMessage
+BROADCAST_FILE = os.getenv("BROADCAST_FILE", "broadcast.json")  # контрольная точка рассылки
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "5"))  # секунд между отчётами админу
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))  # число процессов uvicorn
+MULTI_WORKER = WEB_CONCURRENCY > 1
+RATE_LIMIT_STORAGE_URI = os.getenv("RATE_LIMIT_STORAGE_URI", "memory://")  # общий для процессов: redis://...
+
+if MULTI_WORKER:
+    # Общее состояние процессов живёт в SQLite: JSON-файлы и журнал
+    # перезаписывались бы каждым процессом независимо
+    if STORAGE_BACKEND != "sqlite":
+        raise RuntimeError("WEB_CONCURRENCY > 1 requires STORAGE_BACKEND=sqlite")
+    if USE_POLLING:
+        raise RuntimeError("WEB_CONCURRENCY > 1 is not supported with USE_POLLING=true")
+    if fcntl is None:
+        raise RuntimeError("WEB_CONCURRENCY > 1 requires a POSIX system")
+    if not LLM_CACHE_DB:
+        LLM_CACHE_DB = SQLITE_PATH
+    if RATE_LIMIT_STORAGE_URI.startswith("memory://"):
+        logger.warning("RATE_LIMIT_STORAGE_URI=memory:// — rate limits are counted per worker")
+
+def try_lock_file(path: str):
+    """Неблокирующая эксклюзивная блокировка файла на время жизни процесса.
+
+    Возвращает открытый файл (держать, пока нужна блокировка) или None,
+    если файл заблокирован другим процессом. Освобождается ОС при выходе.
+    """
+    lock_file = open(path, "a+")
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
 
 # Rate limiting
-limiter = Limiter(key_func=get_remote_address)
+limiter = Limiter(key_func=get_remote_address, storage_uri=RATE_LIMIT_STORAGE_URI)
 
 # =====================
 # PYDANTIC MODELS
@@ -113,26 +224,936 @@ class DualDateModel(BaseModel):
         except ValueError as exc:
             raise ValueError("Invalid date format. Use DD.MM.YYYY") from exc
 
+# =====================
+# ACTIVITY ANALYTICS
+# =====================
+
+DAY_RE = re.compile(r"(\d{4})-(\d{2})-(\d{2})", re.ASCII)
+CLOCK_RE = re.compile(r"(\d{2}):(\d{2}):(\d{2})", re.ASCII)
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+DAY_SECONDS = 86400
+
+@lru_cache(maxsize=65536)
+def _day_epoch(day: str) -> Optional[int]:
+    """"YYYY-MM-DD" -> секунды начала дня; дат в базе немного, поэтому кэшируем"""
+    match = DAY_RE.fullmatch(day)
+    if match is None:
+        return None
+    year, month, day_of_month = map(int, match.groups())
+    if not (1 <= month <= 12 and 1 <= day_of_month <= calendar.monthrange(year, month)[1]):
+        return None
+    return (date(year, month, day_of_month).toordinal() - _EPOCH_ORDINAL) * DAY_SECONDS
+
+def parse_timestamp(value: Any) -> Optional[int]:
+    """Строка "%Y-%m-%d %H:%M:%S" -> секунды от 1970-01-01 в том же локальном
+    времени (разности совпадают с datetime). None — не та строка или нет такой даты."""
+    if not isinstance(value, str) or len(value) != 19 or value[10] != " ":
+        return None
+    day_start = _day_epoch(value[:10])
+    clock = CLOCK_RE.fullmatch(value, 11)
+    if day_start is None or clock is None:
+        return None
+    hour, minute, second = map(int, clock.groups())
+    if hour > 23 or minute > 59 or second > 61:
+        return None
+    return day_start + hour * 3600 + minute * 60 + second
+
+def to_epoch(moment: datetime) -> float:
+    """datetime без часового пояса -> секунды в той же шкале, что parse_timestamp"""
+    return (moment - datetime(1970, 1, 1)).total_seconds()
+
+def month_index(timestamp: float) -> int:
+    """Секунды -> номер месяца year * 12 + month - 1; -1 для NaN"""
+    if math.isnan(timestamp):
+        return -1
+    day = date.fromordinal(int(timestamp // DAY_SECONDS) + _EPOCH_ORDINAL)
+    return day.year * 12 + day.month - 1
+
+# Границы «дней без активности» для отчёта о возвратности (как статусы в админке)
+RETENTION_BUCKETS = (("0-7", 7), ("8-30", 30), ("31-90", 90))
+
+USER_STATUSES = ("active", "inactive", "no_data")
+
+class UserQuery:
+    """Фильтр выборки пользователей для выгрузок.
+
+    status: active — заходил не позже days дней назад, inactive — раньше,
+    no_data — дата активности отсутствует или не читается (None — все).
+    since/until — интервал регистрации [since, until).
+    """
+
+    __slots__ = ("status", "since", "until", "threshold")
+
+    def __init__(self, status: Optional[str] = None, since: Optional[datetime] = None,
+                 until: Optional[datetime] = None, days: int = 30, now: Optional[datetime] = None):
+        self.status = status
+        self.since = since
+        self.until = until
+        # Как в count_activity: (now - last_active).days <= days  <=>  last_active > now - (days + 1) суток
+        self.threshold = (now or datetime.now()) - timedelta(days=days + 1)
+
+class ActivityIndex:
+    """Колоночный индекс регистраций и активности пользователей.
+
+    joined и last_active хранятся секундами эпохи в плоских массивах
+    (NumPy, если установлен, иначе array('d')), месяц регистрации — отдельной
+    колонкой year * 12 + month - 1. Отсутствующие и нечитаемые даты — NaN.
+    Подсчёты идут по колонкам без разбора строк; при регистрации и
+    активности пользователя обновляется одна ячейка.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self._slots: Dict[str, int] = {}
+        self.user_ids: List[str] = []  # по номеру ячейки, в порядке регистрации
+        self.size = 0
+        self.missing_last_active = 0
+        if np is not None:
+            self._joined = np.full(capacity, np.nan)
+            self._last_active = np.full(capacity, np.nan)
+            self._joined_month = np.full(capacity, -1, dtype=np.int32)
+        else:
+            self._joined = array("d")
+            self._last_active = array("d")
+            self._joined_month = array("l")
+
+    @classmethod
+    def build(cls, users: Dict[str, Dict]) -> "ActivityIndex":
+        """Индекс по словарю пользователей: колонки разбираются целиком, а не поячеечно"""
+        index = cls(0)
+        index.user_ids = list(users)
+        index._slots = {user_id: slot for slot, user_id in enumerate(index.user_ids)}
+        index.size = len(index.user_ids)
+        index._joined = cls._parse_column([user.get("joined") for user in users.values()])
+        index._last_active = cls._parse_column([user.get("last_active") for user in users.values()])
+        if np is not None:
+            known = ~np.isnan(index._joined)
+            index._joined_month = np.full(index.size, -1, dtype=np.int32)
+            days = (index._joined[known] // DAY_SECONDS).astype("datetime64[D]")
+            index._joined_month[known] = days.astype("datetime64[M]").astype(np.int32) + 1970 * 12
+            index.missing_last_active = int(np.count_nonzero(np.isnan(index._last_active)))
+        else:
+            index._joined_month = array("l", (month_index(value) for value in index._joined))
+            index.missing_last_active = sum(1 for value in index._last_active if math.isnan(value))
+        return index
+
+    @staticmethod
+    def _parse_column(values: List[Any]):
+        """Строки дат -> секунды (NaN вместо пустых и нечитаемых значений).
+        Если все значения в нашем формате, NumPy разбирает колонку за один вызов."""
+        if np is not None:
+            if all(isinstance(value, str) and len(value) == 19 and value[4] == "-" and value[10] == " "
+                   for value in values):
+                try:
+                    return np.array(values, dtype="datetime64[s]").astype(np.int64).astype(np.float64)
+                except ValueError:
+                    pass  # битая дата где-то в колонке — разбираем по одной
+            parsed = (parse_timestamp(value) for value in values)
+            return np.array([math.nan if ts is None else ts for ts in parsed], dtype=np.float64)
+        return array("d", (math.nan if ts is None else ts for ts in map(parse_timestamp, values)))
+
+    def _slot(self, user_id: str) -> int:
+        slot = self._slots.get(user_id)
+        if slot is not None:
+            return slot
+        slot = self._slots[user_id] = self.size
+        self.user_ids.append(user_id)
+        self.size += 1
+        self.missing_last_active += 1
+        if np is not None:
+            if slot == len(self._joined):
+                grow = max(1024, len(self._joined))
+                self._joined = np.concatenate([self._joined, np.full(grow, np.nan)])
+                self._last_active = np.concatenate([self._last_active, np.full(grow, np.nan)])
+                self._joined_month = np.concatenate([self._joined_month, np.full(grow, -1, dtype=np.int32)])
+        else:
+            self._joined.append(math.nan)
+            self._last_active.append(math.nan)
+            self._joined_month.append(-1)
+        return slot
+
+    def upsert(self, user_id: str, joined: Optional[str], last_active: Optional[str]):
+        slot = self._slot(user_id)
+        joined_ts = parse_timestamp(joined)
+        self._joined[slot] = math.nan if joined_ts is None else joined_ts
+        self._joined_month[slot] = -1 if joined_ts is None else month_index(joined_ts)
+        self.touch(user_id, last_active)
+
+    def touch(self, user_id: str, last_active: Optional[str]):
+        slot = self._slot(user_id)
+        was_missing = math.isnan(self._last_active[slot])
+        last_active_ts = parse_timestamp(last_active)
+        self._last_active[slot] = math.nan if last_active_ts is None else last_active_ts
+        self.missing_last_active += (last_active_ts is None) - was_missing
+
+    def _count_above(self, column, threshold: float) -> int:
+        if np is not None:
+            return int(np.count_nonzero(column[:self.size] > threshold))
+        return sum(1 for value in column if value > threshold)
+
+    def count_activity(self, now: datetime, days: int = 30) -> tuple:
+        """(активные, неактивные); без даты активности пользователь считается активным"""
+        # (now - last_active).days <= days  <=>  last_active > now - (days + 1) суток
+        active = self._count_above(self._last_active, to_epoch(now) - (days + 1) * DAY_SECONDS)
+        active += self.missing_last_active
+        return active, self.size - active
+
+    def count_registrations(self, since: datetime, until: datetime) -> int:
+        since_ts, until_ts = to_epoch(since), to_epoch(until)
+        if np is not None:
+            joined = self._joined[:self.size]
+            return int(np.count_nonzero((joined >= since_ts) & (joined < until_ts)))
+        return sum(1 for value in self._joined if since_ts <= value < until_ts)
+
+    def select(self, start: int, limit: int, query: UserQuery) -> tuple:
+        """Номера ячеек, подходящих под query, начиная с start: (ячейки, следующий start | None).
+        Колонки проверяются кусками, поэтому страница не требует прохода по всем."""
+        threshold = to_epoch(query.threshold)
+        since = -math.inf if query.since is None else to_epoch(query.since)
+        until = math.inf if query.until is None else to_epoch(query.until)
+        filter_joined = query.since is not None or query.until is not None
+        found: List[int] = []
+        position = start
+        while position < self.size and len(found) < limit:
+            if np is None:
+                last_active, joined = self._last_active[position], self._joined[position]
+                if query.status == "active":
+                    matched = last_active > threshold
+                elif query.status == "inactive":
+                    matched = last_active <= threshold
+                elif query.status == "no_data":
+                    matched = math.isnan(last_active)
+                else:
+                    matched = True
+                if matched and (not filter_joined or since <= joined < until):
+                    found.append(position)
+                position += 1
+                continue
+            end = min(self.size, position + max(4 * limit, 4096))
+            last_active = self._last_active[position:end]
+            mask = np.ones(end - position, dtype=bool)
+            if query.status == "active":
+                mask &= last_active > threshold
+            elif query.status == "inactive":
+                mask &= last_active <= threshold
+            elif query.status == "no_data":
+                mask &= np.isnan(last_active)
+            if filter_joined:
+                joined = self._joined[position:end]
+                mask &= (joined >= since) & (joined < until)
+            hits = np.flatnonzero(mask)[:limit - len(found)]
+            found.extend((hits + position).tolist())
+            position = end if len(found) < limit else found[-1] + 1
+        return found, (position if position < self.size else None)
+
+    def registrations_by_month(self) -> Dict[str, int]:
+        if np is not None:
+            months = self._joined_month[:self.size]
+            months = months[months >= 0]
+            if not len(months):
+                return {}
+            first = int(months.min())
+            counts = np.bincount(months - first)
+            keys = np.nonzero(counts)[0]
+            return {f"{(first + k) // 12}-{(first + k) % 12 + 1:02d}": int(counts[k]) for k in keys}
+        counts: Dict[int, int] = {}
+        for month in self._joined_month:
+            if month >= 0:
+                counts[month] = counts.get(month, 0) + 1
+        return {f"{month // 12}-{month % 12 + 1:02d}": counts[month] for month in sorted(counts)}
+
+    def retention(self, now: datetime) -> Dict[str, int]:
+        """Пользователи по числу дней без активности"""
+        now_ts = to_epoch(now)
+        buckets: Dict[str, int] = {}
+        previous = 0
+        for name, days in RETENTION_BUCKETS:
+            within = self._count_above(self._last_active, now_ts - (days + 1) * DAY_SECONDS)
+            buckets[name] = within - previous
+            previous = within
+        buckets["91+"] = self.size - self.missing_last_active - previous
+        buckets["no_data"] = self.missing_last_active
+        return buckets
+
+# =====================
+# METRICS
+# =====================
+
+# (разрешение, ширина бакета в секундах, сколько последних бакетов хранится)
+METRIC_RESOLUTIONS = (
+    ("minute", 60, 180),
+    ("hour", 3600, 8 * 24),
+    ("day", DAY_SECONDS, 400),
+)
+METRIC_WIDTHS = {name: width for name, width, _ in METRIC_RESOLUTIONS}
+
+class MetricRings:
+    """Кольцевые буферы счётчиков по минутам, часам и дням.
+
+    Каждое событие сразу прибавляется к бакету каждого разрешения, так что
+    старые минуты остаются в часах, а часы — в днях. Ячейка кольца
+    переиспользуется, когда в неё приходит более новый бакет; память
+    ограничена числом бакетов на число метрик. Состояние — JSON-совместимый
+    dict, который хранится в stats["metrics"].
+    """
+
+    def __init__(self, state: Dict):
+        self.state = state
+        for name, _, size in METRIC_RESOLUTIONS:
+            ring = state.get(name)
+            if not isinstance(ring, dict) or len(ring.get("stamps", ())) != size:
+                state[name] = {"stamps": [-1] * size, "series": {}}
+
+    def add(self, minute: int, name: str, value: float):
+        """Прибавляет value к метрике name в минуте minute (номер минуты от эпохи)"""
+        timestamp = minute * 60
+        for resolution, width, size in METRIC_RESOLUTIONS:
+            ring = self.state[resolution]
+            bucket = timestamp // width
+            slot = bucket % size
+            stamps = ring["stamps"]
+            if stamps[slot] != bucket:
+                if stamps[slot] > bucket:
+                    continue  # бакет старше окна этого разрешения
+                for values in ring["series"].values():
+                    values[slot] = 0
+                stamps[slot] = bucket
+            values = ring["series"].get(name)
+            if values is None:
+                values = ring["series"][name] = [0] * size
+            values[slot] += value
+
+    def totals(self, resolution: str, first: int, last: int) -> Dict[str, float]:
+        """Суммы всех метрик по бакетам [first, last]"""
+        ring = self.state[resolution]
+        slots = [slot for slot, bucket in enumerate(ring["stamps"]) if first <= bucket <= last]
+        return {name: sum(values[slot] for slot in slots) for name, values in ring["series"].items()}
+
+    @staticmethod
+    def copy_state(state: Dict) -> Dict:
+        """Копия колец для записи вне event loop: бакеты и ряды меняются на месте"""
+        return {
+            resolution: {
+                "stamps": list(ring.get("stamps", ())),
+                "series": {name: list(values) for name, values in ring.get("series", {}).items()},
+            } if isinstance(ring, dict) else ring
+            for resolution, ring in state.items()
+        }
+
+    def series(self, name: str, resolution: str, first: int, last: int) -> Dict[int, float]:
+        ring = self.state[resolution]
+        values = ring["series"].get(name)
+        if values is None:
+            return {}
+        return {bucket: values[slot] for slot, bucket in enumerate(ring["stamps"]) if first <= bucket <= last}
+
+class MetricsRecorder:
+    """Счётчики и задержки процесса для админки.
+
+    События копятся в памяти по минутам и раз в METRICS_FLUSH_INTERVAL
+    секунд одной мутацией merge_metrics переносятся в хранилище, поэтому
+    запись метрики не стоит записи на диск. Чтение складывает сохранённое
+    в хранилище (в том числе другими процессами) с ещё не сброшенным.
+    Время — локальное, как у остальных дат бота: день начинается в полночь.
+    """
+
+    def __init__(self):
+        self._pending: Dict[tuple, float] = {}
+
+    @staticmethod
+    def current_bucket(resolution: str, now: Optional[datetime] = None) -> int:
+        return int(to_epoch(now or datetime.now()) // METRIC_WIDTHS[resolution])
+
+    def incr(self, name: str, n: float = 1):
+        key = (self.current_bucket("minute"), name)
+        self._pending[key] = self._pending.get(key, 0) + n
+
+    def observe(self, name: str, seconds: float):
+        """Задержка: число наблюдений и их сумма — среднее в любом окне"""
+        self.incr(f"{name}.count")
+        self.incr(f"{name}.sum", seconds)
+
+    def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        try:
+            storage.merge_metrics([[minute, name, value] for (minute, name), value in pending.items()])
+        except Exception:
+            # Не потеряли: попробуем со следующим сбросом
+            for key, value in pending.items():
+                self._pending[key] = self._pending.get(key, 0) + value
+            raise
+
+    def _pending_in(self, resolution: str, first: int, last: int):
+        ratio = METRIC_WIDTHS[resolution] // 60
+        for (minute, name), value in self._pending.items():
+            bucket = minute // ratio
+            if first <= bucket <= last:
+                yield bucket, name, value
+
+    def totals(self, resolution: str, buckets: int = 1, now: Optional[datetime] = None) -> Dict[str, float]:
+        """Суммы метрик за последние buckets бакетов разрешения, включая текущий"""
+        last = self.current_bucket(resolution, now)
+        result = dict(storage.metric_totals(resolution, last - buckets + 1, last))
+        for _, name, value in self._pending_in(resolution, last - buckets + 1, last):
+            result[name] = result.get(name, 0) + value
+        return result
+
+    def series(self, name: str, resolution: str, buckets: int, now: Optional[datetime] = None) -> List[float]:
+        """Значения метрики по бакетам от старого к текущему, пропуски — нули"""
+        last = self.current_bucket(resolution, now)
+        first = last - buckets + 1
+        stored = storage.metric_series(name, resolution, first, last)
+        values = [stored.get(bucket, 0) for bucket in range(first, last + 1)]
+        for bucket, pending_name, value in self._pending_in(resolution, first, last):
+            if pending_name == name:
+                values[bucket - first] += value
+        return values
+
+metrics = MetricsRecorder()
+
+# Метрики функций бота: feature.<ключ>
+FEATURE_TITLES = {
+    "profile": "Профиль",
+    "numerology": "Нумерология",
+    "compatibility": "Совместимость",
+    "horoscope": "Гороскоп",
+    "natal": "Натальная карта",
+    "daily_card": "Карта дня",
+}
+
+def feature_total(totals: Dict[str, float]) -> int:
+    return int(sum(value for name, value in totals.items() if name.startswith("feature.")))
+
+def mean_latency(totals: Dict[str, float], name: str) -> Optional[float]:
+    count = totals.get(f"{name}.count", 0)
+    return totals.get(f"{name}.sum", 0) / count if count else None
+
+def metrics_digest(now: Optional[datetime] = None) -> Dict[str, Any]:
+    """Сводка для админки: сегодня, последний час, 7 дней и ряды по дням"""
+    now = now or datetime.now()
+    analyses_trend = [0] * 7
+    for feature in FEATURE_TITLES:
+        for index, value in enumerate(metrics.series(f"feature.{feature}", "day", 7, now)):
+            analyses_trend[index] += value
+    return {
+        "today": metrics.totals("day", 1, now),
+        "last_hour": metrics.totals("minute", 60, now),
+        "last_7_days": metrics.totals("day", 7, now),
+        "trend_7_days": {
+            "new_users": metrics.series("new_users", "day", 7, now),
+            "analyses": analyses_trend,
+        },
+    }
+
+def metric_minute(now_str: str) -> int:
+    """Номер минуты для строки времени хранилища (текущая, если строка не читается)"""
+    timestamp = parse_timestamp(now_str)
+    return int((to_epoch(datetime.now()) if timestamp is None else timestamp) // 60)
+
+# =====================
+# PROMETHEUS METRICS
+# =====================
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LLM_LATENCY_BUCKETS = (0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 30.0, 60.0)
+SIZE_BUCKETS = tuple(1024 * 4 ** power for power in range(10))  # 1 КБ … 256 МБ
+
+def _prom_labels(names: Sequence[str], values: Sequence[Any]) -> str:
+    if not names:
+        return ""
+    escaped = (
+        str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for value in values
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+class PromCounter:
+    """Счётчик; значения меток передаются позиционно: inc(1, "natal")"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = ()):
+        self.name, self.help, self.label_names = name, help_text, tuple(label_names)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, n: float = 1, *labels):
+        self._values[labels] = self._values.get(labels, 0) + n
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield self.name, labels, value
+
+class PromHistogram:
+    """Гистограмма с фиксированными границами.
+
+    На горячем пути — поиск корзины bisect и два сложения; накопительные
+    значения le считаются только при выдаче /metrics.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name, self.help, self.label_names = name, help_text, tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series: Dict[tuple, list] = {}  # метки -> [по корзинам..., +Inf, сумма]
+
+    def observe(self, value: float, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def samples(self):
+        bounds = [*map(repr, self.buckets), "+Inf"]
+        for labels, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(bounds, series):
+                cumulative += count
+                yield f"{self.name}_bucket", (*labels, bound), cumulative
+            yield f"{self.name}_sum", labels, series[-1]
+            yield f"{self.name}_count", labels, cumulative
+
+class PromCollector:
+    """Метрика, которая считается при выдаче: func() -> число или {метки: число}.
+    Так экспортируются уже существующие stats/summary без затрат на горячем пути."""
+
+    def __init__(self, name: str, kind: str, help_text: str, label_names: Sequence[str], func):
+        self.name, self.kind, self.help, self.label_names = name, kind, help_text, tuple(label_names)
+        self.func = func
+
+    def samples(self):
+        values = self.func()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in values.items():
+            yield self.name, labels, value
+
+class PromRegistry:
+    """Реестр метрик процесса в текстовом формате Prometheus.
+
+    Каждый процесс uvicorn считает своё; при WEB_CONCURRENCY > 1 у всех рядов
+    есть метка worker, чтобы ответы разных процессов не смешивались.
+    """
+
+    def __init__(self):
+        self._metrics: List[Any] = []
+        self.const_labels: Dict[str, str] = {}
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, label_names: Sequence[str] = ()) -> PromCounter:
+        return self.register(PromCounter(name, help_text, label_names))
+
+    def histogram(self, name: str, help_text: str, label_names: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> PromHistogram:
+        return self.register(PromHistogram(name, help_text, label_names, buckets))
+
+    def collector(self, name: str, kind: str, help_text: str, func, label_names: Sequence[str] = ()):
+        return self.register(PromCollector(name, kind, help_text, label_names, func))
+
+    def render(self) -> str:
+        const_names, const_values = tuple(self.const_labels), tuple(self.const_labels.values())
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            names = const_names + metric.label_names
+            try:
+                for sample_name, labels, value in metric.samples():
+                    label_names = names + ("le",) if len(labels) > len(metric.label_names) else names
+                    lines.append(f"{sample_name}{_prom_labels(label_names, const_values + tuple(labels))} {value}")
+            except Exception as e:
+                logger.warning("PROMETHEUS: метрика %s не собрана: %s", metric.name, e)
+        return "\n".join(lines) + "\n"
+
+prom = PromRegistry()
+
+WEBHOOK_ACK_SECONDS = prom.histogram(
+    "bot_webhook_ack_seconds", "Время ответа Telegram на вебхук", ("outcome",)
+)
+UPDATE_HANDLE_SECONDS = prom.histogram(
+    "bot_update_handle_seconds", "Валидация и dp.feed_update одного обновления", ("update_type",)
+)
+HANDLER_SECONDS = prom.histogram(
+    "bot_handler_seconds", "Длительность обработчика aiogram", ("handler",)
+)
+HANDLER_ERRORS = prom.counter(
+    "bot_handler_errors_total", "Исключения в обработчиках aiogram", ("handler",)
+)
+GROQ_REQUEST_SECONDS = prom.histogram(
+    "bot_groq_request_seconds", "Запрос к LLM без ожидания в очереди", ("system_prompt_key", "mode", "provider"),
+    LLM_LATENCY_BUCKETS,
+)
+LLM_ANSWER_SECONDS = prom.histogram(
+    "bot_llm_answer_seconds", "Ответ ask_groq целиком: из кэша или с очередью, повторами и переключениями",
+    ("system_prompt_key", "provider", "source"), LLM_LATENCY_BUCKETS,
+)
+LLM_FAILOVERS = prom.counter(
+    "bot_llm_failovers_total", "Запросы, переданные следующему бэкенду после отказа", ("provider",)
+)
+GROQ_TOKENS = prom.counter(
+    "bot_groq_tokens_total", "Токены по данным usage из ответа Groq", ("system_prompt_key", "kind")
+)
+GROQ_ERRORS = prom.counter(
+    "bot_groq_errors_total", "Запросы к Groq, не давшие ответа после повторов", ("system_prompt_key",)
+)
+STORAGE_FLUSH_SECONDS = prom.histogram(
+    "bot_storage_flush_seconds", "Сброс хранилища на диск (save_all)"
+)
+STORAGE_FLUSH_BYTES = prom.histogram(
+    "bot_storage_flush_bytes", "Байт записано за один сброс хранилища", buckets=SIZE_BUCKETS
+)
+STORAGE_MUTATION_ERRORS = prom.counter(
+    "bot_storage_mutation_errors_total", "Мутации SQLite, не записанные после всех повторов", ("op",)
+)
+BROADCAST_MESSAGES = prom.counter(
+    "bot_broadcast_messages_total", "Получатели рассылки по исходу отправки", ("result",)
+)
+
+# =====================
+# ACTION HISTORY
+# =====================
+
+EPOCH = datetime(1970, 1, 1)
+
+def iso_to_epoch(value: Any) -> int:
+    """datetime.isoformat() без часового пояса -> целые секунды в шкале to_epoch
+    (0 — не разобрать или раньше 1970: в истории время беззнаковое)"""
+    try:
+        return max(0, int(to_epoch(datetime.fromisoformat(value))))
+    except (TypeError, ValueError):
+        return 0
+
+def epoch_to_iso(seconds: int) -> str:
+    return (EPOCH + timedelta(seconds=seconds)).isoformat()
+
+def encode_action_data(data: Any) -> Optional[str]:
+    """Данные действия -> компактная JSON-строка; одинаковые строки интернированы и хранятся один раз"""
+    if data is None:
+        return None
+    return sys.intern(json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+
+class ActionCodes:
+    """Интернированные имена действий: в истории хранится номер, а не строка.
+
+    Таблица только растёт, номера не меняются; список names сохраняется
+    рядом с историей (personalization["action_codes"]).
+    """
+
+    def __init__(self, names: Optional[List[str]] = None):
+        self.names: List[str] = [sys.intern(name) for name in names or ()]
+        self.codes: Dict[str, int] = {name: code for code, name in enumerate(self.names)}
+
+    def code(self, name: str) -> int:
+        code = self.codes.get(name)
+        if code is None:
+            code = self.codes[name] = len(self.names)
+            self.names.append(sys.intern(name))
+        return code
+
+class ActionHistory:
+    """История действий пользователя — кольцо из USER_HISTORY_SIZE последних записей.
+
+    Запись — номер действия (array 'H') и секунды от эпохи (array 'I');
+    данные есть не у всех действий, поэтому список notes с интернированными
+    JSON-строками по ячейкам заводится только при первых данных. Пока
+    кольцо не заполнено, массивы растут,
+    затем новая запись занимает ячейку самой старой (head): добавление
+    O(1) без копирования списков. На диск пишется encode() — номера,
+    время первой записи и разности, данные по порядковым номерам записей.
+    """
+
+    __slots__ = ("codes", "times", "head", "notes", "birth_date", "preferences", "last_interaction")
+
+    def __init__(self, last_interaction: Optional[str] = None):
+        self.codes = array("H")
+        self.times = array("I")
+        self.head = 0  # ячейка самой старой записи, когда кольцо заполнено
+        self.notes: Optional[List[Optional[str]]] = None
+        self.birth_date: Optional[str] = None
+        self.preferences: Optional[dict] = None
+        self.last_interaction = last_interaction
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def append(self, code: int, moment: int, note: Optional[str] = None):
+        size = len(self.codes)
+        if size < USER_HISTORY_SIZE:
+            slot = size
+            self.codes.append(code)
+            self.times.append(moment)
+        else:
+            slot = self.head
+            self.codes[slot] = code
+            self.times[slot] = moment
+            self.head = (slot + 1) % size
+        notes = self.notes
+        if notes is None:
+            if note is None:
+                return
+            notes = self.notes = []
+        if slot < len(notes):
+            notes[slot] = note
+        else:
+            notes.extend([None] * (slot - len(notes)))
+            notes.append(note)
+
+    def _order(self) -> List[int]:
+        """Ячейки от самой старой записи к самой новой"""
+        size = len(self.codes)
+        return [(self.head + index) % size for index in range(size)]
+
+    def recent(self, limit: int, names: List[str]) -> List[str]:
+        """Имена limit последних действий, от старого к новому"""
+        codes = self.codes
+        size = len(codes)
+        start = self.head + size - min(max(limit, 0), size)
+        return [names[codes[index % size]] for index in range(start, self.head + size)]
+
+    def encode(self) -> Dict[str, Any]:
+        """JSON-совместимая компактная запись для файла и снимка"""
+        order = self._order()
+        times = [self.times[slot] for slot in order]
+        record: Dict[str, Any] = {
+            "codes": [self.codes[slot] for slot in order],
+            "times": times[:1] + [later - earlier for earlier, later in zip(times, times[1:])],
+        }
+        notes = self.notes
+        if notes:
+            record["data"] = {
+                str(index): notes[slot] for index, slot in enumerate(order) if slot < len(notes) and notes[slot] is not None
+            }
+        if self.birth_date:
+            record["birth_date"] = self.birth_date
+        if self.preferences:
+            record["preferences"] = self.preferences
+        if self.last_interaction:
+            record["last_interaction"] = self.last_interaction
+        return record
+
+    @classmethod
+    def decode(cls, record: Dict[str, Any], action_codes: ActionCodes) -> "ActionHistory":
+        """Из encode() или из прежнего формата со списком словарей actions"""
+        history = cls(record.get("last_interaction"))
+        history.birth_date = record.get("birth_date")
+        history.preferences = record.get("preferences") or None
+        if "codes" in record:
+            notes = record.get("data") or {}
+            moment = 0
+            for index, (code, delta) in enumerate(zip(record["codes"], record["times"])):
+                moment += delta
+                note = notes.get(str(index))
+                history.append(code, moment, sys.intern(note) if note is not None else None)
+        else:
+            for action in record.get("actions", []):
+                history.append(action_codes.code(action.get("action", "")), iso_to_epoch(action.get("timestamp")),
+                               encode_action_data(action.get("data")))
+        return history
+
+    def to_dict(self, names: List[str]) -> Dict[str, Any]:
+        """Развёрнутый вид (actions — список словарей) для API админки и выгрузок"""
+        notes = self.notes or ()
+        result = {
+            "actions": [
+                {
+                    "action": names[self.codes[slot]],
+                    "timestamp": epoch_to_iso(self.times[slot]),
+                    "data": json_loads(notes[slot]) if slot < len(notes) and notes[slot] is not None else None,
+                }
+                for slot in self._order()
+            ],
+            "preferences": self.preferences or {},
+            "last_interaction": self.last_interaction,
+        }
+        if self.birth_date:
+            result["birth_date"] = self.birth_date
+        return result
+
 # =====================
 # STORAGE CLASS
 # =====================
 
-class Storage:
+def atomic_write(filename: str, data: bytes):
+    """Запись через временный файл + fsync + os.replace: файл всегда целый"""
+    tmp_path = Path(filename + ".tmp")
+    with tmp_path.open("wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, filename)
+
+class BaseStorage:
+    """Общий интерфейс хранилищ состояния бота.
+
+    Обработчики меняют состояние только через методы мутаций: каждая мутация
+    описывается именем операции и JSON-сериализуемыми аргументами, поэтому её
+    можно записать в журнал и воспроизвести при старте. Чтение идёт через
+    методы запросов, чтобы бэкенд мог не держать все данные в памяти.
+    """
+
+    USERS_FILE = "users.json"
+
     def __init__(self):
         self.lock = asyncio.Lock()
+        self._last_save = time.time()
+        # Кодирование и запись на диск идут в отдельном потоке, а не в event loop
+        self._io_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage-io")
+        self.flush_stats = {
+            "flushes": 0,
+            "bytes_written": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "total_flush_ms": 0.0,
+        }
+
+    async def _run_io(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._io_executor, func, *args)
+
+    def _record_flush(self, started: float, nbytes: int):
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        STORAGE_FLUSH_SECONDS.observe(elapsed_ms / 1000)
+        STORAGE_FLUSH_BYTES.observe(nbytes)
+        self.flush_stats["flushes"] += 1
+        self.flush_stats["bytes_written"] += nbytes
+        self.flush_stats["last_flush_ms"] = round(elapsed_ms, 3)
+        self.flush_stats["max_flush_ms"] = round(max(self.flush_stats["max_flush_ms"], elapsed_ms), 3)
+        self.flush_stats["total_flush_ms"] = round(self.flush_stats["total_flush_ms"] + elapsed_ms, 3)
+
+    # --- аналитика ---
+
+    def activity_report(self, now: datetime) -> Dict[str, Any]:
+        """Сводка активности для админки; пересчитывается не чаще раза в ANALYTICS_CACHE_TTL секунд"""
+        cached = getattr(self, "_activity_report", None)
+        if cached is not None and time.monotonic() - cached[0] < ANALYTICS_CACHE_TTL:
+            return cached[1]
+        active, inactive = self.count_activity(now)
+        year_start = datetime(now.year, 1, 1)
+        month_start = datetime(now.year, now.month, 1)
+        report = {
+            "generated_at": now.strftime("%Y-%m-%d %H:%M:%S"),
+            "total_users": self.count_users(),
+            "active_users": active,
+            "inactive_users": inactive,
+            "registered_this_year": self.count_registrations(year_start, datetime(now.year + 1, 1, 1)),
+            "registered_this_month": self.count_registrations(
+                month_start, (month_start + timedelta(days=32)).replace(day=1)
+            ),
+            "registrations_by_month": self.registrations_by_month(),
+            "retention_days_inactive": self.retention(now),
+        }
+        report["registrations_by_year"] = {}
+        for month, count in report["registrations_by_month"].items():
+            year = month[:4]
+            report["registrations_by_year"][year] = report["registrations_by_year"].get(year, 0) + count
+        self._activity_report = (time.monotonic(), report)
+        return report
+
+    # --- постраничная выгрузка ---
+
+    def users_page(self, cursor: int, limit: int, query: UserQuery) -> tuple:
+        """([(user_id, данные)], следующий курсор | None) в порядке регистрации.
+        Курсор непрозрачен: 0 — начало, дальше — значение из предыдущей страницы."""
+        raise NotImplementedError
+
+    def user_histories(self, user_ids: List[str]) -> Dict[str, Dict]:
+        """История и предпочтения для списка пользователей (у кого они есть)"""
+        raise NotImplementedError
+
+    # --- мутации ---
+
+    def register_user(self, user_id: str, profile: Dict, now_str: str):
+        self._mutate("register_user", user_id, profile, now_str)
+
+    def touch_user(self, user_id: str, now_str: str, count_request: bool = False):
+        self._mutate("touch_user", user_id, now_str, count_request)
+
+    def incr(self, key: str, n: int = 1, bucket: Optional[str] = None):
+        self._mutate("incr", key, n, bucket)
+
+    def set_stat(self, key: str, value: Any):
+        self._mutate("set_stat", key, value)
+
+    def merge_metrics(self, deltas: List[list]):
+        """deltas — [минута, метрика, значение] из MetricsRecorder"""
+        self._mutate("merge_metrics", deltas)
+
+    def mark_unreachable(self, user_id: str, reason: str):
+        """Пользователь заблокировал бота или удалил аккаунт: рассылки его пропускают
+        до следующего обращения к боту"""
+        self._mutate("mark_unreachable", user_id, reason)
+
+    def append_action(self, user_id: str, action: str, data: Optional[dict], timestamp: str,
+                      birth_date: Optional[str] = None):
+        self._mutate("append_action", user_id, action, data, timestamp, birth_date)
+
+    def _mutate(self, op: str, *args):
+        getattr(self, f"_op_{op}")(*args)
+        self._journal(op, args)
+
+    def _journal(self, op: str, args: tuple):
+        """По умолчанию журнала нет: изменения попадут на диск при save_all"""
+
+    async def save_all(self, force: bool = False):
+        pass
+
+def _copy_container(value: Any) -> Any:
+    return dict(value) if isinstance(value, dict) else list(value) if isinstance(value, list) else value
+
+class Storage(BaseStorage):
+    """JSON-хранилище в памяти (STORAGE_BACKEND=json).
+
+    Изменения отмечаются как «грязные» по файлам и по ключам пользователей.
+    Все вызовы save_all в пределах STORAGE_FLUSH_INTERVAL объединяются в один
+    сброс, нетронутые файлы не перезаписываются, а в users.json и
+    personalization.json заново кодируются только изменённые пользователи.
+    История действий в памяти — кольца ActionHistory с номерами из ActionCodes.
+    """
+
+    def __init__(self):
+        super().__init__()
         self.users: Dict[str, Dict] = {}
         self.stats: Dict = {}
         self.personalization: Dict = {}
+        self._action_codes = ActionCodes()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._dirty_sections: set = set()
+        self._dirty_keys: Dict[str, set] = {"users": set(), "personalization": set()}
+        # Закодированные фрагменты JSON по пользователям; принадлежат потоку записи
+        self._fragments: Dict[str, Dict[str, str]] = {"users": {}, "personalization": {}}
+        self.flush_stats.update(avoided_writes=0, coalesced_saves=0)
+        # Колоночный индекс активности строится при первом запросе аналитики
+        self._activity: Optional[ActivityIndex] = None
+        self._metrics: Optional[MetricRings] = None
         self._load_all()
-        self._last_save = time.time()
+        # Фрагментов после загрузки ещё нет: при первой записи файла кодируются все
+        for uid in self.users:
+            self._mark_dirty("users", uid)
+        for uid in self.personalization.get("user_history", {}):
+            self._mark_dirty("personalization", uid)
+        self._dirty_sections.clear()
 
     def _load_all(self):
         self.users = self._load_json("users.json", {})
         self.stats = self._load_json("stats.json", self._default_stats())
-        self.personalization = self._load_json(
+        self._adopt_personalization(self._load_json(
             "personalization.json",
             {"user_preferences": {}, "user_history": {}},
-        )
+        ))
+
+    def _adopt_personalization(self, personalization: Dict):
+        """Разворачивает сохранённую историю в кольца ActionHistory"""
+        self._action_codes = ActionCodes(personalization.get("action_codes"))
+        personalization["action_codes"] = self._action_codes.names
+        personalization["user_history"] = {
+            uid: ActionHistory.decode(record, self._action_codes)
+            for uid, record in personalization.get("user_history", {}).items()
+        }
+        self.personalization = personalization
 
     def _load_json(self, filename: str, default: Any) -> Any:
         path = Path(filename)
@@ -159,22 +1180,893 @@ class Storage:
             "user_last_activity": {},
         }
 
+    # --- чтение ---
+
+    def has_user(self, user_id: str) -> bool:
+        return user_id in self.users
+
+    def count_users(self) -> int:
+        return len(self.users)
+
+    def recent_users(self, limit: int) -> List[tuple]:
+        """Последние зарегистрированные пользователи в порядке регистрации"""
+        return list(self.users.items())[-limit:]
+
+    def _activity_index(self) -> ActivityIndex:
+        if self._activity is None:
+            self._activity = ActivityIndex.build(self.users)
+        return self._activity
+
+    def count_activity(self, now: datetime, days: int = 30) -> tuple:
+        """(активные, неактивные): неактивен, кто не заходил больше days дней"""
+        return self._activity_index().count_activity(now, days)
+
+    def count_registrations(self, since: datetime, until: datetime) -> int:
+        """Число регистраций в интервале [since, until)"""
+        return self._activity_index().count_registrations(since, until)
+
+    def registrations_by_month(self) -> Dict[str, int]:
+        return self._activity_index().registrations_by_month()
+
+    def retention(self, now: datetime) -> Dict[str, int]:
+        return self._activity_index().retention(now)
+
+    def _metric_rings(self) -> MetricRings:
+        # Кольца живут внутри stats: попадают в stats.json и в снимок WAL
+        if self._metrics is None or self._metrics.state is not self.stats.get("metrics"):
+            self._metrics = MetricRings(self.stats.setdefault("metrics", {}))
+        return self._metrics
+
+    def metric_totals(self, resolution: str, first: int, last: int) -> Dict[str, float]:
+        return self._metric_rings().totals(resolution, first, last)
+
+    def metric_series(self, name: str, resolution: str, first: int, last: int) -> Dict[int, float]:
+        return self._metric_rings().series(name, resolution, first, last)
+
+    def counters(self) -> Dict:
+        """Счётчики статистики: верхний уровень и вложенные daily_stats/popular_features"""
+        return self.stats
+
+    def recent_actions(self, user_id: str, limit: int) -> List[str]:
+        history = self.personalization["user_history"].get(user_id)
+        if history is None:
+            return []
+        return history.recent(limit, self._action_codes.names)
+
+    def get_birth_date(self, user_id: str) -> Optional[str]:
+        history = self.personalization["user_history"].get(user_id)
+        return history.birth_date if history is not None else None
+
+    def get_preferences(self, user_id: str) -> dict:
+        history = self.personalization["user_history"].get(user_id)
+        return (history.preferences if history is not None else None) or {}
+
+    def users_page(self, cursor: int, limit: int, query: UserQuery) -> tuple:
+        # Курсор — номер ячейки индекса активности: порядок ячеек совпадает с порядком регистрации
+        index = self._activity_index()
+        slots, next_cursor = index.select(max(0, cursor), limit, query)
+        return [(index.user_ids[slot], self.users[index.user_ids[slot]]) for slot in slots], next_cursor
+
+    def user_histories(self, user_ids: List[str]) -> Dict[str, Dict]:
+        history = self.personalization["user_history"]
+        names = self._action_codes.names
+        return {uid: history[uid].to_dict(names) for uid in user_ids if uid in history}
+
+    # Кольца метрик и даты по каждому пользователю — внутреннее состояние: ряды отдаёт
+    # /api/admin/metrics, пользователей — постраничная выгрузка
+    EXPORT_SKIP = frozenset(("metrics", "user_registration_dates", "user_last_activity"))
+
+    def export_stats(self) -> Dict:
+        return {**{k: v for k, v in self.stats.items() if k not in self.EXPORT_SKIP}, "total_users": len(self.users)}
+
+    # --- мутации ---
+
+    def _op_register_user(self, user_id: str, profile: Dict, now_str: str):
+        self.users[user_id] = {
+            **profile,
+            "joined": now_str,
+            "last_active": now_str,
+            "total_requests": 0
+        }
+        self.stats["total_users"] = len(self.users)
+        self._op_merge_metrics([[metric_minute(now_str), "new_users", 1]])
+        self.stats.setdefault("user_registration_dates", {})[user_id] = now_str
+        self.stats.setdefault("user_last_activity", {})[user_id] = now_str
+        if self._activity is not None:
+            self._activity.upsert(user_id, now_str, now_str)
+        self._mark_dirty("users", user_id)
+        self._mark_dirty("stats")
+
+    def _op_touch_user(self, user_id: str, now_str: str, count_request: bool):
+        user = self.users.get(user_id)
+        if user is not None:
+            user["last_active"] = now_str
+            if count_request:
+                user["total_requests"] = user.get("total_requests", 0) + 1
+            user.pop("unreachable", None)
+            if self._activity is not None:
+                self._activity.touch(user_id, now_str)
+            self._mark_dirty("users", user_id)
+        self.stats.setdefault("user_last_activity", {})[user_id] = now_str
+        self._mark_dirty("stats")
+
+    def _op_mark_unreachable(self, user_id: str, reason: str):
+        user = self.users.get(user_id)
+        if user is not None:
+            user["unreachable"] = reason
+            self._mark_dirty("users", user_id)
+
+    def _op_incr(self, key: str, n: int, bucket: Optional[str]):
+        target = self.stats if bucket is None else self.stats.setdefault(bucket, {})
+        target[key] = target.get(key, 0) + n
+        self._mark_dirty("stats")
+
+    def _op_set_stat(self, key: str, value: Any):
+        if self.stats.get(key) != value:
+            self.stats[key] = value
+            self._mark_dirty("stats")
+
+    def _op_merge_metrics(self, deltas: List[list]):
+        rings = self._metric_rings()
+        for minute, name, value in deltas:
+            rings.add(minute, name, value)
+        self._mark_dirty("stats")
+
+    def _op_append_action(self, user_id: str, action: str, data: Optional[dict], timestamp: str,
+                          birth_date: Optional[str]):
+        history = self.personalization["user_history"].get(user_id)
+        if history is None:
+            history = self.personalization["user_history"][user_id] = ActionHistory(timestamp)
+        if birth_date:
+            history.birth_date = birth_date
+        history.append(self._action_codes.code(action), iso_to_epoch(timestamp), encode_action_data(data))
+        self._mark_dirty("personalization", user_id)
+
+    def _mark_dirty(self, section: str, key: Optional[str] = None):
+        self._dirty_sections.add(section)
+        if key is not None:
+            self._dirty_keys[section].add(key)
+
+    def _stats_snapshot(self) -> Dict[str, Any]:
+        # Кольца метрик вложены на два уровня ниже — копируются отдельно
+        stats = {k: _copy_container(v) for k, v in self.stats.items()}
+        if isinstance(stats.get("metrics"), dict):
+            stats["metrics"] = MetricRings.copy_state(self.stats["metrics"])
+        return stats
+
+    def _dirty_snapshot(self, sections: set) -> Dict[str, Any]:
+        """Копия только изменённых частей состояния (порядок ключей + изменённые записи)"""
+        snapshot: Dict[str, Any] = {}
+        if "users" in sections:
+            changed, self._dirty_keys["users"] = self._dirty_keys["users"], set()
+            snapshot["users"] = {
+                "order": list(self.users),
+                "changed": {uid: dict(self.users[uid]) for uid in changed if uid in self.users},
+            }
+        if "stats" in sections:
+            snapshot["stats"] = self._stats_snapshot()
+        if "personalization" in sections:
+            history = self.personalization.get("user_history", {})
+            changed, self._dirty_keys["personalization"] = self._dirty_keys["personalization"], set()
+            snapshot["personalization"] = {
+                "top": [
+                    (k, None if k == "user_history" else _copy_container(v))
+                    for k, v in self.personalization.items()
+                ],
+                "order": list(history),
+                "changed": {uid: history[uid].encode() for uid in changed if uid in history},
+            }
+        return snapshot
+
     async def save_all(self, force: bool = False):
+        """Сбрасывает изменения на диск не чаще раза в STORAGE_FLUSH_INTERVAL.
+
+        Обычный вызов только запускает сброс в фоне и сразу возвращает
+        управление; force=True дожидается записи (используется при завершении).
+        """
         current_time = time.time()
-        if force or current_time - self._last_save > 60:
-            async with self.lock:
-                self._save_json("users.json", self.users)
-                self._save_json("stats.json", self.stats)
-                self._save_json("personalization.json", self.personalization)
+        if force:
+            await self._flush()
+        elif current_time - self._last_save > STORAGE_FLUSH_INTERVAL and (
+            self._flush_task is None or self._flush_task.done()
+        ):
             self._last_save = current_time
+            self._flush_task = asyncio.create_task(self._flush())
+        else:
+            self.flush_stats["coalesced_saves"] += 1
+
+    async def _flush(self):
+        async with self.lock:
+            sections, self._dirty_sections = self._dirty_sections, set()
+            self.flush_stats["avoided_writes"] += 3 - len(sections)
+            if not sections:
+                return
+            started = time.perf_counter()
+            snapshot = self._dirty_snapshot(sections)
+            try:
+                written = await self._run_io(self._write_files, snapshot)
+            except Exception as e:
+                logger.error("Storage: ошибка сохранения: %s", e)
+                self._restore_dirty(sections, snapshot)
+                return
+            self._last_save = time.time()
+        self._record_flush(started, written)
+
+    def _restore_dirty(self, sections: set, snapshot: Dict[str, Any]):
+        """Возвращает отметки несохранённого снимка, чтобы повторить запись при следующем сбросе"""
+        self._dirty_sections |= sections
+        for section in ("users", "personalization"):
+            if section in snapshot:
+                self._dirty_keys[section] |= set(snapshot[section]["changed"])
+
+    def _write_files(self, snapshot: Dict[str, Any]) -> int:
+        written = 0
+        for filename, section, encode in (
+            ("users.json", "users", self._encode_users),
+            ("stats.json", "stats", self._encode_stats),
+            ("personalization.json", "personalization", self._encode_personalization),
+        ):
+            if section not in snapshot:
+                continue
+            data = encode(snapshot[section]).encode("utf-8")
+            atomic_write(filename, data)
+            written += len(data)
+        return written
+
+    def _encode_users(self, part: Dict[str, Any]) -> str:
+        fragments = self._fragments["users"]
+        for uid, user in part["changed"].items():
+            fragments[uid] = self._encode_value(user, 1)
+        return self._encode_object([(uid, fragments[uid]) for uid in part["order"]], 0)
+
+    def _encode_stats(self, stats: Dict[str, Any]) -> str:
+        # Кольца метрик — сотни чисел на метрику: по одному на строку файл раздувается в разы
+        return self._encode_object([
+            (k, json.dumps(v, separators=(",", ":")) if k == "metrics" else self._encode_value(v, 1))
+            for k, v in stats.items()
+        ], 0)
+
+    def _encode_personalization(self, part: Dict[str, Any]) -> str:
+        fragments = self._fragments["personalization"]
+        for uid, record in part["changed"].items():
+            # Одна строка на пользователя: номера и разности времени в столбик раздули бы файл
+            fragments[uid] = json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+        history_json = self._encode_object([(uid, fragments[uid]) for uid in part["order"]], 1)
+        return self._encode_object(
+            [(k, history_json if k == "user_history" else self._encode_value(v, 1)) for k, v in part["top"]],
+            0,
+        )
+
+    @staticmethod
+    def _encode_value(value: Any, level: int) -> str:
+        """json.dumps(indent=2) для значения, вложенного на level уровней"""
+        return json.dumps(value, ensure_ascii=False, indent=2).replace("\n", "\n" + "  " * level)
+
+    @staticmethod
+    def _encode_object(items: List[tuple], level: int) -> str:
+        """Собирает объект из готовых фрагментов в том же формате, что json.dumps(indent=2)"""
+        if not items:
+            return "{}"
+        pad = "  " * (level + 1)
+        body = ",\n".join(f"{pad}{json.dumps(k, ensure_ascii=False)}: {v}" for k, v in items)
+        return "{\n" + body + "\n" + "  " * level + "}"
+
+class JournaledStorage(Storage):
+    """Журналируемое хранилище (STORAGE_BACKEND=wal).
+
+    Каждая мутация дописывается компактной строкой в WAL, поэтому стоимость
+    сохранения пропорциональна изменениям, а не объёму данных. Полный снимок
+    пишется в фоне, когда журнал вырастает больше WAL_COMPACT_BYTES: как и в
+    JSON-режиме, в event loop копируются только изменённые с прошлого снимка
+    записи, а файл собирается в потоке записи из закодированных фрагментов.
+    При старте загружается последний снимок и воспроизводится хвост журнала.
+    """
+
+    USERS_FILE = "storage.snapshot.json"
+    SNAPSHOT_FILE = "storage.snapshot.json"
+    WAL_FILE = "storage.wal"
+
+    def __init__(self):
+        self._seq = 0
+        self._pending: List[bytes] = []
+        self._wal_bytes = 0
+        self._compact_lock = asyncio.Lock()
+        self._compact_task: Optional[asyncio.Task] = None
+        self._wal_path = Path(self.WAL_FILE)
+        self._compacting_path = Path(self.WAL_FILE + ".compacting")
+        # Закодированные части снимка (users, stats, personalization); принадлежат потоку записи
+        self._sections: Dict[str, str] = {}
+        super().__init__()
+
+        replayed = sum(self._replay(path) for path in (self._compacting_path, self._wal_path))
+        if replayed:
+            logger.info("WAL: воспроизведено %s записей, seq=%s", replayed, self._seq)
+        # Снимок пишется при каждом старте: хвост журнала мог оборваться на середине
+        # записи, и новые записи не должны дописываться после обрывка. Заодно
+        # кодируются фрагменты всех записей — уплотнения перекодируют только изменённые
+        self._dirty_sections.clear()
+        self._write_snapshot(self._dirty_snapshot({"users", "stats", "personalization"}), self._seq)
+        self._compacting_path.unlink(missing_ok=True)
+        self._wal_path.unlink(missing_ok=True)
+        self._wal = self._wal_path.open("ab")
+
+    def _load_all(self):
+        snapshot = self._load_json(self.SNAPSHOT_FILE, None)
+        if snapshot is None:
+            # Первый запуск в режиме WAL — переносим данные из обычных JSON-файлов
+            super()._load_all()
+            return
+        self.users = snapshot["users"]
+        self.stats = snapshot["stats"]
+        self._adopt_personalization(snapshot["personalization"])
+        self._seq = snapshot.get("seq", 0)
+
+    def _replay(self, path: Path) -> int:
+        if not path.exists():
+            return 0
+        count = 0
+        with path.open("rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning("WAL: оборванная запись в %s, хвост отброшен", path)
+                    break
+                if record["s"] <= self._seq:
+                    continue
+                getattr(self, f"_op_{record['op']}")(*record["a"])
+                self._seq = record["s"]
+                count += 1
+        return count
+
+    def _journal(self, op: str, args: tuple):
+        self._seq += 1
+        self._pending.append(json.dumps(
+            {"s": self._seq, "op": op, "a": args},
+            ensure_ascii=False,
+            separators=(",", ":"),
+        ).encode("utf-8"))
+
+    def _append_wal(self, lines: List[bytes]) -> int:
+        data = b"\n".join(lines) + b"\n"
+        self._wal.write(data)
+        self._wal.flush()
+        os.fsync(self._wal.fileno())
+        return len(data)
+
+    async def _flush_pending(self):
+        if self._pending:
+            started = time.perf_counter()
+            lines, self._pending = self._pending, []
+            written = await self._run_io(self._append_wal, lines)
+            self._wal_bytes += written
+            self._record_flush(started, written)
+
+    async def save_all(self, force: bool = False):
+        async with self.lock:
+            await self._flush_pending()
+        self._last_save = time.time()
+
+        if force:
+            await self.compact()
+        elif self._wal_bytes > WAL_COMPACT_BYTES and (self._compact_task is None or self._compact_task.done()):
+            self._compact_task = asyncio.create_task(self.compact())
 
-    def _save_json(self, filename: str, data: Any):
-        Path(filename).write_text(
-            json.dumps(data, ensure_ascii=False, indent=2),
-            encoding="utf-8",
+    async def compact(self):
+        """Пишет полный снимок и отбрасывает вошедшую в него часть журнала"""
+        async with self._compact_lock:
+            async with self.lock:
+                await self._flush_pending()
+                sections, self._dirty_sections = self._dirty_sections, set()
+                parts = self._dirty_snapshot(sections)
+                seq = self._seq
+                self._rotate_wal()
+            started = time.perf_counter()
+            try:
+                written = await self._run_io(self._write_snapshot, parts, seq)
+            except Exception as e:
+                logger.error("WAL: ошибка уплотнения: %s", e)
+                self._restore_dirty(sections, parts)
+                return
+            self._record_flush(started, written)
+            self._compacting_path.unlink(missing_ok=True)
+            logger.info("WAL: снимок записан, seq=%s", seq)
+
+    def _rotate_wal(self):
+        self._wal.close()
+        if self._compacting_path.exists():
+            # Предыдущее уплотнение не завершилось — дописываем журнал, а не затираем
+            with self._compacting_path.open("ab") as dst:
+                dst.write(self._wal_path.read_bytes())
+            self._wal_path.unlink()
+        else:
+            os.replace(self._wal_path, self._compacting_path)
+        self._wal = self._wal_path.open("ab")
+        self._wal_bytes = 0
+
+    def _write_snapshot(self, parts: Dict[str, Any], seq: int) -> int:
+        """Собирает снимок из частей _dirty_snapshot; нетронутые части берутся из прошлого снимка"""
+        for section, encode in (
+            ("users", self._encode_users),
+            ("stats", self._encode_stats),
+            ("personalization", self._encode_personalization),
+        ):
+            if section in parts:
+                self._sections[section] = encode(parts[section])
+        data = self._encode_object([("seq", str(seq)), *self._sections.items()], 0).encode("utf-8")
+        atomic_write(self.SNAPSHOT_FILE, data)
+        return len(data)
+
+    # Снимок читает только программа: фрагменты кодируются без отступов
+
+    @staticmethod
+    def _encode_value(value: Any, level: int) -> str:
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+    @staticmethod
+    def _encode_object(items: List[tuple], level: int) -> str:
+        return "{" + ",".join(f"{json.dumps(k, ensure_ascii=False)}:{v}" for k, v in items) + "}"
+
+class SQLiteStorage(BaseStorage):
+    """Хранилище на SQLite в режиме WAL (STORAGE_BACKEND=sqlite).
+
+    Пользователи, счётчики и история действий лежат в индексированных
+    таблицах и не загружаются в память целиком, поэтому время старта и
+    потребление памяти не растут с числом пользователей. Статистика по
+    активности и регистрациям считается запросами по индексам.
+    При первом запуске данные переносятся из JSON-файлов.
+
+    Мутации выполняются по порядку в потоке storage-io через отдельное
+    соединение: ожидание блокировки записи, занятой другим воркером, не
+    останавливает event loop. Чтение остаётся в event loop — в режиме WAL
+    читатели не ждут писателей. Действия, ещё стоящие в очереди, чтение
+    истории и даты рождения берёт из _queued_actions; остальные записи
+    становятся видны после выполнения, поэтому мутации идемпотентны
+    (повторная регистрация игнорируется). При занятой базе мутация
+    повторяется до SQLITE_WRITE_RETRIES раз, неудачи считаются в flush_stats.
+    """
+
+    USERS_FILE = SQLITE_PATH
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        user_id TEXT PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        joined TEXT,
+        last_active TEXT,
+        total_requests INTEGER NOT NULL DEFAULT 0,
+        unreachable TEXT  -- причина, по которой рассылка до пользователя не доходит
+    );
+    CREATE INDEX IF NOT EXISTS idx_users_last_active ON users(last_active);
+    CREATE INDEX IF NOT EXISTS idx_users_joined ON users(joined);
+
+    CREATE TABLE IF NOT EXISTS counters (
+        bucket TEXT NOT NULL,
+        key TEXT NOT NULL,
+        value INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (bucket, key)
+    );
+
+    CREATE TABLE IF NOT EXISTS profiles (
+        user_id TEXT PRIMARY KEY,
+        birth_date TEXT,
+        preferences TEXT NOT NULL DEFAULT '{}',
+        last_interaction TEXT
+    );
+
+    CREATE TABLE IF NOT EXISTS actions (
+        id INTEGER PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        ts TEXT NOT NULL,
+        action TEXT NOT NULL,
+        data TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_actions_user_ts ON actions(user_id, ts);
+
+    CREATE TABLE IF NOT EXISTS metrics (
+        resolution TEXT NOT NULL,
+        bucket INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        value NUMERIC NOT NULL DEFAULT 0,  -- целые счётчики остаются целыми
+        PRIMARY KEY (resolution, bucket, name)
+    ) WITHOUT ROWID;
+    """
+
+    USER_COLUMNS = ("username", "first_name", "last_name", "joined", "last_active", "total_requests", "unreachable")
+
+    def __init__(self, path: str = SQLITE_PATH):
+        super().__init__()
+        self.flush_stats.update(mutation_retries=0, mutation_errors=0)
+        # user_id -> [(action, birth_date)] действий, отправленных в поток записи, но ещё не
+        # зафиксированных. Фиксация и удаление отсюда идут под _queued_lock, как и чтение,
+        # поэтому действие видно ровно один раз: либо в очереди, либо в базе
+        self._queued_actions: Dict[str, List[tuple]] = {}
+        self._queued_lock = threading.Lock()
+        # timeout — ожидание блокировки записи, занятой другим процессом
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=10)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        columns = {row["name"] for row in self.conn.execute("PRAGMA table_info(users)")}
+        if "unreachable" not in columns:  # база создана до появления рассылок
+            self.conn.execute("ALTER TABLE users ADD COLUMN unreachable TEXT")
+        if self.conn.execute("SELECT COUNT(*) FROM counters").fetchone()[0] == 0:
+            self._import_json()
+        self._writer = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=10)
+        self._writer.execute("PRAGMA synchronous=NORMAL")
+
+    def _import_json(self):
+        """Однократный перенос данных из users.json/stats.json/personalization.json.
+
+        При WEB_CONCURRENCY > 1 воркеры стартуют одновременно: проверка и
+        вставка идут в одной транзакции BEGIN IMMEDIATE, и опоздавшие,
+        дождавшись блокировки, видят уже заполненную таблицу counters.
+        """
+        legacy = Storage()  # файлы читаются до блокировки, чтобы не держать её дольше нужного
+        # Перенос большой базы может занять дольше обычного timeout — на старте ждём дольше
+        self.conn.execute("PRAGMA busy_timeout = 600000")
+        try:
+            with self.conn:
+                self.conn.execute("BEGIN IMMEDIATE")
+                if self.conn.execute("SELECT COUNT(*) FROM counters").fetchone()[0]:
+                    return  # перенёс другой воркер
+                self._insert_legacy(legacy)
+                # total_users — признак завершённого переноса, даже если JSON-файлов не было
+                self.conn.execute("INSERT OR IGNORE INTO counters VALUES ('', 'total_users', 0)")
+        finally:
+            self.conn.execute("PRAGMA busy_timeout = 10000")
+        if legacy.users:
+            logger.info("SQLite: перенесено %s пользователей из JSON", len(legacy.users))
+
+    def _insert_legacy(self, legacy: Storage):
+        """Содержимое JSON-хранилища в таблицы; вызывается внутри транзакции переноса"""
+        self.conn.executemany(
+            f"INSERT OR REPLACE INTO users (user_id, {', '.join(self.USER_COLUMNS)}) "
+            f"VALUES (?{', ?' * len(self.USER_COLUMNS)})",
+            (
+                (uid, *(u.get(col, 0 if col == "total_requests" else None) for col in self.USER_COLUMNS))
+                for uid, u in legacy.users.items()
+            ),
         )
+        for key, value in legacy.stats.items():
+            if isinstance(value, int):
+                self.conn.execute("INSERT OR REPLACE INTO counters VALUES ('', ?, ?)", (key, value))
+        for bucket in ("daily_stats", "popular_features"):
+            for key, value in legacy.stats.get(bucket, {}).items():
+                self.conn.execute("INSERT OR REPLACE INTO counters VALUES (?, ?, ?)", (bucket, key, value))
+        for uid, history in legacy.user_histories(list(legacy.personalization.get("user_history", {}))).items():
+            self.conn.execute(
+                "INSERT OR REPLACE INTO profiles VALUES (?, ?, ?, ?)",
+                (uid, history.get("birth_date"), json.dumps(history.get("preferences", {})),
+                 history.get("last_interaction")),
+            )
+            self.conn.executemany(
+                "INSERT INTO actions (user_id, ts, action, data) VALUES (?, ?, ?, ?)",
+                (
+                    (uid, a.get("timestamp", ""), a.get("action", ""), json.dumps(a.get("data"), ensure_ascii=False))
+                    for a in history.get("actions", [])
+                ),
+            )
 
-storage = Storage()
+    # --- чтение ---
+
+    def _user_dict(self, row: sqlite3.Row) -> Dict:
+        user = {col: row[col] for col in self.USER_COLUMNS}
+        if user["unreachable"] is None:  # как в JSON: ключ есть только у недоступных
+            del user["unreachable"]
+        return user
+
+    def has_user(self, user_id: str) -> bool:
+        return self.conn.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone() is not None
+
+    def count_users(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def recent_users(self, limit: int) -> List[tuple]:
+        rows = self.conn.execute("SELECT * FROM users ORDER BY rowid DESC LIMIT ?", (limit,)).fetchall()
+        return [(row["user_id"], self._user_dict(row)) for row in reversed(rows)]
+
+    def count_activity(self, now: datetime, days: int = 30) -> tuple:
+        # (now - last_active).days <= days  <=>  last_active > now - (days + 1)
+        threshold = (now - timedelta(days=days + 1)).strftime("%Y-%m-%d %H:%M:%S")
+        inactive = self.conn.execute(
+            "SELECT COUNT(*) FROM users WHERE last_active <= ?", (threshold,)
+        ).fetchone()[0]
+        return self.count_users() - inactive, inactive
+
+    def count_registrations(self, since: datetime, until: datetime) -> int:
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM users WHERE joined >= ? AND joined < ?",
+            (since.strftime("%Y-%m-%d %H:%M:%S"), until.strftime("%Y-%m-%d %H:%M:%S")),
+        ).fetchone()[0]
+
+    def registrations_by_month(self) -> Dict[str, int]:
+        rows = self.conn.execute(
+            "SELECT substr(joined, 1, 7) AS month, COUNT(*) FROM users "
+            "WHERE joined GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-*' GROUP BY month ORDER BY month"
+        )
+        return {month: count for month, count in rows}
+
+    def retention(self, now: datetime) -> Dict[str, int]:
+        """Пользователи по числу дней без активности — один проход по индексу last_active"""
+        columns = ", ".join(
+            "SUM(last_active > ?)" for _ in RETENTION_BUCKETS
+        )
+        thresholds = [(now - timedelta(days=days + 1)).strftime("%Y-%m-%d %H:%M:%S") for _, days in RETENTION_BUCKETS]
+        row = self.conn.execute(
+            f"SELECT COUNT(*), COUNT(last_active), {columns} FROM users", thresholds
+        ).fetchone()
+        total, known, within = row[0], row[1], [value or 0 for value in row[2:]]
+        buckets: Dict[str, int] = {}
+        previous = 0
+        for (name, _), count in zip(RETENTION_BUCKETS, within):
+            buckets[name] = count - previous
+            previous = count
+        buckets["91+"] = known - previous
+        buckets["no_data"] = total - known
+        return buckets
+
+    def counters(self) -> Dict:
+        stats: Dict[str, Any] = {"daily_stats": {}, "popular_features": {}}
+        for row in self.conn.execute("SELECT bucket, key, value FROM counters"):
+            if row["bucket"]:
+                stats.setdefault(row["bucket"], {})[row["key"]] = row["value"]
+            else:
+                stats[row["key"]] = row["value"]
+        stats["total_users"] = self.count_users()
+        return stats
+
+    def recent_actions(self, user_id: str, limit: int) -> List[str]:
+        with self._queued_lock:
+            queued = [action for action, _ in self._queued_actions.get(user_id, ())]
+            rows = self.conn.execute(
+                "SELECT action FROM actions WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+                (user_id, max(0, limit - len(queued))),
+            ).fetchall()
+        return ([row["action"] for row in reversed(rows)] + queued)[-limit:]
+
+    def get_birth_date(self, user_id: str) -> Optional[str]:
+        with self._queued_lock:
+            for _, birth_date in reversed(self._queued_actions.get(user_id, ())):
+                if birth_date:
+                    return birth_date
+            row = self.conn.execute("SELECT birth_date FROM profiles WHERE user_id = ?", (user_id,)).fetchone()
+        return row["birth_date"] if row else None
+
+    def get_preferences(self, user_id: str) -> dict:
+        row = self.conn.execute("SELECT preferences FROM profiles WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row["preferences"]) if row else {}
+
+    def users_page(self, cursor: int, limit: int, query: UserQuery) -> tuple:
+        # Курсор — rowid последней выданной строки: страница идёт по первичному ключу
+        conditions, params = ["rowid > ?"], [cursor]
+        threshold = query.threshold.strftime("%Y-%m-%d %H:%M:%S")
+        if query.status == "active":
+            conditions.append("last_active > ?")
+            params.append(threshold)
+        elif query.status == "inactive":
+            conditions.append("last_active <= ?")
+            params.append(threshold)
+        elif query.status == "no_data":
+            conditions.append("last_active IS NULL")
+        if query.since is not None:
+            conditions.append("joined >= ?")
+            params.append(query.since.strftime("%Y-%m-%d %H:%M:%S"))
+        if query.until is not None:
+            conditions.append("joined < ?")
+            params.append(query.until.strftime("%Y-%m-%d %H:%M:%S"))
+        rows = self.conn.execute(
+            f"SELECT rowid, * FROM users WHERE {' AND '.join(conditions)} ORDER BY rowid LIMIT ?",
+            (*params, limit),
+        ).fetchall()
+        next_cursor = rows[-1]["rowid"] if len(rows) == limit else None
+        return [(row["user_id"], self._user_dict(row)) for row in rows], next_cursor
+
+    def user_histories(self, user_ids: List[str]) -> Dict[str, Dict]:
+        history: Dict[str, Dict] = {}
+        for offset in range(0, len(user_ids), 500):  # не упираемся в лимит параметров SQLite
+            chunk = user_ids[offset:offset + 500]
+            marks = ",".join("?" * len(chunk))
+            for row in self.conn.execute(f"SELECT * FROM profiles WHERE user_id IN ({marks})", chunk):
+                history[row["user_id"]] = {
+                    "actions": [],
+                    "preferences": json.loads(row["preferences"]),
+                    "last_interaction": row["last_interaction"],
+                }
+                if row["birth_date"]:
+                    history[row["user_id"]]["birth_date"] = row["birth_date"]
+            for row in self.conn.execute(
+                f"SELECT user_id, ts, action, data FROM actions WHERE user_id IN ({marks}) ORDER BY user_id, id", chunk
+            ):
+                if row["user_id"] in history:
+                    history[row["user_id"]]["actions"].append({
+                        "action": row["action"],
+                        "timestamp": row["ts"],
+                        "data": json.loads(row["data"]) if row["data"] else None,
+                    })
+        return history
+
+    def export_stats(self) -> Dict:
+        return self.counters()
+
+    # --- мутации ---
+
+    def _op_register_user(self, user_id: str, profile: Dict, now_str: str):
+        # Два процесса могут одновременно принять /start одного пользователя:
+        # регистрирует и считает его только первый
+        cursor = self._writer.execute(
+            "INSERT OR IGNORE INTO users (user_id, username, first_name, last_name, joined, last_active) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, profile.get("username"), profile.get("first_name"), profile.get("last_name"), now_str, now_str),
+        )
+        if cursor.rowcount == 1:
+            self._op_merge_metrics([[metric_minute(now_str), "new_users", 1]])
+
+    def _op_touch_user(self, user_id: str, now_str: str, count_request: bool):
+        self._writer.execute(
+            "UPDATE users SET last_active = ?, total_requests = total_requests + ?, unreachable = NULL "
+            "WHERE user_id = ?",
+            (now_str, 1 if count_request else 0, user_id),
+        )
+
+    def _op_mark_unreachable(self, user_id: str, reason: str):
+        self._writer.execute("UPDATE users SET unreachable = ? WHERE user_id = ?", (reason, user_id))
+
+    def _op_incr(self, key: str, n: int, bucket: Optional[str]):
+        self._writer.execute(
+            "INSERT INTO counters (bucket, key, value) VALUES (?, ?, ?) "
+            "ON CONFLICT(bucket, key) DO UPDATE SET value = value + excluded.value",
+            (bucket or "", key, n),
+        )
+
+    def _op_set_stat(self, key: str, value: Any):
+        self._writer.execute("INSERT OR REPLACE INTO counters VALUES ('', ?, ?)", (key, value))
+
+    def _op_merge_metrics(self, deltas: List[list]):
+        with self._writer:
+            self._writer.execute("BEGIN IMMEDIATE")
+            for resolution, width, size in METRIC_RESOLUTIONS:
+                ratio = width // 60
+                rows: Dict[tuple, float] = {}
+                for minute, name, value in deltas:
+                    key = (minute // ratio, name)
+                    rows[key] = rows.get(key, 0) + value
+                self._writer.executemany(
+                    "INSERT INTO metrics (resolution, bucket, name, value) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(resolution, bucket, name) DO UPDATE SET value = value + excluded.value",
+                    ((resolution, bucket, name, value) for (bucket, name), value in rows.items()),
+                )
+                # Как в кольцевом буфере: хранятся только последние size бакетов
+                self._writer.execute(
+                    "DELETE FROM metrics WHERE resolution = ?1 AND bucket <= "
+                    "(SELECT MAX(bucket) FROM metrics WHERE resolution = ?1) - ?2",
+                    (resolution, size),
+                )
+
+    def metric_totals(self, resolution: str, first: int, last: int) -> Dict[str, float]:
+        rows = self.conn.execute(
+            "SELECT name, SUM(value) FROM metrics WHERE resolution = ? AND bucket BETWEEN ? AND ? GROUP BY name",
+            (resolution, first, last),
+        )
+        return {name: value for name, value in rows}
+
+    def metric_series(self, name: str, resolution: str, first: int, last: int) -> Dict[int, float]:
+        rows = self.conn.execute(
+            "SELECT bucket, value FROM metrics WHERE resolution = ? AND name = ? AND bucket BETWEEN ? AND ?",
+            (resolution, name, first, last),
+        )
+        return {bucket: value for bucket, value in rows}
+
+    def _op_append_action(self, user_id: str, action: str, data: Optional[dict], timestamp: str,
+                          birth_date: Optional[str]):
+        try:
+            # IMMEDIATE: блокировка записи сразу, без SQLITE_BUSY при повышении из чтения
+            self._writer.execute("BEGIN IMMEDIATE")
+            self._writer.execute(
+                "INSERT INTO profiles (user_id, birth_date, last_interaction) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET birth_date = COALESCE(excluded.birth_date, birth_date)",
+                (user_id, birth_date or None, timestamp),
+            )
+            self._writer.execute(
+                "INSERT INTO actions (user_id, ts, action, data) VALUES (?, ?, ?, ?)",
+                (user_id, timestamp, action, json.dumps(data, ensure_ascii=False) if data is not None else None),
+            )
+            # Храним только последние USER_HISTORY_SIZE действий пользователя
+            self._writer.execute(
+                "DELETE FROM actions WHERE user_id = ? AND id NOT IN "
+                "(SELECT id FROM actions WHERE user_id = ? ORDER BY id DESC LIMIT ?)",
+                (user_id, user_id, USER_HISTORY_SIZE),
+            )
+            with self._queued_lock:
+                self._writer.execute("COMMIT")
+                self._dequeue_action(user_id)
+        except BaseException:
+            if self._writer.in_transaction:
+                self._writer.execute("ROLLBACK")
+            raise
+
+    def _dequeue_action(self, user_id: str):
+        # Поток записи один, действия пользователя фиксируются в порядке постановки
+        queued = self._queued_actions.get(user_id)
+        if queued:
+            queued.pop(0)
+            if not queued:
+                del self._queued_actions[user_id]
+
+    def _mutate(self, op: str, *args):
+        if op == "append_action":
+            with self._queued_lock:
+                self._queued_actions.setdefault(args[0], []).append((args[1], args[4]))
+        future = self._io_executor.submit(self._apply, op, args)
+        future.add_done_callback(partial(self._mutation_done, op, args))
+
+    def _apply(self, op: str, args: tuple):
+        """Выполняет мутацию в потоке storage-io, повторяя её, пока база занята другим процессом"""
+        for attempt in range(SQLITE_WRITE_RETRIES + 1):
+            try:
+                return getattr(self, f"_op_{op}")(*args)
+            except sqlite3.OperationalError as e:
+                if attempt == SQLITE_WRITE_RETRIES:
+                    raise
+                logger.warning("SQLite: повтор %s (%s): %s", op, attempt + 1, e)
+                self.flush_stats["mutation_retries"] += 1
+                time.sleep(0.5 * (attempt + 1))
+
+    def _mutation_done(self, op: str, args: tuple, future):
+        if future.exception() is None:
+            return
+        logger.error("SQLite: ошибка %s: %s", op, future.exception())
+        self.flush_stats["mutation_errors"] += 1
+        STORAGE_MUTATION_ERRORS.inc(1, op)
+        if op == "append_action":
+            with self._queued_lock:
+                self._dequeue_action(args[0])
+
+    def _checkpoint(self):
+        self._writer.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    async def save_all(self, force: bool = False):
+        # Каждая мутация фиксируется в базе сама. При завершении дожидаемся очереди
+        # (поток один, задачи выполняются по порядку) и сбрасываем WAL SQLite в основной файл
+        if force:
+            async with self.lock:
+                await self._run_io(self._checkpoint)
+
+STORAGE_BACKENDS = {
+    "json": Storage,
+    "wal": JournaledStorage,
+    "sqlite": SQLiteStorage,
+}
+
+def create_storage() -> BaseStorage:
+    backend = STORAGE_BACKENDS.get(STORAGE_BACKEND)
+    if backend is None:
+        logger.error("Unknown STORAGE_BACKEND=%s, using json", STORAGE_BACKEND)
+        backend = Storage
+    return backend()
+
+storage = create_storage()
+
+# =====================
+# HTTP CLIENTS
+# =====================
+
+def create_http_session(limit: int, limit_per_host: int, timeout: float, trace_configs=None) -> aiohttp.ClientSession:
+    """Сессия aiohttp с пулом keep-alive соединений и кэшем DNS"""
+    connector = aiohttp.TCPConnector(
+        limit=limit,
+        limit_per_host=limit_per_host,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=timeout),
+        trace_configs=trace_configs,
+    )
 
 # =====================
 # FASTAPI APP WITH LIFESPAN
@@ -187,14 +2079,25 @@ async def keep_alive():
         return
     url = f"{BASE_URL}/ping"
     logger.info("KEEP-ALIVE: запущен, интервал %s сек, url=%s", KEEP_ALIVE_INTERVAL, url)
-    while True:
-        await asyncio.sleep(KEEP_ALIVE_INTERVAL)
-        try:
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=15)) as session:
+    async with create_http_session(limit=1, limit_per_host=1, timeout=15) as session:
+        while True:
+            await asyncio.sleep(KEEP_ALIVE_INTERVAL)
+            try:
                 async with session.get(url) as resp:
                     logger.debug("KEEP-ALIVE: ping %s → %s", url, resp.status)
+            except Exception as e:
+                logger.warning("KEEP-ALIVE: ошибка ping: %s", e)
+
+async def metrics_flush_loop():
+    """Переносит накопленные в памяти метрики в хранилище"""
+    while True:
+        await asyncio.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            metrics.flush()
+            await storage.save_all()
+            llm_cache.prune()
         except Exception as e:
-            logger.warning("KEEP-ALIVE: ошибка ping: %s", e)
+            logger.warning("METRICS: ошибка сброса: %s", e)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -202,8 +2105,34 @@ async def lifespan(app: FastAPI):
     # Запуск
     logger.info("Starting Astro-Numerology Bot...")
 
+    # Общий пул соединений к Groq на всё время работы приложения
+    await groq_client.start()
+
+    # Воркеры обработки обновлений из вебхука; недообработанные до рестарта — снова в очередь
+    update_queue.start()
+    pending_updates = update_spool.open()
+    for update in pending_updates:
+        update_queue.put(update, force=True)
+    if pending_updates:
+        logger.info("Replaying %s unfinished updates from spool", len(pending_updates))
+
+    # Фоновые задачи уровня приложения выполняет один процесс из нескольких
+    app.state.leader_lock = try_lock_file(f"{SQLITE_PATH}.leader.lock") if MULTI_WORKER else None
+    is_leader = not MULTI_WORKER or app.state.leader_lock is not None
+
+    # Метрики сбрасывает каждый процесс: в SQLite они складываются
+    app.state.metrics_task = asyncio.create_task(metrics_flush_loop())
+
     # Keep-alive для Render Free
-    app.state.keep_alive_task = asyncio.create_task(keep_alive())
+    if is_leader:
+        app.state.keep_alive_task = asyncio.create_task(keep_alive())
+
+    # Незаконченная рассылка продолжается процессом, захватившим её блокировку
+    broadcaster.resume()
+
+    # Ежедневная предгенерация гороскопов и карт дня
+    if PRECOMPUTE_ENABLED and is_leader:
+        app.state.precompute_task = asyncio.create_task(precompute_loop())
 
     # Отложенная установка вебхука / polling (в фоне, чтобы не блокировать открытие порта)
     async def _delayed_setup():
@@ -226,6 +2155,7 @@ async def lifespan(app: FastAPI):
                     url=webhook_url,
                     drop_pending_updates=False,
                     max_connections=40,
+                    allowed_updates=sorted(routed_update_types()),
                 )
                 if WEBHOOK_SECRET and WEBHOOK_SECRET != "your-secret-token":
                     wh_kwargs["secret_token"] = WEBHOOK_SECRET
@@ -236,14 +2166,20 @@ async def lifespan(app: FastAPI):
             except Exception as e:
                 logger.error(f"Ошибка установки вебхука: {e}")
 
-    app.state.setup_task = asyncio.create_task(_delayed_setup())
+    if is_leader:
+        app.state.setup_task = asyncio.create_task(_delayed_setup())
 
     yield
 
     # Завершение
     logger.info("Shutting down Astro-Numerology Bot...")
+    # Дообрабатываем принятые обновления, пока бот и Groq ещё доступны
+    await update_queue.drain(UPDATE_DRAIN_TIMEOUT)
+    await update_spool.close()
+    # Рассылка сохраняет контрольную точку, пока сессия бота открыта
+    await broadcaster.shutdown()
     try:
-        for task_name in ("setup_task", "keep_alive_task", "polling_task"):
+        for task_name in ("setup_task", "keep_alive_task", "polling_task", "precompute_task", "metrics_task"):
             task = getattr(app.state, task_name, None)
             if task:
                 task.cancel()
@@ -254,8 +2190,13 @@ async def lifespan(app: FastAPI):
         if USE_POLLING:
             await bot.delete_webhook()
         await bot.session.close()
+        await groq_client.close()
     except Exception as e:
         logger.error(f"Ошибка при завершении: {e}")
+    try:
+        metrics.flush()
+    except Exception as e:
+        logger.error(f"Ошибка сброса метрик: {e}")
     await storage.save_all(force=True)
 
 app = FastAPI(
@@ -285,11 +2226,35 @@ security = HTTPBearer()
 # AIOGRAM BOT INIT
 # =====================
 
-bot = Bot(token=BOT_TOKEN)
+bot = Bot(
+    token=BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None,
+)
 dp = Dispatcher()
 router = Router()
 dp.include_router(router)
 
+class HandlerTimingMiddleware(BaseMiddleware):
+    """Время и ошибки обработчиков для /metrics.
+
+    Для текстовых сообщений обработчик выбирает text_router, поэтому метка —
+    реальный маршрут из данных фильтра (route), а не сам text_router.
+    """
+
+    async def __call__(self, handler, event, data):
+        name = (data.get("route") or data["handler"].callback).__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(1, name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+
+router.message.middleware(HandlerTimingMiddleware())
+router.callback_query.middleware(HandlerTimingMiddleware())
+
 # =====================
 # CONSTANTS
 # =====================
@@ -345,47 +2310,24 @@ GROQ_SYSTEM_PROMPTS = {
 class PersonalizationEngine:
     @staticmethod
     async def update_user_profile(user_id: int, action: str, data: dict = None, birth_date: str = None):
-        user_id_str = str(user_id)
-
-        if user_id_str not in storage.personalization["user_history"]:
-            storage.personalization["user_history"][user_id_str] = {
-                "actions": [],
-                "preferences": {},
-                "last_interaction": datetime.now().isoformat()
-            }
-
-        if birth_date:
-            storage.personalization["user_history"][user_id_str]["birth_date"] = birth_date
-
-        storage.personalization["user_history"][user_id_str]["actions"].append({
-            "action": action,
-            "timestamp": datetime.now().isoformat(),
-            "data": data
-        })
-
-        if len(storage.personalization["user_history"][user_id_str]["actions"]) > 50:
-            storage.personalization["user_history"][user_id_str]["actions"] = storage.personalization["user_history"][user_id_str]["actions"][-50:]
+        storage.append_action(str(user_id), action, data, datetime.now().isoformat(), birth_date)
         await storage.save_all()
 
     @staticmethod
     def get_user_birth_date(user_id: int) -> Optional[str]:
-        user_id_str = str(user_id)
-        return storage.personalization["user_history"].get(user_id_str, {}).get("birth_date")
+        return storage.get_birth_date(str(user_id))
 
     @staticmethod
     def get_user_preferences(user_id: int) -> dict:
-        user_id_str = str(user_id)
-        return storage.personalization["user_history"].get(user_id_str, {}).get("preferences", {})
+        return storage.get_preferences(str(user_id))
 
     @staticmethod
     def personalize_response(user_id: int, base_response: str, feature_type: str) -> str:
-        user_history = storage.personalization["user_history"].get(str(user_id), {})
-        actions = user_history.get("actions", [])
+        recent_actions = storage.recent_actions(str(user_id), 5)
 
-        if len(actions) < 3:
+        if len(recent_actions) < 3:
             return base_response
 
-        recent_actions = [a["action"] for a in actions[-5:]]
         action_counts = {}
         for action in recent_actions:
             action_counts[action] = action_counts.get(action, 0) + 1
@@ -406,6 +2348,11 @@ class PersonalizationEngine:
 class NumerologyFeatures:
     @staticmethod
     def calculate_life_path_number(date_str: str) -> Optional[int]:
+        # Дата ДД.ММ.ГГГГ — по таблицам сумм цифр, без разбора строки по символам
+        match = DATE_RE.fullmatch(date_str) if isinstance(date_str, str) else None
+        if match is not None:
+            day, month, year = match.groups()
+            return LIFE_PATH_BY_SUM[DIGIT_SUMS[int(day)] + DIGIT_SUMS[int(month)] + DIGIT_SUMS[int(year)]]
         try:
             digits = date_str.replace('.', '')
             total = sum(int(d) for d in digits)
@@ -459,20 +2406,539 @@ ZODIAC_SIGNS = [
     ((2, 19), (3, 20), "Рыбы", "♓", "вода", "Рыбах"),
 ]
 
-def get_zodiac_sign(date_str: str) -> Optional[dict]:
-    """Определяет знак зодиака по дате рождения DD.MM.YYYY"""
+def _build_zodiac_tables() -> tuple:
+    """Записи знаков и таблица [месяц][день] -> номер записи (-1 — нет такого дня)"""
+    records: Dict[str, Mapping] = {}
+    index = [[-1] * 32 for _ in range(13)]
+    for (m1, d1), (m2, d2), name, emoji, element, locative in ZODIAC_SIGNS:
+        if name not in records:
+            records[name] = MappingProxyType({"name": name, "emoji": emoji, "element": element, "locative": locative})
+        number = list(records).index(name)
+        spans = ((m1, d1, d2),) if m1 == m2 else ((m1, d1, 31), (m2, 1, d2))
+        for month, first, last in spans:
+            for day in range(first, last + 1):
+                index[month][day] = number
+    return tuple(records.values()), tuple(tuple(row) for row in index)
+
+# Записи знаков общие и неизменяемые: get_zodiac_sign не создаёт новых объектов
+ZODIAC_RECORDS, ZODIAC_INDEX = _build_zodiac_tables()
+ZODIAC_BY_DAY = tuple(
+    tuple(ZODIAC_RECORDS[number] if number >= 0 else None for number in row)
+    for row in ZODIAC_INDEX
+)
+
+def _reduce_life_path(total: int) -> int:
+    while total > 9 and total not in [11, 22, 33]:
+        total = sum(int(d) for d in str(total))
+    return total
+
+# Число пути зависит только от суммы цифр дня, месяца и года:
+# DIGIT_SUMS — суммы цифр чисел 0..9999, LIFE_PATH_BY_SUM — сведение суммы к числу пути
+DIGIT_SUMS = tuple(sum(int(d) for d in str(n)) for n in range(10000))
+LIFE_PATH_BY_SUM = tuple(_reduce_life_path(total) for total in range(18 + 18 + 36 + 1))
+
+if np is not None:
+    _DIGIT_SUMS_NP = np.array(DIGIT_SUMS, dtype=np.int16)
+    _LIFE_PATH_BY_SUM_NP = np.array(LIFE_PATH_BY_SUM, dtype=np.int8)
+    _ZODIAC_INDEX_NP = np.array(ZODIAC_INDEX, dtype=np.int8)
+
+def get_zodiac_sign(date_str: str) -> Optional[Mapping]:
+    """Определяет знак зодиака по дате рождения DD.MM.YYYY.
+
+    Возвращает общую неизменяемую запись знака; None — если дату не
+    разобрать или такого дня в месяце быть не может (больше 31).
+    """
     try:
         day, month, _ = map(int, date_str.split('.'))
-        for (m1, d1), (m2, d2), name, emoji, element, locative in ZODIAC_SIGNS:
-            if m1 == m2:
-                if month == m1 and d1 <= day <= d2:
-                    return {"name": name, "emoji": emoji, "element": element, "locative": locative}
-            elif m1 < m2:
-                if (month == m1 and day >= d1) or (month == m2 and day <= d2):
-                    return {"name": name, "emoji": emoji, "element": element, "locative": locative}
-        return None
     except Exception:
         return None
+    if 1 <= month <= 12 and 1 <= day <= 31:
+        return ZODIAC_BY_DAY[month][day]
+    return None
+
+def split_dates(date_strs: Sequence[str]) -> tuple:
+    """Дни, месяцы и годы списка дат ДД.ММ.ГГГГ для пакетных функций.
+    Неразобранные даты дают нули: знак -1, число пути 0."""
+    days, months, years = [], [], []
+    for date_str in date_strs:
+        match = DATE_RE.fullmatch(date_str)
+        if match is None or not (1 <= int(match.group(2)) <= 12 and 1 <= int(match.group(1)) <= 31):
+            days.append(0)
+            months.append(0)
+            years.append(0)
+        else:
+            days.append(int(match.group(1)))
+            months.append(int(match.group(2)))
+            years.append(int(match.group(3)))
+    if np is not None:
+        return np.array(days, dtype=np.int16), np.array(months, dtype=np.int16), np.array(years, dtype=np.int16)
+    return days, months, years
+
+def life_path_batch(days, months, years):
+    """Числа пути для массивов дней, месяцев и годов (ndarray с NumPy, иначе список)"""
+    if np is not None:
+        return _LIFE_PATH_BY_SUM_NP[
+            _DIGIT_SUMS_NP[np.asarray(days)] + _DIGIT_SUMS_NP[np.asarray(months)] + _DIGIT_SUMS_NP[np.asarray(years)]
+        ]
+    return [
+        LIFE_PATH_BY_SUM[DIGIT_SUMS[day] + DIGIT_SUMS[month] + DIGIT_SUMS[year]]
+        for day, month, year in zip(days, months, years)
+    ]
+
+def zodiac_batch(days, months):
+    """Номера знаков в ZODIAC_RECORDS для массивов дней и месяцев (-1 — нет знака)"""
+    if np is not None:
+        return _ZODIAC_INDEX_NP[np.asarray(months), np.asarray(days)]
+    return [ZODIAC_INDEX[month][day] for day, month in zip(days, months)]
+
+# =====================
+# LLM RESPONSE CACHE
+# =====================
+
+# Меняется при правке шаблонов промптов, чтобы не отдавать ответы на старые версии
+LLM_CACHE_VERSION = "1"
+
+# Время жизни ответов по функциям (секунды, None — бессрочно).
+# Ответы на гороскопы и карту дня включают в ключ период, поэтому TTL лишь
+# освобождает память после окончания окна.
+LLM_CACHE_TTLS = {
+    "profile": None,
+    "numerology": None,
+    "natal": None,
+    "compatibility": None,
+    "horoscope_today": 86400,
+    "horoscope_tomorrow": 2 * 86400,
+    "horoscope_week": 86400,
+    "horoscope_month": 31 * 86400,
+    "daily_card": 86400,
+}
+LLM_CACHE_DEFAULT_TTL = 86400
+
+class LLMCache:
+    """Кэш ответов LLM по нормализованным входным данным промпта.
+
+    Первый уровень — LRU в памяти с ограничением по объёму, второй
+    (необязательный) — таблица SQLite, переживающая перезапуски. Вместе
+    с текстом хранится имя бэкенда, который его сгенерировал.
+
+    Запросы к таблице выполняет отдельный поток: база может быть общей для
+    нескольких процессов, и ожидание её блокировки не должно останавливать
+    event loop. Запись не ждёт завершения — ответ уже лежит в памяти.
+    """
+
+    def __init__(self, max_bytes: int, db_path: str = "", max_rows: int = 0):
+        self.max_bytes = max_bytes
+        self.max_rows = max_rows
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (text, expires_at, provider)
+        self._bytes = 0
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "disk_errors": 0, "pruned": 0}
+        self._db = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._last_prune = time.monotonic()
+        if db_path:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llm-cache")
+            self._db = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False, timeout=10)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL, provider TEXT)"
+            )
+            columns = {row[1] for row in self._db.execute("PRAGMA table_info(llm_cache)")}
+            if "provider" not in columns:  # кэш создан до записи бэкенда
+                self._db.execute("ALTER TABLE llm_cache ADD COLUMN provider TEXT")
+            self._db.execute("DELETE FROM llm_cache WHERE expires_at < ?", (time.time(),))
+
+    @staticmethod
+    def make_key(system_prompt_key: str, cache_key: tuple, model: str = MODEL_NAME) -> str:
+        """model — модель, давшая ответ: ответы запасных бэкендов не выдаются за ответы основного"""
+        system_prompt = GROQ_SYSTEM_PROMPTS.get(system_prompt_key, GROQ_SYSTEM_PROMPTS["default"])
+        digest = hashlib.sha1(f"{LLM_CACHE_VERSION}|{model}|{system_prompt}".encode("utf-8")).hexdigest()[:12]
+        return "|".join((system_prompt_key, digest, *map(str, cache_key)))
+
+    async def get(self, key: str) -> Optional[tuple]:
+        """(текст, бэкенд) или None; бэкенд — пустая строка у записей без него"""
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, expires_at, provider = entry
+            if expires_at is None or expires_at > now:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return value, provider
+            self._remove(key)
+        if self._db is not None:
+            try:
+                row = await asyncio.get_running_loop().run_in_executor(self._executor, self._db_get, key)
+            except Exception as e:
+                logger.warning("LLM cache: ошибка чтения с диска: %s", e)
+                self.stats["disk_errors"] += 1
+                row = None
+            if row and (row[1] is None or row[1] > now):
+                self._store(key, row[0], row[1], row[2] or "")
+                self.stats["disk_hits"] += 1
+                return row[0], row[2] or ""
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, key: str, value: str, ttl: Optional[float], provider: str = ""):
+        expires_at = time.time() + ttl if ttl is not None else None
+        self._store(key, value, expires_at, provider)
+        if self._db is not None:
+            self._submit(self._db_put, key, value, expires_at, provider)
+
+    def prune(self):
+        """Удаляет из таблицы просроченные и сверхлимитные записи не чаще LLM_CACHE_PRUNE_INTERVAL"""
+        if self._db is None or time.monotonic() - self._last_prune < LLM_CACHE_PRUNE_INTERVAL:
+            return
+        self._last_prune = time.monotonic()
+        self._submit(self._db_prune)
+
+    def _submit(self, func, *args):
+        future = self._executor.submit(func, *args)
+        future.add_done_callback(self._disk_done)
+
+    def _disk_done(self, future):
+        # Вызывается в потоке кэша
+        exc = future.exception()
+        if exc is not None:
+            logger.warning("LLM cache: ошибка записи на диск: %s", exc)
+            self.stats["disk_errors"] += 1
+
+    def _db_get(self, key: str) -> Optional[tuple]:
+        return self._db.execute(
+            "SELECT value, expires_at, provider FROM llm_cache WHERE key = ?", (key,)
+        ).fetchone()
+
+    def _db_put(self, key: str, value: str, expires_at: Optional[float], provider: str):
+        self._db.execute(
+            "INSERT OR REPLACE INTO llm_cache (key, value, expires_at, provider) VALUES (?, ?, ?, ?)",
+            (key, value, expires_at, provider),
+        )
+
+    def _db_prune(self):
+        removed = self._db.execute("DELETE FROM llm_cache WHERE expires_at < ?", (time.time(),)).rowcount
+        if self.max_rows:
+            # rowid растёт с каждой записью (INSERT OR REPLACE выдаёт новый), первыми уходят самые старые
+            removed += self._db.execute(
+                "DELETE FROM llm_cache WHERE rowid IN (SELECT rowid FROM llm_cache ORDER BY rowid "
+                "LIMIT max(0, (SELECT count(*) FROM llm_cache) - ?))",
+                (self.max_rows,),
+            ).rowcount
+        self.stats["pruned"] += removed
+
+    def _store(self, key: str, value: str, expires_at: Optional[float], provider: str):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (value, expires_at, provider)
+        self._bytes += len(value.encode("utf-8"))
+        while self._bytes > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+            self.stats["evictions"] += 1
+
+    def _remove(self, key: str):
+        value, _, _ = self._entries.pop(key)
+        self._bytes -= len(value.encode("utf-8"))
+
+    def summary(self) -> Dict[str, Any]:
+        by_provider = defaultdict(int)
+        for _, _, provider in self._entries.values():
+            by_provider[provider or "unknown"] += 1
+        return {**self.stats, "entries": len(self._entries), "bytes": self._bytes, "by_provider": dict(by_provider)}
+
+llm_cache = LLMCache(LLM_CACHE_MAX_BYTES, LLM_CACHE_DB, LLM_CACHE_DB_MAX_ROWS)
+
+class SingleFlight:
+    """Объединение одинаковых одновременных запросов.
+
+    Пока первый вызов с данным ключом не завершился, остальные ждут его
+    результат вместо собственного запроса к API. Вызов идёт в отдельной
+    задаче, поэтому отмена одного из ожидающих не прерывает его для других.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.stats: Dict[str, Dict[str, int]] = defaultdict(lambda: {"calls": 0, "coalesced": 0})
+
+    async def do(self, key: str, group: str, func):
+        stats = self.stats[group]
+        stats["calls"] += 1
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(func())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            stats["coalesced"] += 1
+        return await asyncio.shield(task)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            group: {**stats, "hit_rate": round(stats["coalesced"] / stats["calls"], 4) if stats["calls"] else 0.0}
+            for group, stats in self.stats.items()
+        }
+
+groq_singleflight = SingleFlight()
+
+# =====================
+# GROQ SCHEDULER
+# =====================
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BACKGROUND: "background"}
+
+class GroqRateLimited(ValueError):
+    """Ответ 429: retry_after — сколько секунд API просит подождать"""
+
+    def __init__(self, retry_after: Optional[float]):
+        super().__init__(f"Groq rate limited, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+class TokenBucket:
+    """Ведро токенов: capacity единиц, полностью восполняется за period секунд"""
+
+    def __init__(self, capacity: int, period: float = 60.0):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: int, now: float) -> float:
+        """Через сколько секунд в ведре будет amount единиц"""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount: int):
+        self.tokens -= amount
+
+    def give_back(self, amount: int):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+class GroqScheduler:
+    """Очередь исходящих запросов к Groq.
+
+    Одновременно выполняется не больше max_concurrency запросов, частота
+    ограничена вёдрами RPM/TPM по модели лимитов Groq; 0 в любом из
+    лимитов — без ограничения. Ожидающие обслуживаются строго по
+    приоритету (интерактивные раньше фоновых), внутри приоритета — по
+    очереди. После 429 выдача приостанавливается
+    на Retry-After для всех, а не только для получившего отказ запроса.
+    """
+
+    def __init__(self, max_concurrency: int, rpm: int, tpm: int):
+        self.max_concurrency = max_concurrency
+        self.requests_bucket = TokenBucket(rpm) if rpm > 0 else None
+        self.tokens_bucket = TokenBucket(tpm) if tpm > 0 else None
+        self.active = 0
+        self.blocked_until = 0.0
+        self._waiters = []  # куча (приоритет, номер, future, токены)
+        self._seq = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.stats = {
+            name: {"granted": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0}
+            for name in PRIORITY_NAMES.values()
+        }
+        self.rate_limited = 0
+
+    @asynccontextmanager
+    async def slot(self, priority: int, tokens: int):
+        """Слот на один запрос; tokens — оценка расхода для TPM"""
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future, tokens))
+        enqueued = time.monotonic()
+        self._pump()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release()
+            else:
+                self._pump()
+            raise
+
+        waited_ms = (time.monotonic() - enqueued) * 1000
+        lane = self.stats[PRIORITY_NAMES.get(priority, "background")]
+        lane["granted"] += 1
+        lane["wait_ms_total"] += waited_ms
+        lane["wait_ms_max"] = round(max(lane["wait_ms_max"], waited_ms), 3)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def settle(self, estimated: int, actual: int):
+        """Поправка TPM по фактическому расходу из ответа API"""
+        if self.tokens_bucket is None:
+            return
+        if actual > estimated:
+            self.tokens_bucket.take(actual - estimated)
+        else:
+            self.tokens_bucket.give_back(estimated - actual)
+
+    def penalize(self, retry_after: float):
+        self.rate_limited += 1
+        self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+
+    def _release(self):
+        self.active -= 1
+        self._pump()
+
+    def _pump(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._waiters and (self.max_concurrency <= 0 or self.active < self.max_concurrency):
+            _, _, future, tokens = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            now = time.monotonic()
+            delay = self.blocked_until - now
+            if self.requests_bucket is not None:
+                delay = max(delay, self.requests_bucket.delay(1, now))
+            if self.tokens_bucket is not None:
+                delay = max(delay, self.tokens_bucket.delay(tokens, now))
+            if delay > 0:
+                self._timer = asyncio.get_running_loop().call_later(delay, self._pump)
+                return
+            heapq.heappop(self._waiters)
+            if self.requests_bucket is not None:
+                self.requests_bucket.take(1)
+            if self.tokens_bucket is not None:
+                self.tokens_bucket.take(tokens)
+            self.active += 1
+            future.set_result(None)
+
+    def summary(self) -> Dict[str, Any]:
+        depth = {name: 0 for name in PRIORITY_NAMES.values()}
+        for priority, _, future, _ in self._waiters:
+            if not future.done():
+                depth[PRIORITY_NAMES.get(priority, "background")] += 1
+        return {
+            "active": self.active,
+            "max_concurrency": self.max_concurrency,
+            "queue_depth": sum(depth.values()),
+            "queue_depth_by_lane": depth,
+            "rate_limited": self.rate_limited,
+            "blocked_for_s": round(max(0.0, self.blocked_until - time.monotonic()), 3),
+            "lanes": {
+                name: {
+                    **lane,
+                    "wait_ms_avg": round(lane["wait_ms_total"] / lane["granted"], 3) if lane["granted"] else 0.0,
+                }
+                for name, lane in self.stats.items()
+            },
+        }
+
+def _per_worker(limit: int) -> int:
+    """Доля общего лимита Groq на один процесс; 0 — без ограничения"""
+    return max(1, limit // WEB_CONCURRENCY) if limit > 0 else 0
+
+groq_scheduler = GroqScheduler(_per_worker(GROQ_MAX_CONCURRENCY), _per_worker(GROQ_RPM), _per_worker(GROQ_TPM))
+
+# =====================
+# LLM PROVIDERS
+# =====================
+
+class LLMProvider:
+    """OpenAI-совместимый бэкенд: адрес, ключ, модель и своя очередь лимитов.
+
+    Бэкенд считается занятым, пока действует пауза после 429 (Retry-After
+    в его планировщике) или после ошибки (LLM_FAILOVER_COOLDOWN).
+    """
+
+    def __init__(self, name: str, base_url: str, api_key: str, model: str, scheduler: GroqScheduler):
+        self.name = name
+        self.url = f"{base_url.rstrip('/')}/chat/completions"
+        self.api_key = api_key
+        self.model = model
+        self.scheduler = scheduler
+        self.down_until = 0.0
+        self.stats = {"requests": 0, "errors": 0, "failovers": 0}
+
+    def available_at(self) -> float:
+        return max(self.scheduler.blocked_until, self.down_until)
+
+    def mark_down(self):
+        self.down_until = time.monotonic() + LLM_FAILOVER_COOLDOWN
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "url": self.url,
+            "model": self.model,
+            **self.stats,
+            "unavailable_for_s": round(max(0.0, self.available_at() - time.monotonic()), 3),
+            "scheduler": self.scheduler.summary(),
+        }
+
+def parse_llm_fallbacks(spec: str) -> List[LLMProvider]:
+    """Запасные бэкенды из LLM_FALLBACKS в порядке попыток.
+
+    Модели через запятую — тот же LLM_BASE_URL и ключ:
+        llama-3.3-70b-versatile,gemma2-9b-it
+    Либо JSON-список, пропущенные поля берутся у основного бэкенда:
+        [{"model": "gpt-4o-mini", "base_url": "https://api.openai.com/v1",
+          "api_key_env": "OPENAI_API_KEY", "rpm": 500, "tpm": 0, "max_concurrency": 8}]
+    """
+    spec = spec.strip()
+    if not spec:
+        return []
+    if spec.startswith("["):
+        entries = json.loads(spec)
+    else:
+        entries = [{"model": model.strip()} for model in spec.split(",") if model.strip()]
+    providers = []
+    for entry in entries:
+        scheduler = GroqScheduler(
+            _per_worker(entry.get("max_concurrency", GROQ_MAX_CONCURRENCY)),
+            _per_worker(entry.get("rpm", GROQ_RPM)),
+            _per_worker(entry.get("tpm", GROQ_TPM)),
+        )
+        api_key = os.getenv(entry["api_key_env"], "") if "api_key_env" in entry else GROQ_API_KEY
+        providers.append(LLMProvider(
+            entry.get("name", entry["model"]), entry.get("base_url", LLM_BASE_URL), api_key, entry["model"], scheduler
+        ))
+    return providers
+
+llm_providers = [
+    LLMProvider(MODEL_NAME, LLM_BASE_URL, GROQ_API_KEY, MODEL_NAME, groq_scheduler),
+    *parse_llm_fallbacks(LLM_FALLBACKS),
+]
+
+def llm_chain() -> List[LLMProvider]:
+    """Бэкенды для очередной попытки: свободные по порядку конфигурации,
+    а если заняты все — тот, что освободится раньше"""
+    now = time.monotonic()
+    ready = [provider for provider in llm_providers if provider.available_at() <= now]
+    return ready or [min(llm_providers, key=LLMProvider.available_at)]
+
+async def llm_failover(call) -> tuple:
+    """call(provider) по цепочке llm_chain; возвращает (ответ, ответивший бэкенд).
+
+    Отказ бэкенда (429, ошибка API, таймаут) передаёт запрос следующему
+    без ожидания; ошибка последнего уходит наружу, к декоратору retry.
+    """
+    chain = llm_chain()
+    for index, provider in enumerate(chain):
+        try:
+            return await call(provider), provider
+        except Exception as e:
+            provider.stats["errors"] += 1
+            if not isinstance(e, GroqRateLimited) or e.retry_after is None:
+                provider.mark_down()
+            if index == len(chain) - 1:
+                raise
+            provider.stats["failovers"] += 1
+            LLM_FAILOVERS.inc(1, provider.name)
+            logger.warning("LLM: %s не ответил (%s), запрос передан %s", provider.name, e, chain[index + 1].name)
 
 # =====================
 # RETRY DECORATOR FOR GROQ
@@ -489,7 +2955,7 @@ def retry(max_retries=3, backoff_factor=1.0):
                 except Exception as e:
                     if retries == max_retries - 1:
                         raise
-                    wait = backoff_factor * (2 ** retries)
+                    wait = getattr(e, "retry_after", None) or backoff_factor * (2 ** retries)
                     logger.warning("Retry %s/%s after %ss: %s", retries + 1, max_retries, wait, e)
                     await asyncio.sleep(wait)
                     retries += 1
@@ -500,17 +2966,128 @@ def retry(max_retries=3, backoff_factor=1.0):
 # GROQ API WITH RETRY
 # =====================
 
-@retry(max_retries=3, backoff_factor=0.5)
-async def _ask_groq_request(prompt: str, system_prompt_key: str = "default") -> str:
-    url = "https://api.groq.com/openai/v1/chat/completions"
+class GroqClient:
+    """Клиент OpenAI-совместимых API (Groq и запасные бэкенды) с общей сессией на всё приложение.
 
-    headers = {
-        "Authorization": f"Bearer {GROQ_API_KEY}",
-        "Content-Type": "application/json"
-    }
+    Соединения переиспользуются между запросами и повторами, поэтому DNS,
+    TCP и TLS оплачиваются только при первом обращении к каждому хосту.
+    Время до первого байта считается отдельно для тёплых и новых соединений.
+    """
 
-    data = {
-        "model": MODEL_NAME,
+    def __init__(self):
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.stats = {
+            "requests": 0,
+            "errors": 0,
+            "ttfb_warm_count": 0,
+            "ttfb_warm_ms_total": 0.0,
+            "ttfb_warm_ms_last": 0.0,
+            "ttfb_cold_count": 0,
+            "ttfb_cold_ms_total": 0.0,
+            "ttfb_cold_ms_last": 0.0,
+            "streams": 0,
+        }
+
+    async def start(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_connection_reuseconn.append(self._on_connection_reuse)
+            self.session = create_http_session(
+                GROQ_POOL_LIMIT,
+                GROQ_POOL_LIMIT_PER_HOST,
+                timeout=90,
+                trace_configs=[trace_config],
+            )
+        return self.session
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    @staticmethod
+    async def _on_connection_reuse(session, trace_ctx, params):
+        trace_ctx.trace_request_ctx["reused"] = True
+
+    def _record_ttfb(self, reused: bool, elapsed: float):
+        kind = "warm" if reused else "cold"
+        elapsed_ms = elapsed * 1000
+        self.stats[f"ttfb_{kind}_count"] += 1
+        self.stats[f"ttfb_{kind}_ms_total"] += elapsed_ms
+        self.stats[f"ttfb_{kind}_ms_last"] = round(elapsed_ms, 3)
+
+    async def _raise_for_status(self, resp: aiohttp.ClientResponse, provider: LLMProvider):
+        self.stats["errors"] += 1
+        error_text = await resp.text()
+        logger.error("LLM API ERROR %s %s: %s", provider.name, resp.status, error_text)
+        if resp.status == 429:
+            try:
+                retry_after = float(resp.headers.get("Retry-After", ""))
+            except ValueError:
+                retry_after = None
+            if retry_after is not None:
+                provider.scheduler.penalize(retry_after)
+            raise GroqRateLimited(retry_after)
+        raise ValueError(f"LLM API error {resp.status}")
+
+    def summary(self) -> Dict[str, Any]:
+        summary = dict(self.stats)
+        for kind in ("warm", "cold"):
+            count = self.stats[f"ttfb_{kind}_count"]
+            summary[f"ttfb_{kind}_ms_avg"] = round(self.stats[f"ttfb_{kind}_ms_total"] / count, 3) if count else 0.0
+        return summary
+
+    async def chat(self, provider: LLMProvider, data: dict) -> dict:
+        session = await self.start()
+        headers = {
+            "Authorization": f"Bearer {provider.api_key}",
+            "Content-Type": "application/json"
+        }
+        trace_request_ctx = {"reused": False}
+        started = time.perf_counter()
+        self.stats["requests"] += 1
+        provider.stats["requests"] += 1
+        async with session.post(provider.url, headers=headers, json=data, trace_request_ctx=trace_request_ctx) as resp:
+            self._record_ttfb(trace_request_ctx["reused"], time.perf_counter() - started)
+            if resp.status != 200:
+                await self._raise_for_status(resp, provider)
+            return await resp.json()
+
+    async def chat_stream(self, provider: LLMProvider, data: dict):
+        """Потоковый ответ (SSE): отдаёт фрагменты текста по мере генерации"""
+        session = await self.start()
+        headers = {
+            "Authorization": f"Bearer {provider.api_key}",
+            "Content-Type": "application/json"
+        }
+        trace_request_ctx = {"reused": False}
+        started = time.perf_counter()
+        self.stats["requests"] += 1
+        self.stats["streams"] += 1
+        provider.stats["requests"] += 1
+        async with session.post(provider.url, headers=headers, json={**data, "stream": True},
+                                trace_request_ctx=trace_request_ctx) as resp:
+            self._record_ttfb(trace_request_ctx["reused"], time.perf_counter() - started)
+            if resp.status != 200:
+                await self._raise_for_status(resp, provider)
+            async for raw_line in resp.content:
+                line = raw_line.strip()
+                if not line.startswith(b"data:"):
+                    continue
+                payload = line[5:].strip()
+                if payload == b"[DONE]":
+                    break
+                chunk = json.loads(payload)
+                choices = chunk.get("choices") or [{}]
+                delta = choices[0].get("delta", {}).get("content")
+                if delta:
+                    yield delta
+
+groq_client = GroqClient()
+
+def _groq_payload(prompt: str, system_prompt_key: str, model: str = MODEL_NAME) -> dict:
+    return {
+        "model": model,
         "messages": [
             {"role": "system", "content": GROQ_SYSTEM_PROMPTS.get(system_prompt_key, GROQ_SYSTEM_PROMPTS["default"])},
             {"role": "user", "content": prompt}
@@ -519,21 +3096,107 @@ async def _ask_groq_request(prompt: str, system_prompt_key: str = "default") ->
         "max_tokens": 1500
     }
 
-    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=90)) as session:
-        async with session.post(url, headers=headers, json=data) as resp:
-            if resp.status != 200:
-                error_text = await resp.text()
-                logger.error("GROQ API ERROR %s: %s", resp.status, error_text)
-                raise ValueError("Groq API error")
-            result = await resp.json()
-            return result["choices"][0]["message"]["content"].strip()
+def _estimate_tokens(data: dict) -> int:
+    """Грубая оценка расхода токенов для TPM: ~3 символа на токен плюс лимит ответа"""
+    chars = sum(len(message["content"]) for message in data["messages"])
+    return chars // 3 + data["max_tokens"]
+
+async def _provider_request(provider: LLMProvider, prompt: str, system_prompt_key: str, priority: int) -> str:
+    data = _groq_payload(prompt, system_prompt_key, provider.model)
+    estimated = _estimate_tokens(data)
+    async with provider.scheduler.slot(priority, estimated):
+        started = time.perf_counter()
+        result = await groq_client.chat(provider, data)
+        GROQ_REQUEST_SECONDS.observe(time.perf_counter() - started, system_prompt_key, "request", provider.name)
+    usage = result.get("usage") or {}
+    for kind in ("prompt_tokens", "completion_tokens"):
+        if kind in usage:
+            GROQ_TOKENS.inc(usage[kind], system_prompt_key, kind[:-len("_tokens")])
+    if "total_tokens" in usage:
+        provider.scheduler.settle(estimated, usage["total_tokens"])
+    return result["choices"][0]["message"]["content"].strip()
+
+async def _provider_stream(provider: LLMProvider, prompt: str, system_prompt_key: str, on_text,
+                           priority: int) -> str:
+    data = _groq_payload(prompt, system_prompt_key, provider.model)
+    text = ""
+    async with provider.scheduler.slot(priority, _estimate_tokens(data)):
+        started = time.perf_counter()
+        async for delta in groq_client.chat_stream(provider, data):
+            text += delta
+            # Не ждём: слот планировщика держится, пока читается поток
+            on_text(text)
+        GROQ_REQUEST_SECONDS.observe(time.perf_counter() - started, system_prompt_key, "stream", provider.name)
+    return text.strip()
+
+@retry(max_retries=3, backoff_factor=0.5)
+async def _ask_groq_request(prompt: str, system_prompt_key: str = "default",
+                            priority: int = PRIORITY_INTERACTIVE) -> tuple:
+    return await llm_failover(
+        lambda provider: _provider_request(provider, prompt, system_prompt_key, priority)
+    )
 
-async def ask_groq(prompt: str, system_prompt_key: str = "default") -> str:
+@retry(max_retries=3, backoff_factor=0.5)
+async def _ask_groq_stream(prompt: str, system_prompt_key: str, on_text,
+                           priority: int = PRIORITY_INTERACTIVE) -> tuple:
+    """Потоковый запрос: on_text получает весь накопленный текст после каждого фрагмента"""
+    return await llm_failover(
+        lambda provider: _provider_stream(provider, prompt, system_prompt_key, on_text, priority)
+    )
+
+GROQ_ERROR_TEXT = "🔮 Произошла ошибка при обработке запроса. Попробуйте позже."
+
+async def ask_groq(prompt: str, system_prompt_key: str = "default", cache_key: Optional[tuple] = None,
+                   on_text=None, priority: int = PRIORITY_INTERACTIVE) -> str:
+    """Запрос к Groq с кэшированием ответа.
+
+    cache_key — нормализованные данные, от которых зависит промпт; первый
+    элемент задаёт функцию и её TTL (см. LLM_CACHE_TTLS). Без cache_key
+    ответ не кэшируется. Сообщения об ошибках в кэш не попадают.
+    Одинаковые одновременные запросы выполняются одним вызовом API.
+    on_text — обычная функция для показа частичного текста; вызывается
+    без ожидания на каждом фрагменте, пока занят слот планировщика, и
+    должна сразу возвращать управление. При LLM_STREAMING ответ
+    запрашивается потоком. Ожидающие того же ответа получают
+    только итоговый текст. priority — полоса в очереди groq_scheduler:
+    фоновые задачи передают PRIORITY_BACKGROUND.
+    """
+    key = None
+    if cache_key is not None:
+        # Ищем ответ модели, которой достанется запрос: пока основной бэкенд
+        # недоступен — запасной, после восстановления — снова основной
+        lookup_started = time.monotonic()
+        key = llm_cache.make_key(system_prompt_key, cache_key, llm_chain()[0].model)
+        cached = await llm_cache.get(key)
+        if cached is not None:
+            metrics.incr("llm.cache_hits")
+            LLM_ANSWER_SECONDS.observe(time.monotonic() - lookup_started, system_prompt_key,
+                                       cached[1] or "unknown", "cache")
+            return cached[0]
+
+    async def fetch() -> str:
+        started = time.monotonic()
+        metrics.incr("llm.calls")
+        if on_text is not None and LLM_STREAMING:
+            result, provider = await _ask_groq_stream(prompt, system_prompt_key, on_text, priority)
+        else:
+            result, provider = await _ask_groq_request(prompt, system_prompt_key, priority)
+        elapsed = time.monotonic() - started
+        metrics.observe("llm.latency", elapsed)
+        LLM_ANSWER_SECONDS.observe(elapsed, system_prompt_key, provider.name, "api")
+        if cache_key is not None:
+            llm_cache.put(llm_cache.make_key(system_prompt_key, cache_key, provider.model), result,
+                          LLM_CACHE_TTLS.get(cache_key[0], LLM_CACHE_DEFAULT_TTL), provider.name)
+        return result
+
+    flight_key = key or hashlib.sha1(f"{system_prompt_key}|{prompt}".encode("utf-8")).hexdigest()
     try:
-        return await _ask_groq_request(prompt, system_prompt_key)
+        return await groq_singleflight.do(flight_key, system_prompt_key, fetch)
     except Exception as e:
         logger.error("GROQ ERROR: %s", e)
-        return "🔮 Произошла ошибка при обработке запроса. Попробуйте позже."
+        metrics.incr("errors.llm")
+        GROQ_ERRORS.inc(1, system_prompt_key)
+        return GROQ_ERROR_TEXT
 
 async def generate_ai_affirmation(date_str: str, life_number: int, target_date_str: str, period: str = "day") -> str:
     period_names = {
@@ -621,6 +3284,19 @@ def admin_menu():
         resize_keyboard=True
     )
 
+def broadcast_confirm_menu():
+    return InlineKeyboardMarkup(
+        inline_keyboard=[[
+            InlineKeyboardButton(text="✅ Отправить всем", callback_data="broadcast_send"),
+            InlineKeyboardButton(text="✖️ Отмена", callback_data="broadcast_cancel")
+        ]]
+    )
+
+def broadcast_stop_menu():
+    return InlineKeyboardMarkup(
+        inline_keyboard=[[InlineKeyboardButton(text="⏹ Остановить", callback_data="broadcast_stop")]]
+    )
+
 def horoscope_type_menu():
     return InlineKeyboardMarkup(
         inline_keyboard=[
@@ -639,16 +3315,58 @@ def horoscope_type_menu():
 # UTILITY FUNCTIONS
 # =====================
 
+DATE_RE = re.compile(r"(\d{1,2})\.(\d{1,2})\.(\d{4})")
+
+def is_valid_date(token: str) -> bool:
+    """Токен — дата ДД.ММ.ГГГГ, существующая в календаре (как у strptime, но без исключений)"""
+    match = DATE_RE.fullmatch(token)
+    if match is None:
+        return False
+    day, month, year = int(match.group(1)), int(match.group(2)), int(match.group(3))
+    return year >= 1 and 1 <= month <= 12 and 1 <= day <= calendar.monthrange(year, month)[1]
+
 def is_date(text: str) -> bool:
     if not text:
         return False
     # Поддержка "DD.MM.YYYY" и "DD.MM.YYYY HH:MM"
-    date_part = text.strip().split()[0]
+    parts = text.split()
+    return bool(parts) and is_valid_date(parts[0])
+
+# Кнопки меню: текст кнопки -> обработчик (заполняется декоратором menu_route)
+MENU_ROUTES: Dict[str, Any] = {}
+
+def menu_route(text: str):
+    def decorator(handler):
+        MENU_ROUTES[text] = handler
+        return handler
+    return decorator
+
+def resolve_text_route(text: Optional[str]):
+    """Обработчик для текстового сообщения или None.
+
+    Кнопки меню — поиск в словаре, даты — регулярное выражение; pydantic
+    и исключения на обычном тексте не используются.
+    """
+    if not text:
+        return None
+    handler = MENU_ROUTES.get(text)
+    if handler is not None:
+        return handler
+    parts = text.split()
+    if len(parts) == 2 and "." in parts[0] and "." in parts[1]:
+        # Две даты — совместимость; дата со временем через точку — обычная дата
+        if is_valid_date(parts[1]) or not is_valid_date(parts[0]):
+            return compatibility_analysis_handler
+    if parts and is_valid_date(parts[0]):
+        return date_analysis_handler
+    return None
+
+def normalize_date(date_str: str) -> str:
+    """Приводит дату к виду DD.MM.YYYY (1.5.1990 → 01.05.1990) для ключей кэша"""
     try:
-        DateModel(date_str=date_part)
-        return True
-    except Exception:
-        return False
+        return datetime.strptime(date_str, "%d.%m.%Y").strftime("%d.%m.%Y")
+    except ValueError:
+        return date_str
 
 def parse_date_input(text: str) -> tuple:
     """Разбирает ввод пользователя на дату и необязательное время.
@@ -674,45 +3392,477 @@ def format_user_name(user: types.User) -> str:
     return " ".join(name_parts) if name_parts else "Дорогой друг"
 
 def calculate_active_users():
-    now = datetime.now()
-    active_count = 0
-    inactive_count = 0
+    return storage.count_activity(datetime.now())
+
+# =====================
+# SAFE REPLY HELPER
+# =====================
+
+async def safe_reply(message: Message, text: str, reply_markup=None):
+    """Отправка с Markdown, fallback на plain text при ошибке"""
+    try:
+        await message.answer(text, parse_mode="Markdown", reply_markup=reply_markup)
+    except Exception:
+        try:
+            clean_text = text.replace('*', '').replace('_', '').replace('`', '')
+            await message.answer(clean_text, reply_markup=reply_markup)
+        except Exception as e:
+            logger.error("Failed to send message: %s", e)
+            await message.answer(
+                "Произошла ошибка при отправке результата. Попробуйте ещё раз.",
+                reply_markup=reply_markup
+            )
+
+class PerceivedLatency:
+    """Время до первого видимого текста ответа по функциям бота"""
+
+    def __init__(self):
+        self.stats: Dict[str, Dict[str, Any]] = {}
+
+    def record(self, feature: str, elapsed: float, streamed: bool):
+        entry = self.stats.setdefault(feature, {
+            "count": 0, "streamed": 0, "ttfv_ms_total": 0.0, "ttfv_ms_last": 0.0, "ttfv_ms_max": 0.0,
+        })
+        elapsed_ms = elapsed * 1000
+        entry["count"] += 1
+        entry["streamed"] += int(streamed)
+        entry["ttfv_ms_total"] += elapsed_ms
+        entry["ttfv_ms_last"] = round(elapsed_ms, 3)
+        entry["ttfv_ms_max"] = round(max(entry["ttfv_ms_max"], elapsed_ms), 3)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            feature: {**entry, "ttfv_ms_avg": round(entry["ttfv_ms_total"] / entry["count"], 3)}
+            for feature, entry in self.stats.items()
+        }
+
+perceived_latency = PerceivedLatency()
 
-    for user_id_str, user_data in storage.users.items():
-        if "last_active" in user_data:
+class LLMReplyStream:
+    """Показ ответа LLM по мере генерации.
+
+    Частичный текст выводится правкой сообщения-заглушки не чаще раза в
+    LLM_STREAM_EDIT_INTERVAL секунд и без разметки: незакрытые `*` ломают
+    Markdown. Правки делает отдельная задача с последним полученным текстом,
+    чтобы запросы к Telegram не задерживали чтение потока; после повтора
+    запроса поток начинается заново, и показ ждёт, пока текст не станет
+    длиннее уже показанного. Итоговая правка применяет Markdown с тем же fallback, что и
+    safe_reply. Клавиатуру к правке не прикрепить, но меню у пользователя
+    уже открыто. Если частичный текст не показывался (кэш, готовая таблица,
+    потоковый режим выключен), ответ уходит обычным сообщением.
+    """
+
+    MAX_LENGTH = 4096
+
+    def __init__(self, placeholder: Message, feature: str, render):
+        self.placeholder = placeholder
+        self.feature = feature
+        self.render = render
+        self.started = time.perf_counter()
+        self.first_visible: Optional[float] = None
+        self.last_edit = 0.0
+        self.last_text = ""
+        self.last_length = 0  # длина самого длинного полученного текста
+        self._pending: Optional[str] = None
+        self._editor: Optional[asyncio.Task] = None
+        self._editing = False
+
+    def on_text(self, text: str):
+        if len(text) <= self.last_length:
+            return
+        self.last_length = len(text)
+        self._pending = text
+        if self._editor is None or self._editor.done():
+            self._editor = asyncio.create_task(self._edit_loop())
+
+    async def _edit_loop(self):
+        while self._pending is not None:
+            delay = self.last_edit + LLM_STREAM_EDIT_INTERVAL - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            text, self._pending = self._pending, None
+            self._editing = True
             try:
-                last_active = datetime.strptime(user_data["last_active"], "%Y-%m-%d %H:%M:%S")
-                days_inactive = (now - last_active).days
+                await self._edit(text)
+            finally:
+                self._editing = False
+
+    async def _edit(self, text: str):
+        now = time.perf_counter()
+        self.last_edit = now
+        visible = self.render(text).replace('*', '').replace('_', '').replace('`', '').strip()
+        visible = visible[:self.MAX_LENGTH]
+        if visible == self.last_text:
+            return
+        try:
+            await self.placeholder.edit_text(visible)
+        except Exception as e:
+            logger.debug("Stream edit skipped: %s", e)
+            return
+        self.last_text = visible
+        if self.first_visible is None:
+            self.first_visible = now
+            perceived_latency.record(self.feature, now - self.started, streamed=True)
+
+    async def finish(self, m: Message, text: str, reply_markup=None):
+        self._pending = None
+        if self._editor is not None and not self._editor.done():
+            # Начатую правку дожидаемся, чтобы она не легла поверх итоговой
+            if self._editing:
+                await self._editor
+            else:
+                self._editor.cancel()
+        final_text = self.render(text)
+        if self.first_visible is None:
+            await safe_reply(m, final_text, reply_markup=reply_markup)
+            perceived_latency.record(self.feature, time.perf_counter() - self.started, streamed=False)
+            return
+        try:
+            await self.placeholder.edit_text(final_text, parse_mode="Markdown")
+        except Exception:
+            try:
+                clean_text = final_text.replace('*', '').replace('_', '').replace('`', '')
+                if clean_text.strip() != self.last_text:
+                    await self.placeholder.edit_text(clean_text)
+            except Exception as e:
+                logger.error("Failed to edit message: %s", e)
+                await safe_reply(m, final_text, reply_markup=reply_markup)
 
-                if days_inactive <= 30:
-                    active_count += 1
-                else:
-                    inactive_count += 1
-            except:
-                active_count += 1
-        else:
-            active_count += 1
+# =====================
+# BROADCAST
+# =====================
+
+BROADCAST_PAGE_SIZE = 1000
+BROADCAST_MAX_ATTEMPTS = 3  # для сетевых ошибок и 5xx; RetryAfter попыток не расходует
+BROADCAST_RESULTS = ("sent", "blocked", "not_found", "skipped", "failed")
+BROADCAST_STATUS_TITLES = {"running": "идёт", "done": "завершена", "stopped": "остановлена"}
+
+def format_eta(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds} с"
+    if seconds < 3600:
+        return f"{seconds // 60} мин {seconds % 60} с"
+    return f"{seconds // 3600} ч {seconds % 3600 // 60} мин"
+
+class Broadcaster:
+    """Рассылка сообщения всем пользователям бота.
+
+    Сообщения отправляют BROADCAST_CONCURRENCY задач через общее ведро
+    токенов: не больше BROADCAST_RATE в секунду при глобальном лимите
+    Telegram около 30, запас остаётся на ответы бота. Каждому получателю
+    уходит одно сообщение, поэтому лимит на отдельный чат не достигается.
+    TelegramRetryAfter приостанавливает всю рассылку на указанный срок,
+    после чего сообщение отправляется повторно. Заблокировавшие бота и
+    удалённые аккаунты помечаются в хранилище и пропускаются следующими
+    рассылками, пока снова не напишут боту.
+
+    Контрольная точка — курсор страницы пользователей и уже обработанные
+    получатели этой страницы — сохраняется в BROADCAST_FILE, после
+    перезапуска рассылка продолжается с того же места. При нескольких
+    процессах рассылку ведёт тот, кто держит блокировку файла.
+    """
+
+    def __init__(self, path: str, rate: float, concurrency: int):
+        self.path = path
+        self.stop_path = f"{path}.stop"
+        self.concurrency = concurrency
+        burst = max(1, round(rate / 5))  # не больше 0.2 с лимита разом
+        self._bucket = TokenBucket(burst, burst / rate)
+        self.paused_until = 0.0
+        self.state: Optional[Dict] = self._load()
+        self._task: Optional[asyncio.Task] = None
+        self._lock_file = None
+        self._save_lock = asyncio.Lock()
+        self._stopping = False
+        self._run_started = 0.0
+        self._run_processed = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    # --- контрольная точка ---
+
+    def _load(self) -> Optional[Dict]:
+        try:
+            with open(self.path, "rb") as f:
+                return json_loads(f.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.error("BROADCAST: не удалось прочитать %s: %s", self.path, e)
+            return None
+
+    async def _save(self):
+        async with self._save_lock:
+            data = json.dumps(self.state, ensure_ascii=False).encode("utf-8")
+            await asyncio.to_thread(atomic_write, self.path, data)
+
+    def _acquire_lock(self) -> bool:
+        if not MULTI_WORKER:
+            return True
+        if self._lock_file is None:
+            self._lock_file = try_lock_file(f"{self.path}.lock")
+        return self._lock_file is not None
+
+    def _release_lock(self):
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    # --- управление ---
+
+    def start(self, text: str, admin_chat_id: int, progress_message_id: Optional[int]) -> bool:
+        """False — рассылка уже идёт (в этом или другом процессе)"""
+        if self.running or not self._acquire_lock():
+            return False
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.stop_path)
+        self.state = {
+            "id": datetime.now().strftime("%Y%m%d-%H%M%S"),
+            "text": text,
+            "status": "running",
+            "started_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "finished_at": None,
+            "admin_chat_id": admin_chat_id,
+            "progress_message_id": progress_message_id,
+            "total": storage.count_users(),
+            "cursor": 0,
+            "page_done": [],
+            "stats": {**dict.fromkeys(BROADCAST_RESULTS, 0), "retry_after": 0},
+        }
+        self._launch()
+        return True
+
+    def resume(self) -> bool:
+        """Продолжает рассылку, прерванную перезапуском"""
+        if self.running or not self.state or self.state["status"] != "running" or not self._acquire_lock():
+            return False
+        self.state = self._load()  # под блокировкой — последняя контрольная точка
+        if not self.state or self.state["status"] != "running":
+            self._release_lock()
+            return False
+        logger.info("BROADCAST: продолжаем рассылку %s с курсора %s", self.state["id"], self.state["cursor"])
+        self._launch()
+        return True
+
+    def _launch(self):
+        self._stopping = False
+        self._run_started = time.monotonic()
+        self._run_processed = 0
+        self._task = asyncio.create_task(self._run())
+
+    def request_stop(self) -> bool:
+        """Остановка по кнопке админа; False — нечего останавливать"""
+        if self.running:
+            self._stopping = True
+            self._task.cancel()
+            return True
+        state = self._load()
+        if MULTI_WORKER and state and state["status"] == "running":
+            # Рассылку ведёт другой процесс: он проверяет флаг перед каждым отчётом
+            Path(self.stop_path).touch()
+            return True
+        return False
 
-    return active_count, inactive_count
+    async def shutdown(self):
+        """Остановка процесса: прогресс сохраняется, рассылка продолжится после запуска"""
+        if self.running:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
 
-# =====================
-# SAFE REPLY HELPER
-# =====================
+    # --- отправка ---
 
-async def safe_reply(message: Message, text: str, reply_markup=None):
-    """Отправка с Markdown, fallback на plain text при ошибке"""
-    try:
-        await message.answer(text, parse_mode="Markdown", reply_markup=reply_markup)
-    except Exception:
+    async def _run(self):
+        state = self.state
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.concurrency)]
+        reporter = asyncio.create_task(self._report_loop())
         try:
-            clean_text = text.replace('*', '').replace('_', '').replace('`', '')
-            await message.answer(clean_text, reply_markup=reply_markup)
+            while True:
+                items, next_cursor = storage.users_page(state["cursor"], BROADCAST_PAGE_SIZE, UserQuery())
+                done = set(state["page_done"])
+                for uid, user in items:
+                    if uid in done:
+                        continue
+                    if user.get("unreachable"):
+                        self._count(uid, "skipped")
+                        continue
+                    await queue.put(uid)
+                await queue.join()
+                if next_cursor is None:
+                    break
+                state["cursor"], state["page_done"] = next_cursor, []
+                await self._save()
+            state["status"] = "done"
+        except asyncio.CancelledError:
+            if self._stopping:
+                state["status"] = "stopped"
+            raise
         except Exception as e:
-            logger.error("Failed to send message: %s", e)
-            await message.answer(
-                "Произошла ошибка при отправке результата. Попробуйте ещё раз.",
-                reply_markup=reply_markup
+            logger.exception("BROADCAST: рассылка прервана ошибкой")
+            state["status"] = "stopped"
+            state["error"] = str(e)
+        finally:
+            for task in (*workers, reporter):
+                task.cancel()
+            await asyncio.gather(*workers, reporter, return_exceptions=True)
+            if state["status"] != "running":
+                state["finished_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            await self._save()
+            await self._report()
+            self._release_lock()
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.stop_path)
+            logger.info("BROADCAST: %s %s, %s", state["id"], state["status"], state["stats"])
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            uid = await queue.get()
+            try:
+                self._count(uid, await self._deliver(uid))
+            finally:
+                queue.task_done()
+
+    def _count(self, uid: str, result: str):
+        self.state["stats"][result] += 1
+        self.state["page_done"].append(uid)
+        if result != "skipped":
+            self._run_processed += 1
+        BROADCAST_MESSAGES.inc(1, result)
+
+    async def _wait_turn(self):
+        while True:
+            now = time.monotonic()
+            wait = max(self.paused_until - now, self._bucket.delay(1, now))
+            if wait <= 0:
+                self._bucket.take(1)
+                return
+            await asyncio.sleep(wait)
+
+    async def _deliver(self, uid: str) -> str:
+        attempts = 0
+        while True:
+            await self._wait_turn()
+            sending = asyncio.ensure_future(bot.send_message(int(uid), self.state["text"]))
+            try:
+                try:
+                    await asyncio.shield(sending)
+                except asyncio.CancelledError:
+                    # Запрос уже ушёл в Telegram: дожидаемся ответа и учитываем
+                    # получателя, иначе после перезапуска он получит сообщение дважды
+                    with contextlib.suppress(Exception):
+                        await sending
+                        self._count(uid, "sent")
+                    raise
+                return "sent"
+            except TelegramRetryAfter as e:
+                # Flood control действует на весь бот — ждут все отправители
+                self.state["stats"]["retry_after"] += 1
+                self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+                logger.warning("BROADCAST: flood control, пауза %s с", e.retry_after)
+            except TelegramForbiddenError:
+                storage.mark_unreachable(uid, "blocked")
+                return "blocked"
+            except (TelegramBadRequest, TelegramNotFound) as e:
+                if "not found" in e.message.lower():
+                    storage.mark_unreachable(uid, "not_found")
+                    return "not_found"
+                logger.warning("BROADCAST: %s не доставлено: %s", uid, e.message)
+                return "failed"
+            except (TelegramNetworkError, TelegramServerError) as e:
+                attempts += 1
+                if attempts >= BROADCAST_MAX_ATTEMPTS:
+                    logger.warning("BROADCAST: %s не доставлено после %s попыток: %s", uid, attempts, e)
+                    return "failed"
+                await asyncio.sleep(2 ** attempts)
+            except Exception as e:
+                logger.warning("BROADCAST: %s не доставлено: %s", uid, e)
+                return "failed"
+
+    # --- отчёт ---
+
+    async def _report_loop(self):
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            if os.path.exists(self.stop_path):
+                self.request_stop()
+                return
+            await self._save()
+            await self._report()
+
+    async def _report(self):
+        """Правит сообщение о ходе рассылки в чате админа"""
+        state = self.state
+        if not state.get("progress_message_id"):
+            return
+        try:
+            await bot.edit_message_text(
+                self.progress_text(),
+                chat_id=state["admin_chat_id"],
+                message_id=state["progress_message_id"],
+                reply_markup=broadcast_stop_menu() if state["status"] == "running" else None,
+            )
+        except TelegramBadRequest:
+            pass  # message is not modified
+        except Exception as e:
+            logger.warning("BROADCAST: не удалось обновить прогресс: %s", e)
+
+    def summary(self) -> Dict:
+        state = self.state if self.running else self._load()
+        if not state:
+            return {"status": "idle"}
+        stats = state["stats"]
+        processed = sum(stats[result] for result in BROADCAST_RESULTS)
+        elapsed = time.monotonic() - self._run_started
+        rate = self._run_processed / elapsed if self.running and elapsed > 1 and self._run_processed else None
+        remaining = max(0, state["total"] - processed)
+        return {
+            "id": state["id"],
+            "status": state["status"],
+            "started_at": state["started_at"],
+            "finished_at": state["finished_at"],
+            "total": state["total"],
+            "processed": processed,
+            "stats": dict(stats),
+            "messages_per_second": round(rate, 2) if rate else None,
+            "eta_seconds": round(remaining / rate) if rate else None,
+            "paused_for_seconds": round(max(0.0, self.paused_until - time.monotonic()), 1) if self.running else 0,
+            "running_here": self.running,
+            "error": state.get("error"),
+        }
+
+    def progress_text(self, summary: Optional[Dict] = None) -> str:
+        summary = summary or self.summary()
+        stats = summary["stats"]
+        total = max(summary["total"], summary["processed"])
+        percent = summary["processed"] * 100 // total if total else 100
+        lines = [
+            f"📢 Рассылка {summary['id']} — {BROADCAST_STATUS_TITLES.get(summary['status'], summary['status'])}",
+            "",
+            f"Обработано: {summary['processed']} из {total} ({percent}%)",
+            f"✅ Доставлено: {stats['sent']}",
+            f"🚫 Заблокировали бота: {stats['blocked']}",
+            f"❓ Аккаунт не найден: {stats['not_found']}",
+            f"⏭ Пропущено недоступных: {stats['skipped']}",
+            f"⚠️ Ошибки: {stats['failed']}",
+            f"⏸ Ограничений Telegram (429): {stats['retry_after']}",
+        ]
+        if summary["messages_per_second"]:
+            lines.append(
+                f"⚡ Скорость: {summary['messages_per_second']:.1f} сообщ./с, "
+                f"осталось ≈ {format_eta(summary['eta_seconds'])}"
             )
+        if summary["paused_for_seconds"]:
+            lines.append(f"⏳ Пауза по требованию Telegram: {summary['paused_for_seconds']} с")
+        if summary.get("error"):
+            lines.append(f"❗ {summary['error']}")
+        return "\n".join(lines)
+
+broadcaster = Broadcaster(BROADCAST_FILE, BROADCAST_RATE, BROADCAST_CONCURRENCY)
 
 # =====================
 # HANDLERS
@@ -728,24 +3878,17 @@ async def start(m: Message):
     now = datetime.now()
     now_str = now.strftime("%Y-%m-%d %H:%M:%S")
 
-    is_new_user = str(user_id) not in storage.users
+    is_new_user = not storage.has_user(str(user_id))
 
     if is_new_user:
-        storage.users[str(user_id)] = {
+        storage.register_user(str(user_id), {
             "username": username,
             "first_name": first_name,
-            "last_name": last_name,
-            "joined": now_str,
-            "last_active": now_str,
-            "total_requests": 0
-        }
-        storage.stats["total_users"] = len(storage.users)
-        storage.stats["daily_stats"]["new_users"] = storage.stats["daily_stats"].get("new_users", 0) + 1
-        storage.stats["user_registration_dates"][str(user_id)] = now_str
+            "last_name": last_name
+        }, now_str)
     else:
-        storage.users[str(user_id)]["last_active"] = now_str
+        storage.touch_user(str(user_id), now_str)
 
-    storage.stats["user_last_activity"][str(user_id)] = now_str
     await storage.save_all()
 
     user_name = format_user_name(m.from_user)
@@ -762,7 +3905,7 @@ async def start(m: Message):
     await m.answer(welcome_text, reply_markup=main_menu(user_id))
     await PersonalizationEngine.update_user_profile(user_id, "start")
 
-@router.message(lambda m: m.text == "🔮 Мой профиль")
+@menu_route("🔮 Мой профиль")
 async def profile_main(m: Message):
     user_id = m.from_user.id
     await PersonalizationEngine.update_user_profile(user_id, "profile_request")
@@ -781,7 +3924,7 @@ async def profile_main(m: Message):
         reply_markup=main_menu(user_id)
     )
 
-@router.message(lambda m: m.text == "💞 Совместимость")
+@menu_route("💞 Совместимость")
 async def compatibility_main(m: Message):
     user_id = m.from_user.id
     await PersonalizationEngine.update_user_profile(user_id, "compatibility_request_general")
@@ -799,7 +3942,7 @@ async def compatibility_main(m: Message):
         reply_markup=main_menu(user_id)
     )
 
-@router.message(lambda m: m.text == "♈ Гороскоп")
+@menu_route("♈ Гороскоп")
 async def horoscope_main(m: Message):
     user_id = m.from_user.id
     await PersonalizationEngine.update_user_profile(user_id, "horoscope_request")
@@ -835,7 +3978,7 @@ async def process_horoscope_type(callback: types.CallbackQuery):
     await PersonalizationEngine.update_user_profile(callback.from_user.id, f"horoscope_{h_type}")
     await callback.answer()
 
-@router.message(lambda m: m.text == "🔢 Нумерология")
+@menu_route("🔢 Нумерология")
 async def numerology_main(m: Message):
     user_id = m.from_user.id
     await PersonalizationEngine.update_user_profile(user_id, "numerology_request")
@@ -853,7 +3996,7 @@ async def numerology_main(m: Message):
         reply_markup=main_menu(user_id)
     )
 
-@router.message(lambda m: m.text == "🌌 Натальная карта")
+@menu_route("🌌 Натальная карта")
 async def natal_chart_main(m: Message):
     user_id = m.from_user.id
     await PersonalizationEngine.update_user_profile(user_id, "natal_chart_request")
@@ -868,7 +4011,7 @@ async def natal_chart_main(m: Message):
         reply_markup=main_menu(user_id)
     )
 
-@router.message(lambda m: m.text == "✨ Карта дня")
+@menu_route("✨ Карта дня")
 async def daily_card_main(m: Message):
     user_id = m.from_user.id
     stored_date = PersonalizationEngine.get_user_birth_date(user_id)
@@ -884,7 +4027,7 @@ async def daily_card_main(m: Message):
             reply_markup=main_menu(user_id)
         )
 
-@router.message(lambda m: m.text == "👑 Админ-панель")
+@menu_route("👑 Админ-панель")
 async def admin_button_handler(m: Message):
     user_id = m.from_user.id
 
@@ -901,7 +4044,7 @@ async def admin_button_handler(m: Message):
             reply_markup=main_menu(user_id)
         )
 
-@router.message(lambda m: m.text == "📊 Статистика")
+@menu_route("📊 Статистика")
 async def admin_stats(m: Message):
     user_id = m.from_user.id
 
@@ -909,34 +4052,34 @@ async def admin_stats(m: Message):
         await m.answer("Доступ запрещен", reply_markup=main_menu(user_id))
         return
 
-    active_users, inactive_users = calculate_active_users()
-    storage.stats["active_users"] = active_users
-    storage.stats["inactive_users"] = inactive_users
-    await storage.save_all()
+    report = storage.activity_report(datetime.now())
+    active_users, inactive_users = report["active_users"], report["inactive_users"]
+    stats = storage.counters()
 
     total_calculations = (
-        storage.stats.get("calculations", 0) +
-        storage.stats.get("compatibility_checks", 0) +
-        storage.stats.get("forecasts", 0) +
-        storage.stats.get("horoscopes", 0)
+        stats.get("calculations", 0) +
+        stats.get("compatibility_checks", 0) +
+        stats.get("forecasts", 0) +
+        stats.get("horoscopes", 0)
     )
 
-    total_users = len(storage.users)
+    total_users = storage.count_users()
     avg_requests = total_calculations / total_users if total_users > 0 else 0
 
-    current_year = datetime.now().year
-    users_this_month = 0
-    users_this_year = 0
+    users_this_year = report["registered_this_year"]
+    users_this_month = report["registered_this_month"]
 
-    for reg_date in storage.stats.get("user_registration_dates", {}).values():
-        try:
-            reg_datetime = datetime.strptime(reg_date, "%Y-%m-%d %H:%M:%S")
-            if reg_datetime.year == current_year:
-                users_this_year += 1
-                if reg_datetime.month == datetime.now().month:
-                    users_this_month += 1
-        except:
-            pass
+    digest = metrics_digest()
+    today, week = digest["today"], digest["last_7_days"]
+    trend = digest["trend_7_days"]
+    llm_latency = mean_latency(today, "llm.latency")
+    top_features = sorted(
+        ((int(week.get(f"feature.{key}", 0)), title) for key, title in FEATURE_TITLES.items()),
+        reverse=True,
+    )
+    top_features_text = "\n".join(
+        f"{place}. {title} ({count} раз)" for place, (count, title) in enumerate(top_features[:3], 1) if count
+    ) or "Нет данных"
 
     stats_text = f"""
 📊 *Статистика бота*
@@ -949,25 +4092,33 @@ async def admin_stats(m: Message):
 • Новых в этом месяце: {users_this_month}
 
 📈 *Анализов выполнено (всего: {total_calculations}):*
-• Профилей и нумерологий: {storage.stats.get("calculations", 0)}
-• Проверок совместимости: {storage.stats.get("compatibility_checks", 0)}
-• Прогнозов (архив): {storage.stats.get("forecasts", 0)}
-• Персональных гороскопов: {storage.stats.get("horoscopes", 0)}
+• Профилей и нумерологий: {stats.get("calculations", 0)}
+• Проверок совместимости: {stats.get("compatibility_checks", 0)}
+• Прогнозов (архив): {stats.get("forecasts", 0)}
+• Персональных гороскопов: {stats.get("horoscopes", 0)}
 
 📊 *Средние показатели:*
 • Запросов на пользователя: {avg_requests:.1f}
 
 📅 *За сегодня ({datetime.now().strftime("%d.%m.%Y")}):*
-• Новых пользователей: {storage.stats.get("daily_stats", {}).get("new_users", 0)}
-• Выполнено анализов: {storage.stats.get("daily_stats", {}).get("calculations", 0)}
-
-🎯 *Популярные функции:*
-1. {max(storage.stats.get("popular_features", {}), key=storage.stats.get("popular_features", {}).get, default="Нет данных")} ({storage.stats.get("popular_features", {}).get(max(storage.stats.get("popular_features", {}), key=storage.stats.get("popular_features", {}).get, default=""), 0)} раз)
+• Новых пользователей: {int(today.get("new_users", 0))}
+• Выполнено анализов: {feature_total(today)}
+• Запросов к AI: {int(today.get("llm.calls", 0))} (из кэша: {int(today.get("llm.cache_hits", 0))}, ошибок: {int(today.get("errors.llm", 0))})
+• Среднее время ответа AI: {f"{llm_latency:.1f} с" if llm_latency is not None else "нет данных"}
+
+🗓 *За 7 дней:*
+• Новых пользователей: {int(week.get("new_users", 0))}
+• Выполнено анализов: {feature_total(week)}
+• Новые по дням: {" · ".join(str(int(v)) for v in trend["new_users"])}
+• Анализы по дням: {" · ".join(str(int(v)) for v in trend["analyses"])}
+
+🎯 *Популярные функции (7 дней):*
+{top_features_text}
 """
 
     await m.answer(stats_text, parse_mode="Markdown", reply_markup=admin_menu())
 
-@router.message(lambda m: m.text == "👥 Пользователи")
+@menu_route("👥 Пользователи")
 async def admin_users(m: Message):
     user_id = m.from_user.id
 
@@ -975,13 +4126,13 @@ async def admin_users(m: Message):
         await m.answer("Доступ запрещен", reply_markup=main_menu(user_id))
         return
 
-    total_users = len(storage.users)
+    total_users = storage.count_users()
     recent_users = []
     inactive_users_list = []
 
     now = datetime.now()
 
-    for uid, user_data in list(storage.users.items())[-10:]:
+    for uid, user_data in storage.recent_users(10):
         username = user_data.get("username", "без username")
         first_name = user_data.get("first_name", "")
         last_name = user_data.get("last_name", "")
@@ -1025,13 +4176,13 @@ async def admin_users(m: Message):
 📉 *Неактивные пользователи (более 30 дней):*
 {chr(10).join(inactive_users_list[:5]) if inactive_users_list else "• Нет неактивных пользователей"}
 
-📁 Файл с пользователями: `users.json`
-💾 Размер файла: {Path("users.json").stat().st_size if Path("users.json").exists() else 0} байт
+📁 Файл с пользователями: `{storage.USERS_FILE}`
+💾 Размер файла: {Path(storage.USERS_FILE).stat().st_size if Path(storage.USERS_FILE).exists() else 0} байт
 """
 
     await m.answer(users_text, parse_mode="Markdown", reply_markup=admin_menu())
 
-@router.message(lambda m: m.text == "📢 Рассылка")
+@menu_route("📢 Рассылка")
 async def admin_broadcast(m: Message):
     user_id = m.from_user.id
 
@@ -1039,15 +4190,63 @@ async def admin_broadcast(m: Message):
         await m.answer("Доступ запрещен", reply_markup=main_menu(user_id))
         return
 
+    summary = broadcaster.summary()
+    status_text = "Рассылок ещё не было." if summary["status"] == "idle" else broadcaster.progress_text(summary)
     await m.answer(
-        "📢 *Функция рассылки*\n\n"
-        "Эта функция находится в разработке.\n\n"
-        "Скоро вы сможете отправлять сообщения всем пользователям бота.",
-        parse_mode="Markdown",
+        "📢 Рассылка\n\n"
+        "Отправьте команду /broadcast и текст сообщения одним сообщением, например:\n"
+        "/broadcast Сегодня полнолуние — загляните в карту дня!\n\n"
+        "Перед отправкой бот покажет сообщение и попросит подтверждение.\n\n"
+        f"{status_text}",
         reply_markup=admin_menu()
     )
 
-@router.message(lambda m: m.text == "🔙 В главное меню")
+@router.message(Command("broadcast"))
+async def broadcast_command(m: Message):
+    user_id = m.from_user.id
+
+    if user_id not in ADMIN_IDS:
+        await m.answer("Доступ запрещен", reply_markup=main_menu(user_id))
+        return
+
+    parts = m.text.split(maxsplit=1)
+    text = parts[1].strip() if len(parts) > 1 else ""
+    if not text:
+        await m.answer("Напишите текст после команды: /broadcast Текст сообщения", reply_markup=admin_menu())
+        return
+    if broadcaster.summary()["status"] == "running":
+        await m.answer("Рассылка уже идёт — дождитесь окончания или остановите её.", reply_markup=admin_menu())
+        return
+
+    # Предпросмотр — ровно то сообщение, которое получат пользователи: кнопка
+    # подтверждения берёт текст из него, сколько бы процессов ни обслуживало бота
+    await m.answer(f"Предпросмотр рассылки для {storage.count_users()} пользователей:")
+    await m.answer(text, reply_markup=broadcast_confirm_menu())
+
+@router.callback_query(lambda c: c.data in ("broadcast_send", "broadcast_cancel", "broadcast_stop"))
+async def process_broadcast_action(callback: types.CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("Доступ запрещен", show_alert=True)
+        return
+
+    if callback.data == "broadcast_stop":
+        stopped = broadcaster.request_stop()
+        await callback.answer("Рассылка останавливается" if stopped else "Рассылка не идёт")
+        return
+
+    await callback.message.edit_reply_markup(reply_markup=None)
+    if callback.data == "broadcast_cancel":
+        await callback.answer("Рассылка отменена")
+        return
+
+    progress = await callback.message.answer("📢 Рассылка запускается…")
+    if broadcaster.start(callback.message.text, callback.message.chat.id, progress.message_id):
+        await callback.answer("Рассылка запущена")
+    else:
+        await progress.edit_text("Рассылка уже идёт — дождитесь окончания или остановите её.")
+        await callback.answer()
+
+@menu_route("🔙 В главное меню")
 async def back_to_main(m: Message):
     user_id = m.from_user.id
     await m.answer(
@@ -1055,9 +4254,10 @@ async def back_to_main(m: Message):
         reply_markup=main_menu(user_id)
     )
 
-@router.message(lambda m: m.text == "ℹ️ О боте")
+@menu_route("ℹ️ О боте")
 async def about_bot(m: Message):
     user_id = m.from_user.id
+    stats = storage.counters()
 
     about_text = f"""
 🌟 *Астро-нумерологический бот с AI*
@@ -1076,8 +4276,8 @@ async def about_bot(m: Message):
 Я сочетаю астрологию (знаки зодиака, стихии) и нумерологию (числа жизненного пути) с современными психологическими знаниями. Все анализы уникальны и создаются специально для вас.
 
 📊 *Статистика:*
-• Пользователей: {storage.stats["total_users"]}
-• Анализов выполнено: {storage.stats.get("calculations", 0) + storage.stats.get("compatibility_checks", 0) + storage.stats.get("horoscopes", 0)}
+• Пользователей: {stats.get("total_users", 0)}
+• Анализов выполнено: {stats.get("calculations", 0) + stats.get("compatibility_checks", 0) + stats.get("horoscopes", 0)}
 
 💡 *Совет:* Регулярно обращайтесь за анализом — звёзды и числа могут раскрывать новые грани вашего пути!
 
@@ -1090,15 +4290,14 @@ async def about_bot(m: Message):
 # MAIN ANALYZERS
 # =====================
 
-@router.message(lambda m: is_date(m.text))
 async def date_analysis_handler(m: Message):
     user_id = m.from_user.id
     date_str, birth_time = parse_date_input(m.text)
-    user_history = storage.personalization["user_history"].get(str(user_id), {"actions": []})
-    if not user_history["actions"]:
+    recent_actions = storage.recent_actions(str(user_id), 1)
+    if not recent_actions:
         await process_profile(m, date_str)
         return
-    last_action = user_history["actions"][-1]["action"]
+    last_action = recent_actions[-1]
     if "horoscope" in last_action:
         await horoscope_handler(m, date_str, last_action)
     elif last_action == "numerology_request":
@@ -1123,19 +4322,12 @@ async def process_profile(m: Message, date_str: str):
     zodiac_emoji = zodiac["emoji"] if zodiac else "🔮"
     zodiac_element = zodiac["element"] if zodiac else "не определена"
 
-    await m.answer("🔮 Составляю ваш профиль...")
-
-    storage.stats["calculations"] = storage.stats.get("calculations", 0) + 1
-    storage.stats["popular_features"]["profile"] = storage.stats["popular_features"].get("profile", 0) + 1
-    storage.stats["daily_stats"]["calculations"] = storage.stats["daily_stats"].get("calculations", 0) + 1
+    placeholder = await m.answer("🔮 Составляю ваш профиль...")
 
-    user_id_str = str(user_id)
-    if user_id_str in storage.users:
-        storage.users[user_id_str]["last_active"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        storage.users[user_id_str]["total_requests"] = storage.users[user_id_str].get("total_requests", 0) + 1
-        await storage.save_all()
-
-    storage.stats["user_last_activity"][user_id_str] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    storage.incr("calculations")
+    storage.incr("profile", bucket="popular_features")
+    metrics.incr("feature.profile")
+    storage.touch_user(str(user_id), datetime.now().strftime("%Y-%m-%d %H:%M:%S"), count_request=True)
     await storage.save_all()
 
     prompt = f"""
@@ -1186,10 +4378,9 @@ async def process_profile(m: Message, date_str: str):
 - философские рассуждения
 """
 
-    analysis = await ask_groq(prompt, "profile")
-    personalized_analysis = PersonalizationEngine.personalize_response(user_id, analysis, "profile")
-
-    final_response = f"""
+    def render(analysis: str) -> str:
+        personalized_analysis = PersonalizationEngine.personalize_response(user_id, analysis, "profile")
+        return f"""
 🔮 *Ваш профиль* 🔮
 
 {personalized_analysis}
@@ -1198,7 +4389,9 @@ async def process_profile(m: Message, date_str: str):
 📅 *Дата анализа:* {datetime.now().strftime("%d.%m.%Y")}
 """
 
-    await safe_reply(m, final_response, reply_markup=main_menu(user_id))
+    stream = LLMReplyStream(placeholder, "profile", render)
+    analysis = await ask_groq(prompt, "profile", cache_key=("profile", normalize_date(date_str)), on_text=stream.on_text)
+    await stream.finish(m, analysis, reply_markup=main_menu(user_id))
     await PersonalizationEngine.update_user_profile(user_id, "profile_analysis", {"date": date_str}, birth_date=date_str)
 
 async def process_numerology(m: Message, date_str: str):
@@ -1210,19 +4403,12 @@ async def process_numerology(m: Message, date_str: str):
     zodiac_emoji = zodiac["emoji"] if zodiac else "🔮"
     zodiac_element = zodiac["element"] if zodiac else "не определена"
 
-    await m.answer("🔢 Анализирую ваш нумерологический портрет...")
-
-    storage.stats["calculations"] = storage.stats.get("calculations", 0) + 1
-    storage.stats["popular_features"]["numerology"] = storage.stats["popular_features"].get("numerology", 0) + 1
-    storage.stats["daily_stats"]["calculations"] = storage.stats["daily_stats"].get("calculations", 0) + 1
+    placeholder = await m.answer("🔢 Анализирую ваш нумерологический портрет...")
 
-    user_id_str = str(user_id)
-    if user_id_str in storage.users:
-        storage.users[user_id_str]["last_active"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        storage.users[user_id_str]["total_requests"] = storage.users[user_id_str].get("total_requests", 0) + 1
-        await storage.save_all()
-
-    storage.stats["user_last_activity"][user_id_str] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    storage.incr("calculations")
+    storage.incr("numerology", bucket="popular_features")
+    metrics.incr("feature.numerology")
+    storage.touch_user(str(user_id), datetime.now().strftime("%Y-%m-%d %H:%M:%S"), count_request=True)
     await storage.save_all()
 
     prompt = f"""
@@ -1274,10 +4460,9 @@ async def process_numerology(m: Message, date_str: str):
 - философские рассуждения
 """
 
-    analysis = await ask_groq(prompt, "detailed")
-    personalized_analysis = PersonalizationEngine.personalize_response(user_id, analysis, "numerology")
-
-    final_response = f"""
+    def render(analysis: str) -> str:
+        personalized_analysis = PersonalizationEngine.personalize_response(user_id, analysis, "numerology")
+        return f"""
 🔢 *Ваш нумерологический портрет* 🔢
 
 {personalized_analysis}
@@ -1286,10 +4471,11 @@ async def process_numerology(m: Message, date_str: str):
 📅 *Дата анализа:* {datetime.now().strftime("%d.%m.%Y")}
 """
 
-    await safe_reply(m, final_response, reply_markup=main_menu(user_id))
+    stream = LLMReplyStream(placeholder, "numerology", render)
+    analysis = await ask_groq(prompt, "detailed", cache_key=("numerology", normalize_date(date_str)), on_text=stream.on_text)
+    await stream.finish(m, analysis, reply_markup=main_menu(user_id))
     await PersonalizationEngine.update_user_profile(user_id, "numerology_analysis", {"date": date_str}, birth_date=date_str)
 
-@router.message(lambda m: m.text and len(m.text.split()) == 2 and all("." in part for part in m.text.split()))
 async def compatibility_analysis_handler(m: Message):
     user_id = m.from_user.id
     date1, date2 = m.text.split()
@@ -1300,9 +4486,10 @@ async def compatibility_analysis_handler(m: Message):
         await m.answer("Пожалуйста, введите даты в правильном формате: ДД.ММ.ГГГГ ДД.ММ.ГГГГ")
         return
 
-    await m.answer("💞 Анализирую совместимость...")
+    placeholder = await m.answer("💞 Анализирую совместимость...")
 
-    storage.stats["compatibility_checks"] = storage.stats.get("compatibility_checks", 0) + 1
+    storage.incr("compatibility_checks")
+    metrics.incr("feature.compatibility")
     await storage.save_all()
 
     life1 = NumerologyFeatures.calculate_life_path_number(date1)
@@ -1360,10 +4547,9 @@ async def compatibility_analysis_handler(m: Message):
 - слова «карма», «вселенная», «потоки»
 """
 
-    analysis = await ask_groq(prompt, "compatibility")
-    personalized_analysis = PersonalizationEngine.personalize_response(user_id, analysis, "compatibility")
-
-    final_response = f"""
+    def render(analysis: str) -> str:
+        personalized_analysis = PersonalizationEngine.personalize_response(user_id, analysis, "compatibility")
+        return f"""
 💞 *Анализ совместимости* 💞
 
 *{z1_emoji} {z1_name} (путь {life1}) + {z2_emoji} {z2_name} (путь {life2})*
@@ -1373,67 +4559,63 @@ async def compatibility_analysis_handler(m: Message):
 *{z1_emoji} {z1_name} | Число пути: {life1}*
 *{z2_emoji} {z2_name} | Число пути: {life2}*
 """
-    await safe_reply(m, final_response, reply_markup=main_menu(user_id))
-    await PersonalizationEngine.update_user_profile(user_id, "compatibility_analysis", {"dates": [date1, date2]})
 
-async def horoscope_handler(m: Message, date_str: str, last_action: str):
-    user_id = m.from_user.id
+    stream = LLMReplyStream(placeholder, "compatibility", render)
+    analysis = await ask_groq(
+        prompt,
+        "compatibility",
+        cache_key=("compatibility", normalize_date(date1), normalize_date(date2)),
+        on_text=stream.on_text,
+    )
+    await stream.finish(m, analysis, reply_markup=main_menu(user_id))
+    await PersonalizationEngine.update_user_profile(user_id, "compatibility_analysis", {"dates": [date1, date2]})
 
-    if "_" in last_action:
-        h_type = last_action.split("_")[1]
-    else:
-        h_type = "today"
+def match_text_route(m: Message):
+    """Фильтр: находит обработчик текста и передаёт его в text_router"""
+    handler = resolve_text_route(m.text)
+    return {"route": handler} if handler is not None else False
 
-    type_names = {
-        "today": "сегодня",
-        "tomorrow": "завтра",
-        "week": "неделю",
-        "month": "месяц"
-    }
+@router.message(match_text_route)
+async def text_router(m: Message, route):
+    await route(m)
 
-    period_display = type_names.get(h_type, "сегодня")
-    today = datetime.now()
+HOROSCOPE_TYPE_NAMES = {
+    "today": "сегодня",
+    "tomorrow": "завтра",
+    "week": "неделю",
+    "month": "месяц"
+}
 
-    if h_type == "today":
-        target_date = today
-        date_description = today.strftime('%d.%m.%Y')
-    elif h_type == "tomorrow":
-        target_date = today + timedelta(days=1)
-        date_description = target_date.strftime('%d.%m.%Y')
+def horoscope_window(h_type: str, today: datetime) -> tuple:
+    """Начало, конец и текстовое описание периода гороскопа"""
+    if h_type == "tomorrow":
+        target_date_start = target_date_end = today + timedelta(days=1)
     elif h_type == "week":
         target_date_start = today
         target_date_end = today + timedelta(days=6)
-        date_description = f"{target_date_start.strftime('%d.%m.%Y')} – {target_date_end.strftime('%d.%m.%Y')}"
     elif h_type == "month":
-        year = today.year
-        month = today.month
-        target_date_start = datetime(year, month, 1)
-        if month == 12:
-            target_date_end = datetime(year + 1, 1, 1) - timedelta(days=1)
-        else:
-            target_date_end = datetime(year, month + 1, 1) - timedelta(days=1)
-        date_description = f"{target_date_start.strftime('%d.%m.%Y')} – {target_date_end.strftime('%d.%m.%Y')}"
+        target_date_start = datetime(today.year, today.month, 1)
+        target_date_end = (target_date_start + timedelta(days=32)).replace(day=1) - timedelta(days=1)
     else:
-        target_date = today
-        date_description = today.strftime('%d.%m.%Y')
+        target_date_start = target_date_end = today
 
-    await m.answer(f"♈ Создаю гороскоп на {period_display}...")
-
-    storage.stats["horoscopes"] = storage.stats.get("horoscopes", 0) + 1
-    await storage.save_all()
+    if h_type in ("week", "month"):
+        date_description = f"{target_date_start.strftime('%d.%m.%Y')} – {target_date_end.strftime('%d.%m.%Y')}"
+    else:
+        date_description = target_date_start.strftime('%d.%m.%Y')
+    return target_date_start, target_date_end, date_description
 
-    life_number = NumerologyFeatures.calculate_life_path_number(date_str)
-    zodiac = get_zodiac_sign(date_str)
-    zodiac_name = zodiac["name"] if zodiac else "не определён"
-    zodiac_emoji = zodiac["emoji"] if zodiac else "🔮"
-    zodiac_element = zodiac["element"] if zodiac else "не определена"
-    period_header = f"{period_display.capitalize()} ({date_description})"
+def build_horoscope_prompt(h_type: str, zodiac_name: str, zodiac_element: str, life_number: Optional[int],
+                           target_date_start: datetime, target_date_end: datetime, date_description: str) -> str:
+    """Промпт гороскопа. Зависит только от знака, числа пути и периода,
+    поэтому один текст подходит всем с таким сочетанием."""
+    period_header = f"{HOROSCOPE_TYPE_NAMES[h_type].capitalize()} ({date_description})"
 
     if h_type in ["today", "tomorrow"]:
         prompt = f"""
 Ты — профессиональный астро-нумеролог-консультант премиум-уровня.
 
-Создай персональный гороскоп на {period_header} для человека, родившегося {date_str}.
+Создай персональный гороскоп на {period_header}.
 Знак зодиака: {zodiac_name} (стихия: {zodiac_element}).
 Число жизненного пути: {life_number if life_number else 'не определено'} (это ПОСТОЯННОЕ число на всю жизнь, рассчитанное из даты рождения — оно НЕ меняется по годам).
 
@@ -1479,7 +4661,7 @@ async def horoscope_handler(m: Message, date_str: str, last_action: str):
         prompt = f"""
 Ты — профессиональный астро-нумеролог-консультант премиум-уровня.
 
-Создай персональный гороскоп на неделю ({date_description}) для человека, родившегося {date_str}.
+Создай персональный гороскоп на неделю ({date_description}).
 Знак зодиака: {zodiac_name} (стихия: {zodiac_element}).
 Число жизненного пути: {life_number if life_number else 'не определено'} (постоянное число на всю жизнь, НЕ меняется по годам).
 
@@ -1516,7 +4698,7 @@ async def horoscope_handler(m: Message, date_str: str, last_action: str):
         prompt = f"""
 Ты — профессиональный астро-нумеролог-консультант премиум-уровня.
 
-Создай персональный гороскоп на месяц ({date_description}) для человека, родившегося {date_str}.
+Создай персональный гороскоп на месяц ({date_description}).
 Знак зодиака: {zodiac_name} (стихия: {zodiac_element}).
 Число жизненного пути: {life_number if life_number else 'не определено'} (постоянное число на всю жизнь, НЕ меняется по годам).
 
@@ -1551,9 +4733,42 @@ async def horoscope_handler(m: Message, date_str: str, last_action: str):
 - философские рассуждения
 """
 
-    horoscope = await ask_groq(prompt, "horoscope")
+    return prompt
 
-    final_response = f"""
+async def horoscope_handler(m: Message, date_str: str, last_action: str):
+    user_id = m.from_user.id
+
+    if "_" in last_action:
+        h_type = last_action.split("_")[1]
+    else:
+        h_type = "today"
+    if h_type not in HOROSCOPE_TYPE_NAMES:
+        h_type = "today"
+
+    period_display = HOROSCOPE_TYPE_NAMES[h_type]
+    today = datetime.now()
+    target_date_start, target_date_end, date_description = horoscope_window(h_type, today)
+
+    placeholder = await m.answer(f"♈ Создаю гороскоп на {period_display}...")
+
+    storage.incr("horoscopes")
+    metrics.incr("feature.horoscope")
+    await storage.save_all()
+
+    life_number = NumerologyFeatures.calculate_life_path_number(date_str)
+    zodiac = get_zodiac_sign(date_str)
+    zodiac_name = zodiac["name"] if zodiac else "не определён"
+    zodiac_emoji = zodiac["emoji"] if zodiac else "🔮"
+    zodiac_element = zodiac["element"] if zodiac else "не определена"
+    period_header = f"{period_display.capitalize()} ({date_description})"
+
+    prompt = build_horoscope_prompt(
+        h_type, zodiac_name, zodiac_element, life_number,
+        target_date_start, target_date_end, date_description,
+    )
+
+    def render(horoscope: str) -> str:
+        return f"""
 ♈ *Ваш персональный гороскоп* ♈
 *{zodiac_emoji} {zodiac_name} | Число пути: {life_number}*
 *На {period_header}*
@@ -1563,7 +4778,10 @@ async def horoscope_handler(m: Message, date_str: str, last_action: str):
 📅 *Дата создания гороскопа:* {today.strftime("%d.%m.%Y %H:%M")}
 """
 
-    await safe_reply(m, final_response, reply_markup=main_menu(user_id))
+    stream = LLMReplyStream(placeholder, f"horoscope_{h_type}", render)
+    horoscope = await get_period_text(f"horoscope_{h_type}", zodiac_name, life_number, date_description, prompt,
+                                      on_text=stream.on_text)
+    await stream.finish(m, horoscope, reply_markup=main_menu(user_id))
     await PersonalizationEngine.update_user_profile(user_id, f"horoscope_generated_{h_type}", {"date": date_str, "period": h_type}, birth_date=date_str)
 
 async def natal_chart_handler(m: Message, date_str: str, birth_time: str = None):
@@ -1577,7 +4795,8 @@ async def natal_chart_handler(m: Message, date_str: str, birth_time: str = None)
     today = datetime.now().strftime("%d.%m.%Y")
 
     time_info = f"Время рождения: {birth_time}" if birth_time else "Время рождения: не указано (Асцендент и дома определить невозможно)"
-    await m.answer("🌌 Составляю вашу натальную карту...")
+    placeholder = await m.answer("🌌 Составляю вашу натальную карту...")
+    metrics.incr("feature.natal")
 
     prompt = f"""
 Составь натальный портрет для человека. Обращайся на «вы» (НИКОГДА не «он», «она», «его», «её»).
@@ -1622,9 +4841,8 @@ async def natal_chart_handler(m: Message, date_str: str, birth_time: str = None)
 Объём: 250–350 слов.
 """
 
-    response = await ask_groq(prompt, "natal")
-
-    final_text = f"""
+    def render(response: str) -> str:
+        return f"""
 🌌 *Ваша натальная карта* 🌌
 *{zodiac_emoji} {zodiac_name} | Число пути: {life_number}*
 {"*Время рождения: " + birth_time + "*" if birth_time else ""}
@@ -1633,28 +4851,18 @@ async def natal_chart_handler(m: Message, date_str: str, birth_time: str = None)
 
 📅 *Дата составления:* {today}
 """
-    await safe_reply(m, final_text, reply_markup=main_menu(user_id))
-    await PersonalizationEngine.update_user_profile(user_id, "natal_chart_generated", {"date": date_str}, birth_date=date_str)
-
-async def daily_card_handler(m: Message, date_str: str):
-    user_id = m.from_user.id
-    life_number = NumerologyFeatures.calculate_life_path_number(date_str)
-    zodiac = get_zodiac_sign(date_str)
-    zodiac_name = zodiac["name"] if zodiac else "не определён"
-    zodiac_emoji = zodiac["emoji"] if zodiac else "🔮"
-    zodiac_element = zodiac["element"] if zodiac else "не определена"
-    today = datetime.now().strftime("%d.%m.%Y")
 
-    await m.answer("✨ Составляю карту дня...")
-
-    storage.stats["daily_cards"] = storage.stats.get("daily_cards", 0) + 1
-    await storage.save_all()
+    stream = LLMReplyStream(placeholder, "natal", render)
+    response = await ask_groq(prompt, "natal", cache_key=("natal", normalize_date(date_str)), on_text=stream.on_text)
+    await stream.finish(m, response, reply_markup=main_menu(user_id))
+    await PersonalizationEngine.update_user_profile(user_id, "natal_chart_generated", {"date": date_str}, birth_date=date_str)
 
+def build_daily_card_prompt(zodiac_name: str, zodiac_element: str, life_number: Optional[int], today_str: str) -> str:
+    """Промпт карты дня: зависит только от знака, числа пути и даты"""
     prompt = f"""
-Составь карту дня на СЕГОДНЯ ({today}). Обращайся на «вы».
+Составь карту дня на СЕГОДНЯ ({today_str}). Обращайся на «вы».
 
 Данные человека:
-- Дата рождения: {date_str}
 - Солнце: {zodiac_name} (стихия: {zodiac_element})
 - Число жизненного пути: {life_number}
 
@@ -1675,7 +4883,7 @@ async def daily_card_handler(m: Message, date_str: str):
 
 💬 — Общение и отношения: как строить взаимодействие сегодня. 1–2 предложения.
 
-🎯 — Число дня: нумерологическое число даты {today} (сумма цифр до однозначного) и как его использовать.
+🎯 — Число дня: нумерологическое число даты {today_str} (сумма цифр до однозначного) и как его использовать.
 
 ✨ — Аффирмация дня: одно предложение от первого лица («я»), не более 15 слов.
 
@@ -1689,19 +4897,505 @@ async def daily_card_handler(m: Message, date_str: str):
 - «вселенная», «карма», «потоки»
 - общие фразы и абстрактная философия
 """
+    return prompt
+
+async def daily_card_handler(m: Message, date_str: str):
+    user_id = m.from_user.id
+    life_number = NumerologyFeatures.calculate_life_path_number(date_str)
+    zodiac = get_zodiac_sign(date_str)
+    zodiac_name = zodiac["name"] if zodiac else "не определён"
+    zodiac_emoji = zodiac["emoji"] if zodiac else "🔮"
+    zodiac_element = zodiac["element"] if zodiac else "не определена"
+    today = datetime.now().strftime("%d.%m.%Y")
+
+    placeholder = await m.answer("✨ Составляю карту дня...")
 
-    response = await ask_groq(prompt, "horoscope")
+    storage.incr("daily_cards")
+    metrics.incr("feature.daily_card")
+    await storage.save_all()
+
+    prompt = build_daily_card_prompt(zodiac_name, zodiac_element, life_number, today)
 
-    final_text = f"""
+    def render(response: str) -> str:
+        return f"""
 ✨ *Карта дня* ✨
 *{zodiac_emoji} {zodiac_name} | Число пути: {life_number}*
 *{today}*
 
 {response}
 """
-    await safe_reply(m, final_text, reply_markup=main_menu(user_id))
+
+    stream = LLMReplyStream(placeholder, "daily_card", render)
+    response = await get_period_text("daily_card", zodiac_name, life_number, today, prompt, on_text=stream.on_text)
+    await stream.finish(m, response, reply_markup=main_menu(user_id))
     await PersonalizationEngine.update_user_profile(user_id, "daily_card_generated", {"date": date_str}, birth_date=date_str)
 
+# =====================
+# PRECOMPUTED HOROSCOPES
+# =====================
+
+LIFE_PATH_NUMBERS = (1, 2, 3, 4, 5, 6, 7, 8, 9, 11, 22, 33)
+
+class PrecomputedTexts:
+    """Заранее сгенерированные гороскопы и карты дня.
+
+    Тексты зависят только от знака зодиака, числа пути и периода, поэтому
+    на каждый период хватает 12 × 12 = 144 сочетаний. Таблица хранится в
+    файле, чтобы после перезапуска не генерировать её заново.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._texts: Dict[str, str] = {}
+        if Path(path).exists():
+            try:
+                self._texts = json.loads(Path(path).read_text(encoding="utf-8"))
+            except json.JSONDecodeError:
+                logger.error("Corrupted %s, using default", path)
+
+    @staticmethod
+    def _key(kind: str, zodiac_name: str, life_number: Optional[int], window: str) -> str:
+        return f"{kind}|{zodiac_name}|{life_number}|{window}"
+
+    def get(self, kind: str, zodiac_name: str, life_number: Optional[int], window: str) -> Optional[str]:
+        return self._texts.get(self._key(kind, zodiac_name, life_number, window))
+
+    def put(self, kind: str, zodiac_name: str, life_number: Optional[int], window: str, text: str):
+        self._texts[self._key(kind, zodiac_name, life_number, window)] = text
+
+    def prune(self, windows: set):
+        """Удаляет тексты за прошедшие периоды; windows — множество (вид, окно)"""
+        for key in list(self._texts):
+            kind, _, _, window = key.split("|", 3)
+            if (kind, window) not in windows:
+                del self._texts[key]
+
+    def save(self):
+        atomic_write(self.path, json.dumps(self._texts, ensure_ascii=False).encode("utf-8"))
+
+    def __len__(self) -> int:
+        return len(self._texts)
+
+precomputed_texts = PrecomputedTexts(PRECOMPUTE_FILE)
+
+async def get_period_text(kind: str, zodiac_name: str, life_number: Optional[int], window: str, prompt: str,
+                          on_text=None) -> str:
+    """Текст гороскопа или карты дня: из готовой таблицы, иначе — живая генерация"""
+    text = precomputed_texts.get(kind, zodiac_name, life_number, window)
+    if text is not None:
+        return text
+    return await ask_groq(prompt, "horoscope", cache_key=(kind, zodiac_name, life_number, window), on_text=on_text)
+
+def precompute_targets(now: datetime):
+    """Все тексты текущих периодов: (вид, знак, число пути, окно, промпт)"""
+    signs = {name: element for _, _, name, _, element, _ in ZODIAC_SIGNS}
+    today_str = now.strftime("%d.%m.%Y")
+    windows = {h_type: horoscope_window(h_type, now) for h_type in HOROSCOPE_TYPE_NAMES}
+    for zodiac_name, zodiac_element in signs.items():
+        for life_number in LIFE_PATH_NUMBERS:
+            for h_type, (start, end, window) in windows.items():
+                prompt = build_horoscope_prompt(h_type, zodiac_name, zodiac_element, life_number, start, end, window)
+                yield f"horoscope_{h_type}", zodiac_name, life_number, window, prompt
+            prompt = build_daily_card_prompt(zodiac_name, zodiac_element, life_number, today_str)
+            yield "daily_card", zodiac_name, life_number, today_str, prompt
+
+async def precompute_texts(now: Optional[datetime] = None) -> int:
+    """Генерирует недостающие тексты текущих периодов с ограниченным параллелизмом"""
+    targets = list(precompute_targets(now or datetime.now()))
+    precomputed_texts.prune({(kind, window) for kind, _, _, window, _ in targets})
+    missing = [t for t in targets if precomputed_texts.get(*t[:4]) is None]
+    semaphore = asyncio.Semaphore(PRECOMPUTE_CONCURRENCY)
+
+    async def generate(kind: str, zodiac_name: str, life_number: int, window: str, prompt: str) -> bool:
+        async with semaphore:
+            text = await ask_groq(prompt, "horoscope", cache_key=(kind, zodiac_name, life_number, window),
+                                  priority=PRIORITY_BACKGROUND)
+        if text == GROQ_ERROR_TEXT:
+            return False
+        precomputed_texts.put(kind, zodiac_name, life_number, window, text)
+        return True
+
+    started = time.perf_counter()
+    generated = sum(await asyncio.gather(*(generate(*t) for t in missing)))
+    await asyncio.to_thread(precomputed_texts.save)
+    logger.info(
+        "PRECOMPUTE: сгенерировано %s из %s недостающих текстов за %.1f с (всего %s)",
+        generated, len(missing), time.perf_counter() - started, len(precomputed_texts),
+    )
+    return generated
+
+async def precompute_loop():
+    """Сразу после старта догенерирует недостающее, затем — ежедневно в PRECOMPUTE_AT"""
+    hour, minute = map(int, PRECOMPUTE_AT.split(":"))
+    while True:
+        try:
+            await precompute_texts()
+        except Exception as e:
+            logger.error("PRECOMPUTE: ошибка: %s", e)
+        now = datetime.now()
+        next_run = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        await asyncio.sleep((next_run - now).total_seconds())
+
+# =====================
+# UPDATE QUEUE
+# =====================
+
+class RawUpdate:
+    """Обновление из вебхука: исходное тело и поля, нужные до полной валидации"""
+
+    __slots__ = ("update_id", "update_type", "chat_key", "raw")
+
+    def __init__(self, update_id: Optional[int], update_type: Optional[str], chat_key, raw: bytes):
+        self.update_id = update_id
+        self.update_type = update_type
+        self.chat_key = chat_key
+        self.raw = raw
+
+def update_chat_key(update_data: dict):
+    """Чат обновления; без чата — само обновление, порядок не важен"""
+    for field, payload in update_data.items():
+        if field == "update_id" or not isinstance(payload, dict):
+            continue
+        chat = payload.get("chat") or (payload.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return chat["id"]
+        sender = payload.get("from") or payload.get("user")
+        if sender and "id" in sender:
+            return sender["id"]
+    return ("update", update_data.get("update_id"))
+
+def decode_update(raw: bytes) -> RawUpdate:
+    """Быстрый разбор тела вебхука без валидации модели Update.
+    ValueError — тело не JSON-объект."""
+    update_data = json_loads(raw)
+    if not isinstance(update_data, dict):
+        raise ValueError("Update must be a JSON object")
+    update_type = next((field for field in update_data if field != "update_id"), None)
+    return RawUpdate(update_data.get("update_id"), update_type, update_chat_key(update_data), raw)
+
+_routed_update_types: Optional[frozenset] = None
+
+def routed_update_types() -> frozenset:
+    """Типы обновлений, для которых есть обработчики; остальные не разбираем"""
+    global _routed_update_types
+    if _routed_update_types is None:
+        _routed_update_types = frozenset(dp.resolve_used_update_types())
+    return _routed_update_types
+
+class UpdateSpool:
+    """Журнал принятых обновлений на диске.
+
+    Вебхук отвечает Telegram только после того, как обновление записано и
+    сброшено на диск; после обработки в журнал дописывается отметка done.
+    Запись групповая: пока идёт один fsync, новые строки копятся и уходят
+    следующим одним fsync, так что при нагрузке ответ вебхуку ждёт не больше
+    двух сбросов. При старте необработанные обновления возвращаются в
+    очередь — обработка «хотя бы один раз». Повторная доставка того же
+    update_id отбрасывается.
+    """
+
+    RECENT_LIMIT = 10000
+
+    def __init__(self, filename: str, compact_bytes: int):
+        self.filename = filename
+        self.enabled = bool(filename)
+        self.compact_bytes = compact_bytes
+        self.pending: "OrderedDict[int, RawUpdate]" = OrderedDict()
+        self._recent: "OrderedDict[int, None]" = OrderedDict()
+        self._buffer: List[bytes] = []
+        self._written_seq = 0
+        self._synced_seq = 0
+        self._flush_task: Optional[asyncio.Task] = None
+        self._file = None
+        self._slot_lock = None
+        self._bytes = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="spool-io")
+        self.stats = {
+            "appended": 0,
+            "done": 0,
+            "duplicates": 0,
+            "replayed": 0,
+            "fsyncs": 0,
+            "fsync_ms_total": 0.0,
+            "fsync_ms_max": 0.0,
+            "compactions": 0,
+        }
+
+    @staticmethod
+    def _encode(record: dict) -> bytes:
+        return json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+
+    @classmethod
+    def _encode_update(cls, update: "RawUpdate") -> bytes:
+        # Тело от Telegram уже JSON в одну строку — вставляем его как есть
+        if b"\n" in update.raw:
+            return cls._encode({"u": update.update_id, "r": json_loads(update.raw)})
+        return b'{"u":%d,"r":%s}\n' % (update.update_id, update.raw)
+
+    def open(self) -> List["RawUpdate"]:
+        """Читает журнал и возвращает необработанные обновления по порядку"""
+        if not self.enabled:
+            return []
+        if MULTI_WORKER:
+            # У каждого процесса свой журнал; номер слота постоянен между
+            # перезапусками, поэтому недообработанное подхватит новый процесс
+            for slot in range(WEB_CONCURRENCY):
+                self._slot_lock = try_lock_file(f"{self.filename}.{slot}.lock")
+                if self._slot_lock is not None:
+                    self.filename = f"{self.filename}.{slot}"
+                    break
+            else:
+                logger.error("Spool: no free slot among %s, spooling disabled", WEB_CONCURRENCY)
+                self.enabled = False
+                return []
+        path = Path(self.filename)
+        if path.exists():
+            with path.open("rb") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logger.warning("Spool: torn record at the end, ignoring")
+                        break
+                    if "done" in record:
+                        self.pending.pop(record["done"], None)
+                        self._remember(record["done"])
+                    elif record["u"] not in self._recent:
+                        payload = record["r"] if "r" in record else record["d"]
+                        self.pending[record["u"]] = decode_update(
+                            json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+                        )
+        self.stats["replayed"] = len(self.pending)
+        self._rewrite([self._encode_update(update) for update in self.pending.values()])
+        return list(self.pending.values())
+
+    def _rewrite(self, lines: List[bytes]):
+        if self._file is not None:
+            self._file.close()
+        data = b"".join(lines)
+        atomic_write(self.filename, data)
+        self._file = open(self.filename, "ab")
+        self._bytes = len(data)
+
+    def _remember(self, update_id: int):
+        self._recent[update_id] = None
+        if len(self._recent) > self.RECENT_LIMIT:
+            self._recent.popitem(last=False)
+
+    def seen(self, update_id: Optional[int]) -> bool:
+        """Обновление уже принято или обработано"""
+        if not self.enabled or update_id is None:
+            return False
+        if update_id in self.pending or update_id in self._recent:
+            self.stats["duplicates"] += 1
+            return True
+        return False
+
+    async def append(self, update: "RawUpdate"):
+        """Записывает обновление и ждёт, пока запись окажется на диске"""
+        update_id = update.update_id
+        if not self.enabled or update_id is None:
+            return
+        self.pending[update_id] = update
+        self._buffer.append(self._encode_update(update))
+        self._written_seq += 1
+        self.stats["appended"] += 1
+        target = self._written_seq
+        try:
+            while self._synced_seq < target:
+                await asyncio.shield(self._start_flush())
+        except Exception:
+            # Вебхук ответит ошибкой, и Telegram доставит обновление повторно
+            self.pending.pop(update_id, None)
+            raise
+
+    def mark_done(self, update: "RawUpdate"):
+        """Отметка об обработке; на диск уходит со следующим сбросом"""
+        update_id = update.update_id
+        if not self.enabled or update_id is None or self.pending.pop(update_id, None) is None:
+            return
+        self._remember(update_id)
+        self._buffer.append(self._encode({"done": update_id}))
+        self._written_seq += 1
+        self.stats["done"] += 1
+        self._start_flush()
+
+    def _start_flush(self) -> asyncio.Task:
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush())
+            # Ошибку получат ожидающие append; фоновый сброс отметок её только логирует
+            self._flush_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return self._flush_task
+
+    async def _flush(self):
+        lines: List[bytes] = []
+        try:
+            while self._buffer:
+                lines, self._buffer = self._buffer, []
+                target = self._written_seq
+                started = time.perf_counter()
+                if self._bytes > self.compact_bytes:
+                    # Журнал вырос: переписываем только ещё не обработанные обновления
+                    snapshot = [self._encode_update(update) for update in self.pending.values()]
+                    await asyncio.get_running_loop().run_in_executor(self._executor, self._rewrite, snapshot)
+                    self.stats["compactions"] += 1
+                else:
+                    await asyncio.get_running_loop().run_in_executor(self._executor, self._write, lines)
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                self.stats["fsyncs"] += 1
+                self.stats["fsync_ms_total"] += elapsed_ms
+                self.stats["fsync_ms_max"] = round(max(self.stats["fsync_ms_max"], elapsed_ms), 3)
+                self._synced_seq = target
+                lines = []
+        except Exception as e:
+            logger.error("Spool write failed: %s", e)
+            self._buffer[:0] = lines
+            raise
+        finally:
+            self._flush_task = None
+
+    def _write(self, lines: List[bytes]):
+        data = b"".join(lines)
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._bytes += len(data)
+
+    async def close(self):
+        if not self.enabled:
+            return
+        if self._flush_task is not None:
+            with contextlib.suppress(Exception):
+                await self._flush_task
+        if self._buffer:
+            with contextlib.suppress(Exception):
+                await self._start_flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._executor.shutdown(wait=True)
+
+    def summary(self) -> Dict[str, Any]:
+        fsyncs = self.stats["fsyncs"]
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "pending": len(self.pending),
+            "bytes": self._bytes,
+            "fsync_ms_avg": round(self.stats["fsync_ms_total"] / fsyncs, 3) if fsyncs else 0.0,
+        }
+
+update_spool = UpdateSpool(UPDATE_SPOOL_FILE, UPDATE_SPOOL_COMPACT_BYTES)
+
+class UpdateQueue:
+    """Очередь обновлений из вебхука с ограниченным пулом воркеров.
+
+    Обновления одного чата обрабатываются строго по порядку, разные чаты —
+    параллельно, не больше workers одновременно. Чат с ожидающими
+    обновлениями стоит в общей очереди готовых одним элементом, поэтому
+    активный пользователь не задерживает остальных. При max_depth
+    необработанных обновлений новые не принимаются. Обработанные
+    обновления отмечаются в spool.
+    """
+
+    def __init__(self, workers: int, max_depth: int, spool: Optional[UpdateSpool] = None):
+        self.workers = workers
+        self.spool = spool
+        self.max_depth = max_depth
+        self.depth = 0
+        self.accepting = False
+        self._chats: Dict[Any, deque] = {}
+        self._ready: Optional[asyncio.Queue] = None
+        self._idle: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        self.stats = {
+            "accepted": 0,
+            "rejected": 0,
+            "skipped": 0,
+            "processed": 0,
+            "max_depth_seen": 0,
+            "wait_ms_total": 0.0,
+            "wait_ms_max": 0.0,
+        }
+
+    def start(self):
+        self._ready = asyncio.Queue()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self.accepting = True
+
+    def can_accept(self) -> bool:
+        return self.accepting and self.depth < self.max_depth
+
+    def put(self, update: RawUpdate, force: bool = False) -> bool:
+        """Ставит обновление в очередь; False — очередь переполнена или остановлена.
+        force — без проверки глубины, для уже записанных в журнал обновлений."""
+        if not force and not self.can_accept():
+            self.stats["rejected"] += 1
+            return False
+        key = update.chat_key
+        pending = self._chats.get(key)
+        if pending is None:
+            pending = self._chats[key] = deque()
+            self._ready.put_nowait(key)
+        pending.append((update, time.monotonic()))
+        self.depth += 1
+        self.stats["accepted"] += 1
+        self.stats["max_depth_seen"] = max(self.stats["max_depth_seen"], self.depth)
+        self._idle.clear()
+        return True
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            pending = self._chats[key]
+            update, enqueued = pending.popleft()
+            waited_ms = (time.monotonic() - enqueued) * 1000
+            self.stats["wait_ms_total"] += waited_ms
+            self.stats["wait_ms_max"] = round(max(self.stats["wait_ms_max"], waited_ms), 3)
+            try:
+                await process_telegram_update(update)
+                if self.spool is not None:
+                    self.spool.mark_done(update)
+            finally:
+                self.depth -= 1
+                self.stats["processed"] += 1
+                if pending:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._chats[key]
+                if self.depth == 0:
+                    self._idle.set()
+
+    async def drain(self, timeout: float):
+        """Перестаёт принимать обновления и ждёт обработки уже принятых"""
+        self.accepting = False
+        if self._idle is not None:
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Update queue drain timed out, %s updates left", self.depth)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def summary(self) -> Dict[str, Any]:
+        processed = self.stats["processed"]
+        return {
+            **self.stats,
+            "workers": self.workers,
+            "max_depth": self.max_depth,
+            "depth": self.depth,
+            "chats_pending": len(self._chats),
+            "wait_ms_avg": round(self.stats["wait_ms_total"] / processed, 3) if processed else 0.0,
+        }
+
+update_queue = UpdateQueue(UPDATE_WORKERS, UPDATE_QUEUE_MAX, update_spool)
+
 # =====================
 # FASTAPI ROUTES
 # =====================
@@ -1713,13 +5407,22 @@ def verify_admin(credentials: HTTPAuthorizationCredentials = Depends(security)):
     return True
 
 @app.post(WEBHOOK_PATH)
-async def telegram_webhook(
-    request: Request,
-    background_tasks: BackgroundTasks
-):
+async def telegram_webhook(request: Request):
     """Эндпоинт для получения обновлений от Telegram"""
-    logger.info(">>> WEBHOOK HIT from %s", request.client.host if request.client else "unknown")
-
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        outcome = await accept_webhook_update(request)
+        return {"status": "ok"}
+    except HTTPException as e:
+        outcome = f"http_{e.status_code}"
+        raise
+    finally:
+        WEBHOOK_ACK_SECONDS.observe(time.perf_counter() - started, outcome)
+
+async def accept_webhook_update(request: Request) -> str:
+    """Проверяет и ставит обновление в очередь; возвращает исход для метрик.
+    Отказы — HTTPException: Telegram повторит доставку."""
     # Проверка secret_token для безопасности
     if WEBHOOK_SECRET and WEBHOOK_SECRET != "your-secret-token":
         secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token")
@@ -1727,19 +5430,46 @@ async def telegram_webhook(
             logger.warning("Webhook secret mismatch!")
             raise HTTPException(status_code=403, detail="Forbidden")
 
-    update_data = await request.json()
-    logger.info(">>> WEBHOOK update_id=%s", update_data.get("update_id", "?"))
-    background_tasks.add_task(process_telegram_update, update_data)
-
-    return {"status": "ok"}
-
-async def process_telegram_update(update_data: dict):
-    """Обработка обновления Telegram"""
+    # Модель Update валидируется уже в воркере, прямо из тела запроса
     try:
-        update = Update(**update_data)
-        await dp.feed_update(bot, update)
+        update = decode_update(await request.body())
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid update")
+    if UPDATE_LOG_SAMPLE and random.random() < UPDATE_LOG_SAMPLE:
+        logger.info(">>> WEBHOOK update_id=%s type=%s from %s", update.update_id, update.update_type,
+                    request.client.host if request.client else "unknown")
+    if update.update_type not in routed_update_types():
+        update_queue.stats["skipped"] += 1
+        return "skipped"
+    if update_spool.seen(update.update_id):
+        logger.info(">>> WEBHOOK duplicate update_id=%s, skipping", update.update_id)
+        return "duplicate"
+    if not update_queue.can_accept():
+        # Telegram повторит доставку позже
+        update_queue.stats["rejected"] += 1
+        logger.warning("Update queue is full, rejecting update_id=%s", update.update_id)
+        raise HTTPException(status_code=503, detail="Update queue is full")
+    await update_spool.append(update)
+    update_queue.put(update, force=True)
+    return "accepted"
+
+async def process_telegram_update(update: RawUpdate):
+    """Обработка обновления Telegram.
+
+    Update валидируется из исходного JSON сразу с контекстом бота: без него
+    feed_update пересоздаёт модель через model_dump, то есть валидирует дважды.
+    """
+    started = time.perf_counter()
+    metrics.incr("updates")
+    try:
+        parsed = Update.model_validate_json(update.raw, context={"bot": bot})
+        await dp.feed_update(bot, parsed)
     except Exception as e:
         logger.error(f"Error processing update: {e}")
+        metrics.incr("errors.updates")
+    elapsed = time.perf_counter() - started
+    metrics.observe("update.latency", elapsed)
+    UPDATE_HANDLE_SECONDS.observe(elapsed, update.update_type)
 
 @app.api_route("/", methods=["GET", "HEAD"])
 async def home():
@@ -1754,7 +5484,7 @@ async def health():
     return {
         "status": "healthy",
         "timestamp": datetime.now().isoformat(),
-        "users": len(storage.users),
+        "users": storage.count_users(),
         "bot": await bot.get_me() if BOT_TOKEN else "not_configured"
     }
 
@@ -1779,12 +5509,15 @@ async def debug_webhook():
 @limiter.limit("10/minute")
 async def admin_panel(request: Request, _: bool = Depends(verify_admin)):
     """Веб-админка"""
-    active_users, inactive_users = calculate_active_users()
+    report = storage.activity_report(datetime.now())
+    active_users, inactive_users = report["active_users"], report["inactive_users"]
+    today = metrics_digest()["today"]
+    stats = storage.counters()
     total_analyses = (
-        storage.stats.get("calculations", 0) +
-        storage.stats.get("compatibility_checks", 0) +
-        storage.stats.get("forecasts", 0) +
-        storage.stats.get("horoscopes", 0)
+        stats.get("calculations", 0) +
+        stats.get("compatibility_checks", 0) +
+        stats.get("forecasts", 0) +
+        stats.get("horoscopes", 0)
     )
 
     return f"""
@@ -1820,22 +5553,24 @@ async def admin_panel(request: Request, _: bool = Depends(verify_admin)):
                 <div class="grid">
                     <div class="card">
                         <h3>👥 Пользователи</h3>
-                        <p><strong>Всего:</strong> {storage.stats.get('total_users', 0)}</p>
+                        <p><strong>Всего:</strong> {stats.get('total_users', 0)}</p>
                         <p><strong>Активных:</strong> {active_users}</p>
                         <p><strong>Неактивных:</strong> {inactive_users}</p>
                     </div>
                     <div class="card">
                         <h3>📈 Анализы</h3>
                         <p><strong>Всего анализов:</strong> {total_analyses}</p>
-                        <p><strong>Портретов:</strong> {storage.stats.get('calculations', 0)}</p>
-                        <p><strong>Совместимостей:</strong> {storage.stats.get('compatibility_checks', 0)}</p>
-                        <p><strong>Прогнозов:</strong> {storage.stats.get('forecasts', 0)}</p>
-                        <p><strong>Гороскопов:</strong> {storage.stats.get('horoscopes', 0)}</p>
+                        <p><strong>Портретов:</strong> {stats.get('calculations', 0)}</p>
+                        <p><strong>Совместимостей:</strong> {stats.get('compatibility_checks', 0)}</p>
+                        <p><strong>Прогнозов:</strong> {stats.get('forecasts', 0)}</p>
+                        <p><strong>Гороскопов:</strong> {stats.get('horoscopes', 0)}</p>
                     </div>
                     <div class="card">
                         <h3>📅 Сегодня</h3>
-                        <p><strong>Новых пользователей:</strong> {storage.stats.get('daily_stats', {}).get('new_users', 0)}</p>
-                        <p><strong>Анализов вполнено:</strong> {storage.stats.get('daily_stats', {}).get('calculations', 0)}</p>
+                        <p><strong>Новых пользователей:</strong> {int(today.get('new_users', 0))}</p>
+                        <p><strong>Анализов вполнено:</strong> {feature_total(today)}</p>
+                        <p><strong>Запросов к AI:</strong> {int(today.get('llm.calls', 0))}</p>
+                        <p><strong>Ошибок:</strong> {int(today.get('errors.llm', 0) + today.get('errors.updates', 0))}</p>
                         <p><strong>Дата:</strong> {datetime.now().strftime("%d.%m.%Y")}</p>
                     </div>
                 </div>
@@ -1853,9 +5588,9 @@ async def admin_panel(request: Request, _: bool = Depends(verify_admin)):
 
             <div class="stats">
                 <h2>📁 Файлы данных:</h2>
-                <p><a href="/api/admin/users" class="file-link" target="_blank">users.json</a> ({len(storage.users)} пользователей)</p>
+                <p><a href="/api/admin/export/users.csv" class="file-link">users.csv</a> ({storage.count_users()} пользователей)</p>
+                <p><a href="/api/admin/export/users.ndjson?include_history=true" class="file-link">users.ndjson</a> (с историей)</p>
                 <p><a href="/api/admin/stats" class="file-link" target="_blank">stats.json</a></p>
-                <p><a href="/api/admin/personalization" class="file-link" target="_blank">personalization.json</a></p>
             </div>
 
             <div class="stats">
@@ -1868,61 +5603,91 @@ async def admin_panel(request: Request, _: bool = Depends(verify_admin)):
     </html>
     """
 
+EXPORT_PAGE_SIZE = 1000  # пользователей на страницу и на кусок потоковой выгрузки
+EXPORT_CSV_COLUMNS = ("user_id", "username", "first_name", "last_name", "joined", "last_active", "total_requests",
+                      "unreachable")
+
+def user_query(status: Optional[str] = None, joined_from: Optional[date] = None, joined_to: Optional[date] = None,
+               inactive_days: int = 30) -> UserQuery:
+    """Фильтр из параметров запроса; joined_to включительно"""
+    if status is not None and status not in USER_STATUSES:
+        raise HTTPException(status_code=400, detail=f"status must be one of {', '.join(USER_STATUSES)}")
+    return UserQuery(
+        status=status,
+        since=datetime(joined_from.year, joined_from.month, joined_from.day) if joined_from else None,
+        until=datetime(joined_to.year, joined_to.month, joined_to.day) + timedelta(days=1) if joined_to else None,
+        days=inactive_days,
+    )
+
+async def iter_user_pages(query: UserQuery, page_size: int = EXPORT_PAGE_SIZE):
+    """Страницы (пользователи) по курсору; между страницами event loop свободен"""
+    cursor = 0
+    while True:
+        items, cursor = storage.users_page(cursor, page_size, query)
+        if items:
+            yield items
+        if cursor is None:
+            return
+        await asyncio.sleep(0)
+
 @app.get("/admin/full_report")
 @limiter.limit("10/minute")
 async def admin_full_report(request: Request, _: bool = Depends(verify_admin)):
-    """Полный отчет по пользователям"""
-    report = []
+    """Полный отчет по пользователям — отдаётся потоком по страницам"""
     now = datetime.now()
 
-    report.append("📊 ПОЛНЫЙ ОТЧЕТ ПО ПОЛЬЗОВАТЕЛЯМ")
-    report.append(f"Дата генерации: {now.strftime('%d.%m.%Y %H:%M:%S')}")
-    report.append(f"Всего пользователей: {len(storage.users)}")
-    report.append("=" * 50)
-
-    active_count = 0
-    inactive_count = 0
-
-    for uid, user_data in sorted(storage.users.items(), key=lambda x: x[1].get("joined", "")):
-        username = user_data.get("username", "без username")
-        first_name = user_data.get("first_name", "")
-        last_name = user_data.get("last_name", "")
-        name = f"{first_name} {last_name}".strip() or f"User{uid[-6:]}"
-        joined = user_data.get("joined", "неизвестно")
-        last_active = user_data.get("last_active", "никогда")
-        total_requests = user_data.get("total_requests", 0)
-
-        status = "НЕТ ДАННЫХ"
-        try:
-            if last_active != "никогда":
-                last_active_dt = datetime.strptime(last_active, "%Y-%m-%d %H:%M:%S")
-                days_inactive = (now - last_active_dt).days
-                if days_inactive <= 7:
-                    status = "АКТИВЕН"
-                    active_count += 1
-                elif days_inactive <= 30:
-                    status = "ДАВНО"
-                    active_count += 1
+    async def report():
+        yield "<pre>" + "\n".join([
+            "📊 ПОЛНЫЙ ОТЧЕТ ПО ПОЛЬЗОВАТЕЛЯМ",
+            f"Дата генерации: {now.strftime('%d.%m.%Y %H:%M:%S')}",
+            f"Всего пользователей: {storage.count_users()}",
+            "=" * 50,
+        ]) + "\n"
+
+        active_count = 0
+        inactive_count = 0
+        now_ts = to_epoch(now)
+
+        async for items in iter_user_pages(UserQuery(now=now)):
+            lines = []
+            for uid, user_data in items:
+                username = user_data.get("username", "без username")
+                first_name = user_data.get("first_name", "")
+                last_name = user_data.get("last_name", "")
+                name = f"{first_name} {last_name}".strip() or f"User{uid[-6:]}"
+                joined = user_data.get("joined", "неизвестно")
+                last_active = user_data.get("last_active", "никогда")
+                total_requests = user_data.get("total_requests", 0)
+
+                last_active_ts = parse_timestamp(last_active)
+                if last_active == "никогда":
+                    status = "НЕТ АКТИВНОСТИ"
+                elif last_active_ts is None:
+                    status = "ОШИБКА ДАННЫХ"
                 else:
-                    status = f"НЕАКТИВЕН ({days_inactive} дней)"
-                    inactive_count += 1
-            else:
-                status = "НЕТ АКТИВНОСТИ"
-        except:
-            status = "ОШИБКА ДАННЫХ"
-
-        user_line = f"👤 ID: {uid} | {name} | @{username}"
-        user_line += f"\n   📅 Регистрация: {joined}"
-        user_line += f"\n   ⏱️ Последняя активность: {last_active}"
-        user_line += f"\n   📊 Запросов: {total_requests} | Статус: {status}"
-        user_line += f"\n   {'─'*40}"
-
-        report.append(user_line)
-
-    report.append("=" * 50)
-    report.append(f"ИТОГО: Активных: {active_count} | Неактивных: {inactive_count}")
-
-    return HTMLResponse(content="<pre>" + "\n".join(report) + "</pre>")
+                    days_inactive = int((now_ts - last_active_ts) // DAY_SECONDS)
+                    if days_inactive <= 7:
+                        status = "АКТИВЕН"
+                        active_count += 1
+                    elif days_inactive <= 30:
+                        status = "ДАВНО"
+                        active_count += 1
+                    else:
+                        status = f"НЕАКТИВЕН ({days_inactive} дней)"
+                        inactive_count += 1
+
+                user_line = f"👤 ID: {uid} | {name} | @{username}"
+                user_line += f"\n   📅 Регистрация: {joined}"
+                user_line += f"\n   ⏱️ Последняя активность: {last_active}"
+                user_line += f"\n   📊 Запросов: {total_requests} | Статус: {status}"
+                user_line += f"\n   {'─'*40}"
+
+                lines.append(user_line)
+            yield "\n".join(lines) + "\n"
+
+        yield "=" * 50 + "\n" + f"ИТОГО: Активных: {active_count} | Неактивных: {inactive_count}" + "</pre>"
+
+    return StreamingResponse(report(), media_type="text/html; charset=utf-8")
 
 # =====================
 # API ENDPOINTS
@@ -1932,30 +5697,189 @@ async def admin_full_report(request: Request, _: bool = Depends(verify_admin)):
 @limiter.limit("30/minute")
 async def get_stats_api(request: Request):
     """API для получения статистики"""
-    active_users, inactive_users = calculate_active_users()
-    storage.stats["active_users"] = active_users
-    storage.stats["inactive_users"] = inactive_users
-    await storage.save_all()
+    # Только чтение: активность считается по индексу, на диск ничего не пишется
+    report = storage.activity_report(datetime.now())
+    today = metrics_digest()["today"]
+    return {
+        **storage.export_stats(),
+        "active_users": report["active_users"],
+        "inactive_users": report["inactive_users"],
+        "daily_stats": {"new_users": int(today.get("new_users", 0)), "calculations": feature_total(today)},
+    }
+
+@app.get("/api/admin/analytics")
+@limiter.limit("30/minute")
+async def get_analytics_api(request: Request, _: bool = Depends(verify_admin)):
+    """Активность, регистрации по месяцам и годам, распределение по дням без активности"""
+    return storage.activity_report(datetime.now())
+
+@app.get("/api/admin/metrics")
+@limiter.limit("30/minute")
+async def get_metrics_api(request: Request, resolution: str = "hour", buckets: int = 24,
+                          _: bool = Depends(verify_admin)):
+    """Ряды метрик: resolution — minute | hour | day, buckets — число последних бакетов"""
+    sizes = {name: size for name, _, size in METRIC_RESOLUTIONS}
+    if resolution not in sizes:
+        raise HTTPException(status_code=400, detail=f"resolution must be one of {', '.join(sizes)}")
+    buckets = max(1, min(buckets, sizes[resolution]))
+    now = datetime.now()
+    totals = metrics.totals(resolution, buckets, now)
+    return {
+        "resolution": resolution,
+        "bucket_seconds": METRIC_WIDTHS[resolution],
+        "first_bucket_start": (metrics.current_bucket(resolution, now) - buckets + 1) * METRIC_WIDTHS[resolution],
+        "totals": totals,
+        "series": {name: metrics.series(name, resolution, buckets, now) for name in sorted(totals)},
+        "digest": metrics_digest(now),
+    }
 
-    return storage.stats
+@app.get("/api/admin/broadcast")
+@limiter.limit("60/minute")
+async def get_broadcast_api(request: Request, _: bool = Depends(verify_admin)):
+    """Ход текущей или итог последней рассылки: доставка, скорость, ETA"""
+    return broadcaster.summary()
 
 @app.get("/api/admin/users")
+@limiter.limit("120/minute")
+async def get_users_api(request: Request, cursor: int = 0, limit: int = 100,
+                        query: UserQuery = Depends(user_query), _: bool = Depends(verify_admin)):
+    """Пользователи постранично в порядке регистрации.
+    Следующая страница — с cursor=next_cursor; null — страниц больше нет."""
+    items, next_cursor = storage.users_page(cursor, max(1, min(limit, EXPORT_PAGE_SIZE)), query)
+    return {"items": [{"user_id": uid, **user} for uid, user in items], "next_cursor": next_cursor}
+
+@app.get("/api/admin/export/users.ndjson")
+@limiter.limit("10/minute")
+async def export_users_ndjson(request: Request, include_history: bool = False,
+                              query: UserQuery = Depends(user_query), _: bool = Depends(verify_admin)):
+    """Все подходящие пользователи потоком: одна JSON-строка на пользователя"""
+    async def rows():
+        async for items in iter_user_pages(query):
+            histories = storage.user_histories([uid for uid, _ in items]) if include_history else {}
+            chunk = []
+            for uid, user in items:
+                row = {"user_id": uid, **user}
+                if include_history:
+                    row["history"] = histories.get(uid)
+                chunk.append(json.dumps(row, ensure_ascii=False))
+            yield "\n".join(chunk) + "\n"
+
+    return StreamingResponse(rows(), media_type="application/x-ndjson",
+                             headers={"Content-Disposition": 'attachment; filename="users.ndjson"'})
+
+@app.get("/api/admin/export/users.csv")
 @limiter.limit("10/minute")
-async def get_users_api(request: Request, _: bool = Depends(verify_admin)):
-    """API для получения пользователей"""
-    return storage.users
+async def export_users_csv(request: Request, query: UserQuery = Depends(user_query),
+                           _: bool = Depends(verify_admin)):
+    """Все подходящие пользователи потоком в CSV"""
+    async def rows():
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, EXPORT_CSV_COLUMNS, extrasaction="ignore")
+        writer.writeheader()
+        async for items in iter_user_pages(query):
+            writer.writerows({"user_id": uid, **user} for uid, user in items)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
+
+    return StreamingResponse(rows(), media_type="text/csv; charset=utf-8",
+                             headers={"Content-Disposition": 'attachment; filename="users.csv"'})
 
 @app.get("/api/admin/stats")
 @limiter.limit("10/minute")
 async def get_stats_raw_api(request: Request, _: bool = Depends(verify_admin)):
     """API для получения сырой статистики"""
-    return storage.stats
+    return storage.export_stats()
+
+@app.get("/api/admin/storage")
+@limiter.limit("30/minute")
+async def get_storage_api(request: Request, _: bool = Depends(verify_admin)):
+    """API для метрик хранилища: длительность и объём сбросов на диск.
+    При WEB_CONCURRENCY > 1 метрики относятся к ответившему процессу."""
+    return {"backend": type(storage).__name__, "worker_pid": os.getpid(), **storage.flush_stats}
+
+@app.get("/api/admin/updates")
+@limiter.limit("30/minute")
+async def get_updates_api(request: Request, _: bool = Depends(verify_admin)):
+    """API для очереди обновлений: глубина, отказы, время ожидания, журнал на диске"""
+    return {**update_queue.summary(), "spool": update_spool.summary()}
+
+@app.get("/api/admin/groq")
+@limiter.limit("30/minute")
+async def get_groq_api(request: Request, _: bool = Depends(verify_admin)):
+    """API для метрик клиента Groq: запросы, ошибки, время до первого байта, кэш ответов"""
+    return {
+        **groq_client.summary(),
+        "cache": llm_cache.summary(),
+        "coalescing": groq_singleflight.summary(),
+        "perceived_latency": perceived_latency.summary(),
+        "scheduler": groq_scheduler.summary(),
+        "providers": [provider.summary() for provider in llm_providers],
+    }
 
 @app.get("/api/admin/personalization")
-@limiter.limit("10/minute")
-async def get_personalization_api(request: Request, _: bool = Depends(verify_admin)):
-    """API для получения данных персонализации"""
-    return storage.personalization
+@limiter.limit("120/minute")
+async def get_personalization_api(request: Request, cursor: int = 0, limit: int = 100,
+                                  query: UserQuery = Depends(user_query), _: bool = Depends(verify_admin)):
+    """История и предпочтения постранично, по тем же курсорам и фильтрам, что /api/admin/users.
+    В items только пользователи страницы, у которых есть история."""
+    items, next_cursor = storage.users_page(cursor, max(1, min(limit, EXPORT_PAGE_SIZE)), query)
+    histories = storage.user_histories([uid for uid, _ in items])
+    return {
+        "items": [{"user_id": uid, **histories[uid]} for uid, _ in items if uid in histories],
+        "next_cursor": next_cursor,
+    }
+
+# Очереди, кэши и счётчики, которые уже ведутся в stats/summary, — считаются при выдаче
+prom.collector("bot_update_queue_depth", "gauge", "Обновлений в очереди и в обработке",
+               lambda: update_queue.depth)
+prom.collector("bot_update_queue_chats_pending", "gauge", "Чатов с необработанными обновлениями",
+               lambda: len(update_queue._chats))
+prom.collector("bot_update_queue_updates_total", "counter", "Входящие обновления по исходу",
+               lambda: {(result,): update_queue.stats[result]
+                        for result in ("accepted", "rejected", "skipped", "processed")},
+               ("result",))
+prom.collector("bot_update_spool_pending", "gauge", "Необработанных обновлений в журнале",
+               lambda: len(update_spool.pending))
+prom.collector("bot_groq_scheduler_active", "gauge", "Запросов к Groq в работе",
+               lambda: groq_scheduler.active)
+prom.collector("bot_groq_scheduler_queue_depth", "gauge", "Запросов к Groq в очереди по полосам",
+               lambda: {(lane,): depth for lane, depth in groq_scheduler.summary()["queue_depth_by_lane"].items()},
+               ("lane",))
+prom.collector("bot_llm_provider_available", "gauge", "1 — бэкенд LLM принимает запросы, 0 — на паузе",
+               lambda: {(provider.name,): int(provider.available_at() <= time.monotonic())
+                        for provider in llm_providers},
+               ("provider",))
+prom.collector("bot_groq_http_requests_total", "counter", "HTTP-запросы к Groq, включая повторы",
+               lambda: groq_client.stats["requests"])
+prom.collector("bot_groq_http_errors_total", "counter", "Неуспешные HTTP-запросы к Groq",
+               lambda: groq_client.stats["errors"])
+prom.collector("bot_llm_cache_requests_total", "counter", "Обращения к кэшу ответов LLM",
+               lambda: {(result,): llm_cache.stats[key]
+                        for result, key in (("hit", "hits"), ("disk_hit", "disk_hits"), ("miss", "misses"))},
+               ("result",))
+prom.collector("bot_llm_cache_hit_ratio", "gauge", "Доля попаданий в кэш ответов LLM",
+               lambda: (llm_cache.stats["hits"] + llm_cache.stats["disk_hits"])
+               / max(1, llm_cache.stats["hits"] + llm_cache.stats["disk_hits"] + llm_cache.stats["misses"]))
+prom.collector("bot_llm_cache_bytes", "gauge", "Размер кэша ответов LLM в памяти",
+               lambda: llm_cache._bytes)
+prom.collector("bot_llm_cache_disk_errors_total", "counter", "Ошибки запросов к таблице кэша ответов LLM",
+               lambda: llm_cache.stats["disk_errors"])
+prom.collector("bot_singleflight_calls_total", "counter", "Вызовы LLM через SingleFlight по функциям",
+               lambda: {(group,): stats["calls"] for group, stats in groq_singleflight.stats.items()},
+               ("system_prompt_key",))
+prom.collector("bot_singleflight_coalesced_total", "counter", "Вызовы, дождавшиеся чужого запроса",
+               lambda: {(group,): stats["coalesced"] for group, stats in groq_singleflight.stats.items()},
+               ("system_prompt_key",))
+if MULTI_WORKER:
+    prom.const_labels["worker"] = str(os.getpid())
+
+@app.get("/metrics")
+async def prometheus_metrics(_: bool = Depends(verify_admin)):
+    """Метрики в текстовом формате Prometheus (scrape с заголовком Authorization: Bearer ADMIN_TOKEN)"""
+    return PlainTextResponse(prom.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 # =====================
 # MAIN ENTRY POINT
@@ -1989,9 +5913,11 @@ if __name__ == "__main__":
     logger.info("• Система персонализации")
     logger.info("="*50)
 
+    # Несколько процессов uvicorn импортирует приложение сам, по строке
     uvicorn.run(
-        app,
+        "main:app" if MULTI_WORKER else app,
         host="0.0.0.0",
         port=PORT,
         reload=False,
+        workers=WEB_CONCURRENCY,
     )
@@ -0,0 +1,15 @@
+"""Общие настройки тестов.
+
+main.py читает окружение и создаёт хранилище при импорте, поэтому модуль
+импортируется из пустого временного каталога с тестовым окружением.
+"""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST-TOKEN")
+os.environ["STORAGE_BACKEND"] = "json"
+os.environ["UPDATE_SPOOL_FILE"] = ""
+os.chdir(tempfile.mkdtemp(prefix="astro-bot-tests-"))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
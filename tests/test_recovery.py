@@ -0,0 +1,224 @@
+"""Восстановление состояния после падения: журналы, снимки и перенос данных"""
+import asyncio
+import concurrent.futures
+import sqlite3
+import threading
+
+import pytest
+
+import main
+
+NOW = "2026-01-01 10:00:00"
+
+def fill(storage: main.BaseStorage, first: int, count: int):
+    for index in range(first, first + count):
+        uid = str(index)
+        storage.register_user(uid, {"first_name": f"user{index}"}, NOW)
+        storage.append_action(uid, "profile", {"n": index}, f"2026-01-01T10:00:{index % 60:02d}", "01.01.2000")
+        storage.touch_user(uid, NOW, count_request=True)
+    storage.incr("calculations", count)
+
+def state(storage: main.BaseStorage) -> tuple:
+    users, cursor = [], 0
+    while cursor is not None:
+        page, cursor = storage.users_page(cursor, 100, main.UserQuery())
+        users.extend(page)
+    histories = storage.user_histories([uid for uid, _ in users])
+    return dict(users), histories, storage.export_stats()["calculations"]
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+# --- WAL ---
+
+def test_wal_replay_restores_unsaved_snapshot(workdir):
+    storage = main.JournaledStorage()
+    fill(storage, 0, 30)
+    asyncio.run(storage.save_all())
+
+    restored = main.JournaledStorage()
+    assert restored._seq == storage._seq
+    assert state(restored) == state(storage)
+    assert not (workdir / main.JournaledStorage.WAL_FILE).stat().st_size
+
+def test_wal_torn_tail_is_dropped_and_not_appended_after(workdir):
+    storage = main.JournaledStorage()
+    fill(storage, 0, 10)
+    asyncio.run(storage.save_all())
+    expected = state(storage)
+    with open(main.JournaledStorage.WAL_FILE, "ab") as wal:
+        wal.write(b'{"s":999,"op":"incr","a":["calcul')
+
+    restored = main.JournaledStorage()
+    assert state(restored) == expected
+    fill(restored, 10, 5)
+    asyncio.run(restored.save_all())
+
+    again = main.JournaledStorage()
+    assert state(again) == state(restored)
+    assert len(state(again)[0]) == 15
+
+def test_wal_merges_unfinished_compaction(workdir):
+    storage = main.JournaledStorage()
+    fill(storage, 0, 10)
+    asyncio.run(storage.save_all())
+    # Уплотнение успело переименовать журнал, но не записало снимок
+    storage._rotate_wal()
+    fill(storage, 10, 10)
+    asyncio.run(storage.save_all())
+    assert (workdir / "storage.wal.compacting").exists()
+
+    restored = main.JournaledStorage()
+    assert state(restored) == state(storage)
+    assert not (workdir / "storage.wal.compacting").exists()
+
+def test_wal_compaction_keeps_untouched_records(workdir):
+    storage = main.JournaledStorage()
+    fill(storage, 0, 20)
+    asyncio.run(storage.compact())
+    # Второе уплотнение перекодирует только изменённых пользователей
+    storage.append_action("3", "natal", None, "2026-01-02T10:00:00")
+    fill(storage, 20, 2)
+    asyncio.run(storage.compact())
+
+    restored = main.JournaledStorage()
+    assert restored._seq == storage._seq
+    assert state(restored) == state(storage)
+    assert restored.recent_actions("3", 2) == ["profile", "natal"]
+
+# --- SQLite ---
+
+def hold_writer(storage: main.SQLiteStorage) -> threading.Event:
+    """Занимает поток storage-io, пока не будет установлено событие"""
+    release = threading.Event()
+    storage._io_executor.submit(release.wait, 5)
+    return release
+
+def lock_database(path) -> sqlite3.Connection:
+    """Блокировка записи от имени другого процесса"""
+    other = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    other.execute("BEGIN IMMEDIATE")
+    return other
+
+def test_sqlite_reads_see_queued_actions(workdir):
+    storage = main.SQLiteStorage(str(workdir / "bot.db"))
+    storage.append_action("1", "profile", None, "2026-01-01T10:00:00", "01.01.2000")
+    release = hold_writer(storage)
+    storage.append_action("1", "numerology_request", None, "2026-01-01T10:00:01")
+    storage.append_action("1", "natal_chart_request", None, "2026-01-01T10:00:02", "02.02.2002")
+    assert storage.recent_actions("1", 1) == ["natal_chart_request"]
+    assert storage.recent_actions("1", 5) == ["profile", "numerology_request", "natal_chart_request"]
+    assert storage.get_birth_date("1") == "02.02.2002"
+
+    release.set()
+    asyncio.run(storage.save_all(force=True))
+    assert not storage._queued_actions
+    assert storage.recent_actions("1", 5) == ["profile", "numerology_request", "natal_chart_request"]
+    assert storage.get_birth_date("1") == "02.02.2002"
+
+def test_sqlite_retries_mutation_while_database_is_busy(workdir):
+    storage = main.SQLiteStorage(str(workdir / "bot.db"))
+    storage._writer.execute("PRAGMA busy_timeout = 0")
+    other = lock_database(workdir / "bot.db")
+    storage.append_action("1", "profile", None, "2026-01-01T10:00:00")
+    threading.Timer(0.2, other.rollback).start()
+    asyncio.run(storage.save_all(force=True))
+
+    assert storage.flush_stats["mutation_retries"] >= 1
+    assert storage.flush_stats["mutation_errors"] == 0
+    assert storage.recent_actions("1", 5) == ["profile"]
+
+def test_sqlite_failed_mutation_is_counted_and_dropped_from_queue(workdir, monkeypatch):
+    monkeypatch.setattr(main, "SQLITE_WRITE_RETRIES", 0)
+    storage = main.SQLiteStorage(str(workdir / "bot.db"))
+    storage._writer.execute("PRAGMA busy_timeout = 0")
+    other = lock_database(workdir / "bot.db")
+    storage.append_action("1", "profile", None, "2026-01-01T10:00:00")
+    storage._io_executor.submit(lambda: None).result()
+    other.rollback()
+
+    assert storage.flush_stats["mutation_errors"] == 1
+    assert storage.recent_actions("1", 5) == []
+
+def test_sqlite_imports_legacy_json_once(workdir):
+    legacy = main.Storage()
+    fill(legacy, 0, 25)
+    asyncio.run(legacy.save_all(force=True))
+    expected = state(legacy)
+
+    def imported(storage: main.SQLiteStorage) -> tuple:
+        users, histories, calculations = state(storage)
+        # Пустые колонки SQLite в JSON-записях просто отсутствуют
+        users = {uid: {k: v for k, v in user.items() if v is not None} for uid, user in users.items()}
+        return users, histories, calculations
+
+    # Воркеры стартуют одновременно: перенос выполняет только один из них
+    with concurrent.futures.ThreadPoolExecutor(4) as pool:
+        workers = list(pool.map(lambda _: main.SQLiteStorage(str(workdir / "bot.db")), range(4)))
+    for storage in workers:
+        assert imported(storage) == expected
+    assert workers[0].conn.execute("SELECT COUNT(*) FROM actions").fetchone()[0] == 25
+
+    restarted = main.SQLiteStorage(str(workdir / "bot.db"))
+    assert imported(restarted) == expected
+
+# --- журнал обновлений ---
+
+def make_update(update_id: int) -> main.RawUpdate:
+    return main.decode_update(
+        b'{"update_id":%d,"message":{"message_id":%d,"chat":{"id":%d},"text":"/start"}}'
+        % (update_id, update_id, 100 + update_id % 3)
+    )
+
+def spool_session(path, compact_bytes: int, appended=(), done=()) -> main.UpdateSpool:
+    """Открывает журнал, принимает и отмечает обработанными обновления и закрывает его"""
+    spool = main.UpdateSpool(str(path), compact_bytes)
+    spool.open()
+
+    async def run():
+        for update_id in appended:
+            await spool.append(make_update(update_id))
+        for update_id in done:
+            spool.mark_done(spool.pending[update_id])
+        await spool.close()
+
+    asyncio.run(run())
+    return spool
+
+def test_spool_replays_updates_without_done(workdir):
+    path = workdir / "updates.spool"
+    spool_session(path, 1 << 20, appended=[1, 2, 3, 4], done=[2, 4])
+
+    restored = main.UpdateSpool(str(path), 1 << 20)
+    replayed = restored.open()
+    assert [update.update_id for update in replayed] == [1, 3]
+    assert [update.raw for update in replayed] == [make_update(1).raw, make_update(3).raw]
+    assert replayed[0].chat_key == make_update(1).chat_key
+    # Повторная доставка принятого или уже обработанного обновления отбрасывается
+    assert restored.seen(1) and restored.seen(2)
+    assert not restored.seen(5)
+    assert restored.stats["duplicates"] == 2
+    asyncio.run(restored.close())
+
+def test_spool_torn_tail_is_dropped(workdir):
+    path = workdir / "updates.spool"
+    spool_session(path, 1 << 20, appended=[1, 2], done=[1])
+    with open(path, "ab") as f:
+        f.write(b'{"u":3,"r":{"update_id":3,"mess')
+
+    spool_session(path, 1 << 20, appended=[4])
+    restored = main.UpdateSpool(str(path), 1 << 20)
+    assert [update.update_id for update in restored.open()] == [2, 4]
+    asyncio.run(restored.close())
+
+def test_spool_compaction_keeps_only_pending(workdir):
+    path = workdir / "updates.spool"
+    spool = spool_session(path, 1024, appended=range(1, 41), done=range(1, 39))
+    assert spool.stats["compactions"] >= 1
+    assert path.stat().st_size < 1024
+
+    restored = main.UpdateSpool(str(path), 1024)
+    assert [update.update_id for update in restored.open()] == [39, 40]
+    asyncio.run(restored.close())